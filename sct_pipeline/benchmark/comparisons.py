@@ -0,0 +1,458 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import nibabel as nib
+import nipype.interfaces.ants as ants
+from nipype.utils.filemanip import split_filename
+
+from sct_pipeline.benchmark.harness import standin_environment
+from sct_pipeline.benchmark.phantom import cord_phantom, write_dwi_phantom, write_mt_phantom, write_t2_phantom
+from sct_pipeline.interfaces.dmri import ComputeDTI, ComputeDTINative
+from sct_pipeline.interfaces.registration import ApplyTransformsNative, RegisterMultimodal, RegisterSlicewiseNative
+from sct_pipeline.interfaces.segmentation import LabelFusion, LabelFusionNative
+from sct_pipeline.interfaces.util import ComputeMTR, ComputeMTRNative, GenerateTemplate, ThresholdLabels
+from sct_pipeline.workflows.spine_vbm import spine_label_registration
+
+'''
+Comparisons of the in-process interfaces with the command line tools they replace, on phantoms (phantom.py).
+Each comparison runs a reference interface (the SCT/ANTs wrapper) and a candidate interface (the in-process
+version) on the same inputs and reports the best wall time of each over the repeats and their agreement inside
+the phantom cord (cord and CSF for registrations). By default the commands are the stand-ins (standins.py),
+which measures the interpreter start and I/O the native interfaces avoid but gives no meaningful agreement. With
+use_standins=False the commands on PATH are used, which measures both against the real tools.
+
+The transforms comparison resamples a segmentation (linear) and vertebral labels (nearest neighbour) of a T2
+phantom through a displacement field and an ITK affine with antsApplyTransforms (what sct_apply_transfo runs)
+and with ApplyTransformsNative.
+
+The threshold and template comparisons measure memory: ThresholdLabels and GenerateTemplate against their first
+versions (kept below as functions), which loaded every label file, or the merged 4D image, as float64. Each
+side runs in a new process and its peak RSS above the memory of the interpreter is reported with the times.
+
+The registration profiles comparison is of the same kind, the fast profile of spine_vbm against the full one on
+two T2 phantoms, with the Dice of the warped vertebral labels as agreement. It is only meaningful with ANTs.
+'''
+
+
+def _phantom_kwargs(shape, zooms):
+    kwargs = {}
+    if shape is not None:
+        kwargs['shape'] = tuple(shape)
+    if zooms is not None:
+        kwargs['zooms'] = tuple(zooms)
+    return kwargs
+
+
+def _run(interface, run_dir, repeats=1):
+    # Runs interface repeats times in run_dir, returns the best wall time and the outputs of the last run
+    os.makedirs(run_dir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(run_dir)
+    try:
+        times = []
+        for _ in range(repeats):
+            start = time.time()
+            result = interface.run()
+            times.append(time.time() - start)
+    finally:
+        os.chdir(cwd)
+    return min(times), result.outputs
+
+
+def _agreement(reference_file, candidate_file, mask):
+    # Largest and mean absolute difference inside mask, relative to the mean absolute reference value
+    reference = nib.load(reference_file).get_fdata(dtype=np.float32)[mask]
+    candidate = nib.load(candidate_file).get_fdata(dtype=np.float32)[mask]
+    scale = max(float(np.mean(np.abs(reference))), np.finfo(np.float32).tiny)
+    difference = np.abs(candidate - reference)
+    return float(difference.max()) / scale, float(difference.mean()) / scale
+
+
+def compare_dti(work_dir, shape=None, zooms=None, repeats=1):
+    # ComputeDTINative against sct_dmri_compute_dti (ComputeDTI) on a DWI phantom with 2 b0 and 20 directions
+    kwargs = _phantom_kwargs(shape, zooms)
+    dwi, bval, bvec = write_dwi_phantom(os.path.join(work_dir, 'phantom'), num_directions=20, num_b0=2, **kwargs)
+    cord = cord_phantom(**kwargs)[0] > 0
+
+    reference_time, reference = _run(ComputeDTI(dwi_image=dwi, bval=bval, bvec=bvec),
+                                     os.path.join(work_dir, 'reference'), repeats)
+    candidate_time, candidate = _run(ComputeDTINative(dwi_image=dwi, bval=bval, bvec=bvec),
+                                     os.path.join(work_dir, 'candidate'), repeats)
+    agreement = {}
+    for metric in ['fa', 'md', 'ad', 'rd']:
+        agreement[metric + '_max_diff'], agreement[metric + '_mean_diff'] = \
+            _agreement(getattr(reference, metric), getattr(candidate, metric), cord)
+    return {'reference': 'ComputeDTI', 'candidate': 'ComputeDTINative', 'reference_s': reference_time,
+            'candidate_s': candidate_time, 'agreement': agreement}
+
+
+def compare_mtr(work_dir, shape=None, zooms=None, repeats=1):
+    # ComputeMTRNative against sct_compute_mtr (ComputeMTR) on the MT phantom
+    kwargs = _phantom_kwargs(shape, zooms)
+    mton, mtoff = write_mt_phantom(os.path.join(work_dir, 'phantom'), **kwargs)
+    cord = cord_phantom(**kwargs)[0] > 0
+
+    reference_time, reference = _run(ComputeMTR(mt_on_image=mton, mt_off_image=mtoff),
+                                     os.path.join(work_dir, 'reference'), repeats)
+    candidate_time, candidate = _run(ComputeMTRNative(mt_on_image=mton, mt_off_image=mtoff),
+                                     os.path.join(work_dir, 'candidate'), repeats)
+    agreement = {}
+    agreement['mtr_max_diff'], agreement['mtr_mean_diff'] = _agreement(reference.mtr_image, candidate.mtr_image,
+                                                                       cord)
+    return {'reference': 'ComputeMTR', 'candidate': 'ComputeMTRNative', 'reference_s': reference_time,
+            'candidate_s': candidate_time, 'agreement': agreement}
+
+
+def compare_slicereg(work_dir, shape=None, zooms=None, repeats=1):
+    # RegisterSlicewiseNative against sct_register_multimodal with slicereg (RegisterMultimodal), registering the
+    # MT off to the MT on phantom inside the cord and CSF as in create_spinalcord_mtr_workflow
+    kwargs = _phantom_kwargs(shape, zooms)
+    mton, mtoff = write_mt_phantom(os.path.join(work_dir, 'phantom'), **kwargs)
+    cord, csf, _, affine = cord_phantom(**kwargs)
+    mask = (cord + csf) > 0
+    mask_file = os.path.join(work_dir, 'phantom_mask.nii.gz')
+    nib.save(nib.Nifti1Image(mask.astype(np.uint8), affine), mask_file)
+
+    reference_time, reference = _run(RegisterMultimodal(input_image=mtoff, destination_image=mton, mask=mask_file,
+                                                        param='step=1,type=im,algo=slicereg,metric=CC',
+                                                        interpolation='spline'),
+                                     os.path.join(work_dir, 'reference'), repeats)
+    candidate_time, candidate = _run(RegisterSlicewiseNative(input_image=mtoff, destination_image=mton,
+                                                             mask=mask_file, interpolation='spline'),
+                                     os.path.join(work_dir, 'candidate'), repeats)
+    agreement = {}
+    agreement['warped_max_diff'], agreement['warped_mean_diff'] = \
+        _agreement(reference.warped_input_image, candidate.warped_input_image, mask)
+    return {'reference': 'RegisterMultimodal', 'candidate': 'RegisterSlicewiseNative', 'reference_s': reference_time,
+            'candidate_s': candidate_time, 'agreement': agreement}
+
+
+def _write_spine_phantom(prefix, seed, kwargs, num_levels=7):
+    # T2 image, cord segmentation and vertebral levels (num_levels bands along z inside the cord) of a phantom
+    image = write_t2_phantom(prefix, seed=seed, **kwargs)
+    header = nib.load(image).header
+    cord, _, _, affine = cord_phantom(header.get_data_shape(), header.get_zooms(), seed=seed)
+    levels = cord * (1 + np.arange(cord.shape[2]) * num_levels // cord.shape[2])[None, None]
+    files = [image]
+    for data, suffix in [(cord, '_seg.nii.gz'), (levels, '_labels.nii.gz')]:
+        files.append(os.path.abspath(prefix + suffix))
+        nib.save(nib.Nifti1Image(data.astype(np.uint8), affine), files[-1])
+    return files
+
+
+def _dice(fixed_labels, warped_labels):
+    # Mean Dice over the labels of fixed_labels
+    fixed = np.rint(nib.load(fixed_labels).get_fdata())
+    warped = np.rint(nib.load(warped_labels).get_fdata())
+    dice = [2.0 * np.sum((fixed == label) & (warped == label)) / (np.sum(fixed == label) + np.sum(warped == label))
+            for label in np.unique(fixed[fixed > 0])]
+    return float(np.mean(dice))
+
+
+def _write_itk_transforms(prefix, affine, shape, angle_deg=4.0, translation_lps=(1.0, -0.5, 1.5),
+                           amplitude_mm=1.0):
+    # ITK .mat of a rotation about z around the centre of the grid followed by a translation, and a smooth
+    # displacement field on the grid (NIfTI, LPS vectors in mm). Returns [field, affine] in antsApplyTransforms
+    # order, the affine is applied first.
+    import scipy.io
+
+    lps = np.diag([-1.0, -1.0, 1.0])
+    angle = np.deg2rad(angle_deg)
+    rotation = np.array([[np.cos(angle), -np.sin(angle), 0], [np.sin(angle), np.cos(angle), 0], [0, 0, 1]])
+    center = lps.dot(affine[:3, :3].dot((np.array(shape[:3]) - 1) / 2.0) + affine[:3, 3])
+    mat_file = os.path.abspath(prefix + '_affine.mat')
+    scipy.io.savemat(mat_file, {'AffineTransform_double_3_3': np.r_[rotation.ravel(), translation_lps][:, None],
+                                'fixed': center[:, None]}, format='4')
+
+    i, j, k = np.meshgrid(*[np.linspace(0, 2 * np.pi, n) for n in shape[:3]], indexing='ij')
+    field = np.zeros(tuple(shape[:3]) + (1, 3), dtype=np.float32)
+    field[..., 0, 0] = amplitude_mm * np.sin(k) * np.cos(j)
+    field[..., 0, 1] = 0.5 * amplitude_mm * np.cos(i)
+    img = nib.Nifti1Image(field, affine)
+    img.header.set_intent('vector')
+    field_file = os.path.abspath(prefix + '_warp.nii.gz')
+    nib.save(img, field_file)
+    return [field_file, mat_file]
+
+
+def compare_transforms(work_dir, shape=None, zooms=None, repeats=1):
+    # ApplyTransformsNative against antsApplyTransforms (ants.ApplyTransforms, one run per image) resampling the
+    # segmentation and labels of a T2 phantom through a displacement field and an affine, as affine_warp_seg and
+    # affine_warp_labels of create_spine_template_workflow
+    kwargs = _phantom_kwargs(shape, zooms)
+    image, seg, labels = _write_spine_phantom(os.path.join(work_dir, 'phantom'), 0, kwargs)
+    img = nib.load(image)
+    transforms = _write_itk_transforms(os.path.join(work_dir, 'phantom'), img.affine, img.shape)
+
+    reference_dir = os.path.join(work_dir, 'reference')
+    reference_time = 0.0
+    reference = {}
+    for name, input_image, interpolation in [('seg', seg, 'Linear'), ('labels', labels, 'NearestNeighbor')]:
+        run_time, outputs = _run(ants.ApplyTransforms(input_image=input_image, reference_image=image,
+                                                      transforms=transforms, interpolation=interpolation),
+                                 reference_dir, repeats)
+        reference_time += run_time
+        reference[name] = outputs.output_image
+    candidate_time, candidate = _run(ApplyTransformsNative(input_images=[seg, labels], interpolations=['linear', 'nn'],
+                                                           reference_image=image, transforms=transforms),
+                                     os.path.join(work_dir, 'candidate'), repeats)
+
+    # The seg is compared where either side is inside the cord
+    mask = (nib.load(reference['seg']).get_fdata() > 0) | (nib.load(candidate.output_images[0]).get_fdata() > 0)
+    reference_labels = np.rint(nib.load(reference['labels']).get_fdata())
+    candidate_labels = np.rint(nib.load(candidate.output_images[1]).get_fdata())
+    agreement = {'labels_mismatch': float(np.mean(reference_labels[mask] != candidate_labels[mask])),
+                 'labels_dice': _dice(reference['labels'], candidate.output_images[1])}
+    agreement['seg_max_diff'], agreement['seg_mean_diff'] = _agreement(reference['seg'], candidate.output_images[0],
+                                                                       mask)
+    return {'reference': 'ants.ApplyTransforms', 'candidate': 'ApplyTransformsNative', 'reference_s': reference_time,
+            'candidate_s': candidate_time, 'agreement': agreement}
+
+
+def compare_registration_profiles(work_dir, shape=None, zooms=None, repeats=1):
+    # Fast against full REGISTRATION_PROFILES of the deformable registration of create_spine_template_workflow,
+    # registering one T2 phantom (with its segmentation and labels) to another with a different centreline
+    kwargs = _phantom_kwargs(shape, zooms)
+    fixed = _write_spine_phantom(os.path.join(work_dir, 'fixed'), 0, kwargs)
+    moving = _write_spine_phantom(os.path.join(work_dir, 'moving'), 1, kwargs)
+
+    times, warped_labels = {}, {}
+    for profile in ['full', 'fast']:
+        registration = spine_label_registration('registration', deformable=True, profile=profile).interface
+        registration.inputs.fixed_image = fixed
+        registration.inputs.moving_image = moving
+        run_dir = os.path.join(work_dir, profile)
+        times[profile], outputs = _run(registration, run_dir, repeats)
+        warp = ants.ApplyTransforms(input_image=moving[2], reference_image=fixed[0],
+                                    transforms=outputs.composite_transform, interpolation='NearestNeighbor')
+        warped_labels[profile] = _run(warp, run_dir)[1].output_image
+
+    agreement = {'full_dice': _dice(fixed[2], warped_labels['full']),
+                 'fast_dice': _dice(fixed[2], warped_labels['fast']),
+                 'fast_vs_full_dice': _dice(warped_labels['full'], warped_labels['fast'])}
+    return {'reference': 'full profile', 'candidate': 'fast profile', 'reference_s': times['full'],
+            'candidate_s': times['fast'], 'agreement': agreement}
+
+
+def compare_label_fusion(work_dir, shape=None, zooms=None, repeats=1, num_levels=7):
+    # LabelFusionNative against ImageMath MajorityVoting (LabelFusion) on four label images of the phantom cord,
+    # two with the vertebral levels of _write_spine_phantom and two with the levels moved down by one slice. The
+    # slices where they differ are 2 against 2 ties, which report how both break them.
+    kwargs = _phantom_kwargs(shape, zooms)
+    cord, _, _, affine = cord_phantom(**kwargs)
+    levels = [cord * (1 + (np.arange(cord.shape[2]) + shift) * num_levels // (cord.shape[2] + 1))[None, None]
+              for shift in [0, 1]]
+    images = []
+    for i, data in enumerate([levels[0], levels[0], levels[1], levels[1]]):
+        images.append(os.path.join(work_dir, 'labels_%d.nii.gz' % i))
+        nib.save(nib.Nifti1Image(data.astype(np.uint8), affine), images[-1])
+    ties = levels[0] != levels[1]
+
+    reference_time, reference = _run(LabelFusion(images=images, operation='MajorityVoting'),
+                                     os.path.join(work_dir, 'reference'), repeats)
+    candidate_time, candidate = _run(LabelFusionNative(images=images, operation='MajorityVoting',
+                                                       max_label=num_levels),
+                                     os.path.join(work_dir, 'candidate'), repeats)
+    reference_labels = np.rint(nib.load(reference.output_image).get_fdata())
+    candidate_labels = np.rint(nib.load(candidate.output_image).get_fdata())
+    mismatch = reference_labels != candidate_labels
+    # Ties the native fusion gives to the lowest label, against the share ImageMath gives to it
+    agreement = {'tie_voxels': float(np.sum(ties)),
+                 'tie_mismatch': float(np.mean(mismatch[ties])),
+                 'other_mismatch': float(np.mean(mismatch[~ties])),
+                 'ties_to_lowest_reference': float(np.mean(reference_labels[ties] == np.minimum(*levels)[ties]))}
+    return {'reference': 'LabelFusion', 'candidate': 'LabelFusionNative', 'reference_s': reference_time,
+            'candidate_s': candidate_time, 'agreement': agreement}
+
+
+def _rss_gb(field):
+    # VmRSS (current) or VmHWM (peak) of the process on Linux
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024.0 ** 2
+    raise ValueError('No %s in /proc/self/status' % field)
+
+
+def _max_rss_gb():
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    scale = 1024.0 ** 3 if sys.platform == 'darwin' else 1024.0 ** 2
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def _reset_peak_rss():
+    # Linux resets VmHWM to the current RSS, False where it cannot be reset
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        _rss_gb('VmHWM')
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def _measured_call(function, run_dir, args):
+    # Runs function(*args) in run_dir, returns its wall time and the peak RSS it added to the process. The peak is
+    # reset first where possible, so the imports do not hide it, elsewhere the peak of the whole process is compared.
+    os.makedirs(run_dir, exist_ok=True)
+    os.chdir(run_dir)
+    reset = _reset_peak_rss()
+    before = _rss_gb('VmRSS') if reset else _max_rss_gb()
+    start = time.time()
+    function(*args)
+    run_time = time.time() - start
+    return run_time, (_rss_gb('VmHWM') if reset else _max_rss_gb()) - before
+
+
+def _run_isolated(function, run_dir, repeats, *args):
+    # Best wall time and largest peak RSS (GB) of repeats runs of function(*args), each in a new process so that
+    # the peak of one run (or of writing the phantoms) does not hide the next one
+    times, peaks = [], []
+    for _ in range(repeats):
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            run_time, peak = pool.submit(_measured_call, function, run_dir, args).result()
+        times.append(run_time)
+        peaks.append(peak)
+    return min(times), max(peaks)
+
+
+def _baseline_threshold_labels(label_files, threshold=True, num_additional_labels_removed=1):
+    # ThresholdLabels before it streamed the label files
+    vol_list, header_list, affine_list = [], [], []
+    max_common_label = np.inf
+    for f in label_files:
+        vol_obj = nib.load(f)
+        vol_data = vol_obj.get_fdata()
+        vol_list.append(vol_data)
+        header_list.append(vol_obj.header)
+        affine_list.append(vol_obj.affine)
+        max_common_label = min(max_common_label, np.max(vol_data))
+    max_common_label = max_common_label - num_additional_labels_removed
+    for f, vol_data, header, affine in zip(label_files, vol_list, header_list, affine_list):
+        vol_data[vol_data > max_common_label] = 0
+        if threshold:
+            vol_data[vol_data > 0] = 1
+        nib.Nifti1Image(vol_data, affine, header).to_filename(split_filename(f)[1] + '_thresh.nii.gz')
+
+
+def _baseline_generate_template(input_file, flip_axis=0):
+    # GenerateTemplate before it averaged the volumes one at a time, on the 4D image merged by fslmerge
+    vol_obj = nib.load(input_file)
+    vol_data = vol_obj.get_fdata()
+    if flip_axis == -1:
+        template_data = np.average(vol_data, axis=-1)
+    else:
+        template_data = (np.average(vol_data, axis=-1) + np.average(np.flip(vol_data, axis=flip_axis), axis=-1)) / 2
+    nib.Nifti1Image(template_data, vol_obj.affine, vol_obj.header).to_filename('template.nii.gz')
+
+
+def _threshold_labels(label_files):
+    ThresholdLabels(label_files=label_files, threshold=True, num_additional_labels_removed=1).run()
+
+
+def _generate_template(input_files):
+    GenerateTemplate(input_files=input_files).run()
+
+
+def _memory_cohort(work_dir, shape, zooms, num_subjects):
+    # T2 images and vertebral labels of a straightened cohort, one phantom copied for every subject
+    kwargs = _phantom_kwargs(shape or (160, 160, 256), zooms or (0.5, 0.5, 0.5))
+    image, _, labels = _write_spine_phantom(os.path.join(work_dir, 'phantom'), 0, kwargs)
+    images, label_files = [], []
+    for i in range(num_subjects):
+        images.append(os.path.join(work_dir, 'sub%04d_T2w.nii.gz' % (i + 1)))
+        label_files.append(os.path.join(work_dir, 'sub%04d_labels.nii.gz' % (i + 1)))
+        shutil.copyfile(image, images[-1])
+        shutil.copyfile(labels, label_files[-1])
+    return images, label_files
+
+
+def compare_threshold_labels(work_dir, shape=None, zooms=None, repeats=1, num_subjects=8):
+    # Peak memory of ThresholdLabels against its first version on the labels of num_subjects straightened
+    # subjects (160x160x256 voxels by default), thresholded as in create_spine_template_workflow
+    _, label_files = _memory_cohort(work_dir, shape, zooms, num_subjects)
+    reference_dir = os.path.join(work_dir, 'reference')
+    candidate_dir = os.path.join(work_dir, 'candidate')
+    reference_time, reference_peak = _run_isolated(_baseline_threshold_labels, reference_dir, repeats, label_files)
+    candidate_time, candidate_peak = _run_isolated(_threshold_labels, candidate_dir, repeats, label_files)
+
+    # The first version wrote the float64 labels with a scaling (1 is stored as 1.00000006)
+    mismatch = [np.mean(np.rint(nib.load(os.path.join(reference_dir, name)).get_fdata()) !=
+                        np.rint(nib.load(os.path.join(candidate_dir, name)).get_fdata()))
+                for name in [split_filename(f)[1] + '_thresh.nii.gz' for f in label_files]]
+    agreement = {'reference_peak_gb': reference_peak, 'candidate_peak_gb': candidate_peak,
+                 'labels_mismatch': float(np.max(mismatch))}
+    return {'reference': 'ThresholdLabels (first)', 'candidate': 'ThresholdLabels', 'reference_s': reference_time,
+            'candidate_s': candidate_time, 'agreement': agreement}
+
+
+def compare_generate_template(work_dir, shape=None, zooms=None, repeats=1, num_subjects=8):
+    # Peak memory of GenerateTemplate averaging the 3D images one at a time (stream_templates) against its first
+    # version on the 4D image merged from them, for num_subjects straightened subjects
+    images, _ = _memory_cohort(work_dir, shape, zooms, num_subjects)
+    merged = os.path.join(work_dir, 'merged.nii.gz')
+    first = nib.load(images[0])
+    nib.save(nib.Nifti1Image(np.stack([nib.load(f).get_fdata(dtype=np.float32) for f in images], axis=-1),
+                             first.affine), merged)
+
+    reference_dir = os.path.join(work_dir, 'reference')
+    candidate_dir = os.path.join(work_dir, 'candidate')
+    reference_time, reference_peak = _run_isolated(_baseline_generate_template, reference_dir, repeats, merged)
+    candidate_time, candidate_peak = _run_isolated(_generate_template, candidate_dir, repeats, images)
+
+    agreement = {'reference_peak_gb': reference_peak, 'candidate_peak_gb': candidate_peak}
+    agreement['template_max_diff'], agreement['template_mean_diff'] = \
+        _agreement(os.path.join(reference_dir, 'template.nii.gz'), os.path.join(candidate_dir, 'template.nii.gz'),
+                   first.get_fdata() > 0)
+    return {'reference': 'GenerateTemplate (first)', 'candidate': 'GenerateTemplate', 'reference_s': reference_time,
+            'candidate_s': candidate_time, 'agreement': agreement}
+
+
+COMPARISONS = {'dti': compare_dti, 'mtr': compare_mtr, 'slicereg': compare_slicereg,
+               'labelfusion': compare_label_fusion, 'transforms': compare_transforms,
+               'threshold': compare_threshold_labels, 'template': compare_generate_template,
+               'profiles': compare_registration_profiles}
+
+
+def run_comparison(comparison, output_dir, shape=None, zooms=None, repeats=1, use_standins=True, keep=False):
+    # Runs comparison (one of COMPARISONS) in a new folder of output_dir, removed afterwards unless keep is set
+    if comparison not in COMPARISONS:
+        raise ValueError('Unknown comparison %s (one of %s)' % (comparison, ', '.join(sorted(COMPARISONS))))
+    os.makedirs(output_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix='compare_%s_' % comparison, dir=output_dir)
+    try:
+        if use_standins:
+            with standin_environment(os.path.join(work_dir, 'bin')):
+                result = COMPARISONS[comparison](work_dir, shape, zooms, repeats)
+        else:
+            result = COMPARISONS[comparison](work_dir, shape, zooms, repeats)
+    except Exception:
+        print('Comparison files kept in %s' % work_dir)
+        raise
+
+    result.update({'comparison': comparison, 'standins': use_standins,
+                   'speedup': result['reference_s'] / max(result['candidate_s'], 1e-9)})
+    if keep:
+        print('Comparison files kept in %s' % work_dir)
+        result['work_dir'] = work_dir
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+def format_comparisons(results):
+    lines = ['%-11s %-24s %-24s %11s %11s %8s  %s' %
+             ('comparison', 'reference', 'candidate', 'reference_s', 'candidate_s', 'speedup', 'agreement')]
+    for r in results:
+        agreement = ' '.join('%s=%.3g' % (name, value) for name, value in sorted(r['agreement'].items()))
+        lines.append('%-11s %-24s %-24s %11.2f %11.2f %8.1f  %s' %
+                     (r['comparison'], r['reference'], r['candidate'], r['reference_s'], r['candidate_s'],
+                      r['speedup'], agreement))
+    return '\n'.join(lines)
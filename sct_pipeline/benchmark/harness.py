@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import contextlib
+
+import nipype.pipeline.engine as pe
+
+from sct_pipeline.benchmark.phantom import make_cohort
+from sct_pipeline.benchmark.standins import DELAY_VARIABLE, install_standins
+from sct_pipeline.interfaces.image import apply_intermediate_format, load_image, save_image
+from sct_pipeline.workflows.execution import run_workflow
+from sct_pipeline.workflows.processing import create_spinalcord_mtr_cohort_workflow, create_spinalcord_dti_workflow
+from sct_pipeline.workflows.spine_vbm import create_spine_template_workflow
+
+'''
+End-to-end benchmark of the workflows on synthetic cohorts. Each run writes phantoms (phantom.py), puts the
+stand-in executables (standins.py) first on PATH, builds the cohort workflow and runs it with run_workflow and
+its profiler. From the profile it reports the wall time against a lower bound, the larger of the critical path
+and the summed node time spread over the threads. What is left (scheduler overhead) is the time nipype spends
+hashing inputs, writing results and polling between nodes, which grows with the number of nodes of the cohort
+rather than with the work done by the commands. The bytes read and written by the nodes are reported as well.
+
+With a compression setting, the workflow is run with that intermediate format (apply_intermediate_format). Its
+I/O time is measured after the run by reading every intermediate image the nodes wrote and writing it again in
+the same format: the in-process interfaces and FSL follow the setting, the SCT and ANTs commands always write
+gzip (nibabel level). The read and write time per subject is reported.
+'''
+
+WORKFLOWS = ['mtr', 'dti', 'vbm']
+
+
+@contextlib.contextmanager
+def standin_environment(bin_dir, delay=0.0):
+    # Installs the stand-ins into bin_dir and puts them first on PATH, with the given delay, until the block exits
+    environ = {name: os.environ.get(name) for name in ['PATH', DELAY_VARIABLE]}
+    try:
+        os.environ['PATH'] = install_standins(bin_dir) + os.pathsep + os.environ.get('PATH', '')
+        os.environ[DELAY_VARIABLE] = json.dumps(delay)
+        yield bin_dir
+    finally:
+        for name, value in environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def create_benchmark_workflow(workflow, work_dir, subjects, use_native=False):
+    # Cohort workflow of subjects (from make_cohort) writing to work_dir. With use_native, the in-process
+    # interfaces are used where they do not need the PAM50 template.
+    if workflow == 'mtr':
+        wf = create_spinalcord_mtr_cohort_workflow(work_dir, subjects, compute_csa=True, use_native_mtr=use_native,
+                                                   use_native_metrics=use_native, use_native_slicereg=use_native,
+                                                   name='benchmark_mtr')
+    elif workflow == 'dti':
+        # One sub-workflow per subject in a single meta-workflow, as create_spinalcord_mtr_cohort_workflow
+        wf = pe.Workflow('benchmark_dti', work_dir)
+        wf.config['execution']['stop_on_first_crash'] = False
+        for subject in subjects:
+            subject_wf = create_spinalcord_dti_workflow(work_dir, subject['patient_id'], subject['scan_id'],
+                                                        use_native_dti=use_native,
+                                                        name=subject['patient_id'] + '_' + subject['scan_id'])
+            for field in ['dwi_file', 'bval_file', 'bvec_file']:
+                setattr(subject_wf.inputs.input_node, field, [subject[field]])
+            wf.add_nodes([subject_wf])
+    elif workflow == 'vbm':
+        wf = create_spine_template_workflow(work_dir, stream_templates=use_native,
+                                            use_native_label_fusion=use_native, use_native_transforms=use_native)
+        wf.inputs.input_node.spine_files = [subject['spine_file'] for subject in subjects]
+    else:
+        raise ValueError('Unknown workflow %s (one of %s)' % (workflow, ', '.join(WORKFLOWS)))
+    wf.config['execution']['crashdump_dir'] = work_dir
+    return wf
+
+
+def intermediate_io_time(wf, compression=None, compression_level=1):
+    # Seconds to read (decompress) and write again every image in the node folders of a run of wf, in the format
+    # it was written in. Returns (images, read_s, write_s).
+    import numpy as np
+    import nibabel as nib
+
+    root = os.path.join(wf.base_dir, wf.name)
+    rewrite_dir = tempfile.mkdtemp(prefix='io_', dir=wf.base_dir)
+    images, read_s, write_s = 0, 0.0, 0.0
+    # Subject folders of a cohort are links to their own working directories
+    for dirpath, _, filenames in os.walk(root, followlinks=True):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if not filename.endswith(('.nii', '.nii.gz')) or os.path.islink(path):
+                continue
+            if filename.endswith('.nii'):
+                fmt, level = 'none', compression_level
+            elif compression in ['gzip', 'parallel']:
+                fmt, level = compression, compression_level
+            else:
+                fmt, level = 'gzip', nib.openers.Opener.default_compresslevel
+            start = time.time()
+            img = load_image(path)
+            data = np.asarray(img.dataobj.get_unscaled())
+            read_s += time.time() - start
+
+            start = time.time()
+            written = save_image(img.__class__(data, img.affine, img.header), os.path.join(rewrite_dir, 'image'),
+                                 fmt, level)
+            write_s += time.time() - start
+            os.remove(written)
+            images += 1
+    shutil.rmtree(rewrite_dir, ignore_errors=True)
+    return images, read_s, write_s
+
+
+def summarize_benchmark(report, num_threads):
+    # Wall time, its lower bound and the scheduler overhead of a profile report (WorkflowProfiler.write_report)
+    records = [r for r in report['nodes'] if not r['mapnode']]
+    node_time = sum(r['wall_time_s'] for r in records)
+    critical_path = report['critical_path']['wall_time_s']
+    lower_bound = max(critical_path, node_time / num_threads)
+    overhead = max(report['wall_time_s'] - lower_bound, 0.0)
+    return {'nodes': len(records),
+            'crashed': sum(r['status'] != 'ok' for r in records),
+            'wall_time_s': report['wall_time_s'],
+            'critical_path_s': critical_path,
+            'node_time_s': node_time,
+            'lower_bound_s': lower_bound,
+            'scheduler_overhead_s': overhead,
+            'overhead_per_node_ms': 1000.0 * overhead / len(records) if records else 0.0,
+            'bytes_read': sum(r['bytes_read'] or 0 for r in records),
+            'bytes_written': sum(r['bytes_written'] or 0 for r in records)}
+
+
+def run_benchmark(workflow, num_subjects, output_dir, num_threads=1, delay=0.0, shape=None, zooms=None,
+                  use_native=False, unique_phantoms=False, memory_gb=None, keep=False, compression=None,
+                  compression_level=1):
+    # Runs workflow on num_subjects phantoms in a new folder of output_dir. delay is the stand-in delay in
+    # seconds, or a dict of seconds per command (see standins.py). compression is the intermediate format
+    # (gzip, parallel or none, the defaults of the interfaces if not set). The folder is removed afterwards
+    # unless keep is set or nodes crashed.
+    os.makedirs(output_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix='benchmark_%s_%d_' % (workflow, num_subjects), dir=output_dir)
+    with standin_environment(os.path.join(work_dir, 'bin'), delay):
+        subjects = make_cohort(os.path.join(work_dir, 'phantoms'), workflow, num_subjects, shape, zooms,
+                               unique_phantoms)
+        start = time.time()
+        wf = create_benchmark_workflow(workflow, work_dir, subjects, use_native)
+        if compression is not None:
+            apply_intermediate_format(wf, compression, compression_level)
+        build_time = time.time() - start
+
+        profile = os.path.join(work_dir, 'profile')
+        try:
+            run_workflow(wf, num_threads, profile=profile, memory_gb=memory_gb)
+        except RuntimeError as e:
+            # Crashed nodes are counted in the results
+            print(e)
+        with open(profile + '.json') as f:
+            report = json.load(f)
+        images, read_s, write_s = intermediate_io_time(wf, compression, compression_level)
+
+    result = {'workflow': workflow, 'subjects': num_subjects, 'threads': num_threads, 'native': use_native,
+              'delay': delay, 'compression': compression or 'default', 'build_time_s': build_time}
+    result.update(summarize_benchmark(report, num_threads))
+    result.update({'intermediate_images': images,
+                   'io_read_per_subject_s': read_s / num_subjects,
+                   'io_write_per_subject_s': write_s / num_subjects})
+    if keep or result['crashed']:
+        print('Benchmark files kept in %s' % work_dir)
+        result['work_dir'] = work_dir
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+def format_results(results):
+    lines = ['%-5s %8s %7s %-8s %6s %7s %9s %9s %9s %9s %8s %8s %8s %10s %10s' %
+             ('wf', 'subjects', 'threads', 'format', 'nodes', 'crashed', 'build_s', 'wall_s', 'bound_s', 'overhd_s',
+              'ms/node', 'rd_s/sub', 'wr_s/sub', 'read_MB', 'written_MB')]
+    for r in results:
+        lines.append('%-5s %8d %7d %-8s %6d %7d %9.1f %9.1f %9.1f %9.1f %8.0f %8.2f %8.2f %10.1f %10.1f' %
+                     (r['workflow'], r['subjects'], r['threads'], r['compression'], r['nodes'], r['crashed'],
+                      r['build_time_s'], r['wall_time_s'], r['lower_bound_s'], r['scheduler_overhead_s'],
+                      r['overhead_per_node_ms'], r['io_read_per_subject_s'], r['io_write_per_subject_s'],
+                      r['bytes_read'] / 1e6, r['bytes_written'] / 1e6))
+    return '\n'.join(lines)
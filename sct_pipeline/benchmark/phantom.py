@@ -0,0 +1,132 @@
+import os
+
+import numpy as np
+import nibabel as nib
+
+'''
+Synthetic spinal cord phantoms for benchmarking. An axial volume holds a cylindrical cord, surrounded by CSF and
+tissue, whose centreline sways along the slices. The cord is the brightest structure so the stand-in
+segmentation (standins.py) finds it. Writers produce the MT on/off pair of the MTR workflow, the DWI run (with
+bval/bvec files) of the DTI workflow and the T2 images of the VBM workflow, make_cohort the inputs of a whole
+cohort.
+'''
+
+WORKFLOW_INPUTS = {'mtr': ['mton_file', 'mtoff_file'], 'dti': ['dwi_file', 'bval_file', 'bvec_file'],
+                   'vbm': ['spine_file']}
+
+
+def phantom_affine(shape, zooms):
+    # Voxel to RAS+ affine with the centre of the volume at the origin
+    affine = np.diag(list(zooms) + [1.0])
+    affine[:3, 3] = -(np.asarray(shape[:3]) - 1) / 2.0 * np.asarray(zooms)
+    return affine
+
+
+def cord_phantom(shape=(64, 64, 24), zooms=(0.75, 0.75, 5.0), cord_radius_mm=4.0, csf_radius_mm=7.0,
+                 sway_mm=3.0, noise=0.02, seed=0):
+    # Returns the cord, CSF and tissue masks (float32) of the phantom and its affine
+    x, y = np.meshgrid((np.arange(shape[0]) - (shape[0] - 1) / 2.0) * zooms[0],
+                       (np.arange(shape[1]) - (shape[1] - 1) / 2.0) * zooms[1], indexing='ij')
+    neck_radius = 0.45 * min(shape[0] * zooms[0], shape[1] * zooms[1])
+    cord = np.zeros(shape[:3], dtype=np.float32)
+    csf = np.zeros(shape[:3], dtype=np.float32)
+    tissue = np.zeros(shape[:3], dtype=np.float32)
+    rng = np.random.RandomState(seed)
+    phase = rng.uniform(0, 2 * np.pi)
+    for z in range(shape[2]):
+        # Smooth left-right and anterior-posterior sway of the centreline
+        angle = phase + 2 * np.pi * z / max(shape[2], 1)
+        distance = np.hypot(x - sway_mm * np.sin(angle), y - 0.5 * sway_mm * np.cos(angle))
+        cord[..., z] = distance <= cord_radius_mm
+        csf[..., z] = (distance > cord_radius_mm) & (distance <= csf_radius_mm)
+        tissue[..., z] = (distance > csf_radius_mm) & (np.hypot(x, y) <= neck_radius)
+    return cord, csf, tissue, phantom_affine(shape, zooms)
+
+
+def _image(cord, csf, tissue, intensities, noise, rng):
+    data = intensities[0] * cord + intensities[1] * csf + intensities[2] * tissue
+    if noise > 0:
+        data = data + noise * max(intensities) * rng.standard_normal(data.shape)
+    return np.clip(data, 0, None).astype(np.float32)
+
+
+def _save(data, affine, filename):
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    nib.save(nib.Nifti1Image(data, affine), filename)
+    return os.path.abspath(filename)
+
+
+def write_mt_phantom(prefix, shape=(64, 64, 24), zooms=(0.75, 0.75, 5.0), mtr=(0.45, 0.1, 0.35), noise=0.02,
+                     seed=0):
+    # MT off and MT on (saturated by the cord, CSF and tissue mtr) images, returns (mton_file, mtoff_file)
+    cord, csf, tissue, affine = cord_phantom(shape, zooms, noise=noise, seed=seed)
+    rng = np.random.RandomState(seed + 1)
+    # Inverted T2* like contrast so that the cord is brighter than the CSF in both images
+    mtoff = _image(cord, csf, tissue, (1000.0, 700.0, 500.0), noise, rng)
+    mton = _image(cord, csf, tissue, (1000.0 * (1 - mtr[0]), 700.0 * (1 - mtr[1]), 500.0 * (1 - mtr[2])), noise,
+                  rng)
+    return _save(mton, affine, prefix + '_mton.nii.gz'), _save(mtoff, affine, prefix + '_mtoff.nii.gz')
+
+
+def write_dwi_phantom(prefix, shape=(64, 64, 24), zooms=(0.75, 0.75, 5.0), num_directions=6, bvalue=800.0,
+                      num_b0=1, noise=0.02, seed=0):
+    # DWI run with num_b0 b=0 volumes and num_directions directions on a half sphere, returns
+    # (dwi_file, bval_file, bvec_file). Diffusion along the cord (z) is faster than across it.
+    cord, csf, tissue, affine = cord_phantom(shape, zooms, noise=noise, seed=seed)
+    rng = np.random.RandomState(seed + 1)
+    golden = np.pi * (3 - np.sqrt(5))
+    k = np.arange(num_directions) + 0.5
+    gz = k / num_directions
+    directions = np.stack([np.sqrt(1 - gz ** 2) * np.cos(golden * k), np.sqrt(1 - gz ** 2) * np.sin(golden * k), gz],
+                          axis=1)
+    bvecs = np.concatenate([np.zeros((num_b0, 3)), directions])
+    bvals = np.r_[np.zeros(num_b0), np.full(num_directions, bvalue)]
+
+    volumes = []
+    for b, g in zip(bvals, bvecs):
+        cord_adc = 0.4e-3 + 1.4e-3 * g[2] ** 2
+        volumes.append(_image(cord, csf, tissue, (1000.0 * np.exp(-b * cord_adc), 800.0 * np.exp(-b * 3e-3),
+                                                  400.0 * np.exp(-b * 1e-3)), noise, rng))
+    dwi_file = _save(np.stack(volumes, axis=3), affine, prefix + '_dwi.nii.gz')
+    bval_file = os.path.abspath(prefix + '_dwi.bval')
+    bvec_file = os.path.abspath(prefix + '_dwi.bvec')
+    np.savetxt(bval_file, bvals[np.newaxis], fmt='%g')
+    np.savetxt(bvec_file, bvecs.T, fmt='%.6f')
+    return dwi_file, bval_file, bvec_file
+
+
+def write_t2_phantom(prefix, shape=(64, 64, 48), zooms=(0.8, 0.8, 0.8), noise=0.02, seed=0):
+    # T2 weighted image (cord brighter than the tissue), returns the image file
+    cord, csf, tissue, affine = cord_phantom(shape, zooms, noise=noise, seed=seed)
+    rng = np.random.RandomState(seed + 1)
+    return _save(_image(cord, csf, tissue, (1000.0, 600.0, 300.0), noise, rng), affine, prefix + '_T2w.nii.gz')
+
+
+def make_cohort(output_dir, workflow, num_subjects, shape=None, zooms=None, unique=False, seed=0):
+    # Writes the inputs of num_subjects subjects of workflow ('mtr', 'dti' or 'vbm') to output_dir and returns
+    # one dict per subject with patient_id, scan_id and the WORKFLOW_INPUTS of the workflow. Unless unique is
+    # set, one set of phantoms is written and shared by all subjects (their workflows still run separately).
+    if workflow not in WORKFLOW_INPUTS:
+        raise ValueError('Unknown workflow %s (one of %s)' % (workflow, ', '.join(sorted(WORKFLOW_INPUTS))))
+    kwargs = {}
+    if shape is not None:
+        kwargs['shape'] = tuple(shape)
+    if zooms is not None:
+        kwargs['zooms'] = tuple(zooms)
+
+    subjects = []
+    files = None
+    for i in range(num_subjects):
+        patient_id = 'sub%04d' % (i + 1)
+        if files is None or unique:
+            prefix = os.path.join(output_dir, patient_id if unique else 'phantom')
+            if workflow == 'mtr':
+                files = write_mt_phantom(prefix, seed=seed + i, **kwargs)
+            elif workflow == 'dti':
+                files = write_dwi_phantom(prefix, seed=seed + i, **kwargs)
+            else:
+                files = (write_t2_phantom(prefix, seed=seed + i, **kwargs),)
+        subject = {'patient_id': patient_id, 'scan_id': 'scan1'}
+        subject.update(zip(WORKFLOW_INPUTS[workflow], files))
+        subjects.append(subject)
+    return subjects
@@ -0,0 +1,470 @@
+import os
+import re
+import sys
+import csv
+import json
+import time
+
+'''
+Stand-in executables for the SCT, ANTs and FSL commands called by the pipelines, used to benchmark the
+workflows (scheduling, I/O, the in-process interfaces) without the toolboxes. Every stand-in parses the
+arguments the nipype interfaces pass, writes outputs with the names the interfaces expect and with shapes that
+are consistent with the inputs (a thresholded cord segmentation, vertebral levels along the cord, zero warping
+fields, images resampled by cropping/padding to the destination grid), then sleeps so the command takes the
+delay set in SCT_PIPELINE_STANDIN_DELAY. The delay is either a number of seconds for every command or a JSON
+object of seconds per command, e.g. {"sct_deepseg_sc": 20, "antsRegistration": 120, "*": 1}.
+
+install_standins writes one small script per command into a folder, put that folder first on PATH to use them.
+'''
+
+DELAY_VARIABLE = 'SCT_PIPELINE_STANDIN_DELAY'
+ANTS_VERSION = '2.3.5'
+SCT_VERSION = '5.0.0'
+
+
+def standin_delay(command, delays=None):
+    # Delay of command in seconds from delays (a number, a dict or a JSON string, defaults to the environment)
+    if delays is None:
+        delays = os.environ.get(DELAY_VARIABLE)
+    if not delays:
+        return 0.0
+    if isinstance(delays, str):
+        try:
+            return float(delays)
+        except ValueError:
+            delays = json.loads(delays)
+    if isinstance(delays, dict):
+        return float(delays.get(command, delays.get('*', 0.0)))
+    return float(delays)
+
+
+def _arg(args, flag, default=None):
+    # Value following flag in args
+    if flag in args and args.index(flag) + 1 < len(args):
+        return args[args.index(flag) + 1]
+    return default
+
+
+def _base(filename):
+    # File name without folder and .nii/.nii.gz extension, as nipype split_filename
+    name = os.path.basename(filename)
+    for ext in ['.nii.gz', '.nii', '.gz']:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return os.path.splitext(name)[0]
+
+
+def _load(filename):
+    import nibabel as nib
+    import numpy as np
+
+    obj = nib.load(filename)
+    return np.asanyarray(obj.dataobj).astype(np.float32), obj.affine
+
+
+def _save(data, affine, filename, vector=False):
+    import nibabel as nib
+
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    obj = nib.Nifti1Image(data, affine)
+    if vector:
+        obj.header.set_intent('vector')
+    nib.save(obj, filename)
+    return filename
+
+
+def _volume(data):
+    # Mean over time of 4D images
+    return data.mean(axis=3) if data.ndim > 3 else data
+
+
+def _zooms(affine):
+    import numpy as np
+
+    return np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+
+
+def _on_grid(data, shape):
+    # Centred crop/zero pad of the first three dimensions of data to shape (stands in for resampling)
+    import numpy as np
+
+    out = np.zeros(tuple(shape[:3]) + data.shape[3:], dtype=data.dtype)
+    src, dst = [], []
+    for n_in, n_out in zip(data.shape[:3], shape[:3]):
+        offset = (n_in - n_out) // 2
+        if offset >= 0:
+            src.append(slice(offset, offset + n_out))
+            dst.append(slice(0, n_out))
+        else:
+            src.append(slice(0, n_in))
+            dst.append(slice(-offset, -offset + n_in))
+    out[tuple(dst)] = data[tuple(src)]
+    return out
+
+
+def _cord(data):
+    # The phantoms make the cord the brightest structure
+    import numpy as np
+
+    volume = _volume(data)
+    peak = volume.max()
+    return (volume > 0.75 * peak).astype(np.float32) if peak > 0 else np.zeros_like(volume)
+
+
+def _centre(mask):
+    # Centre of mass of mask in each axial slice (None for empty slices)
+    import numpy as np
+
+    x, y = np.meshgrid(np.arange(mask.shape[0]), np.arange(mask.shape[1]), indexing='ij')
+    centres = []
+    for z in range(mask.shape[2]):
+        total = mask[..., z].sum()
+        centres.append(None if total == 0 else (int(round((x * mask[..., z]).sum() / total)),
+                                                 int(round((y * mask[..., z]).sum() / total))))
+    return centres
+
+
+def _centerline(mask):
+    import numpy as np
+
+    centerline = np.zeros(mask.shape[:3], dtype=np.float32)
+    for z, centre in enumerate(_centre(mask)):
+        if centre is not None:
+            centerline[centre[0], centre[1], z] = 1
+    return centerline
+
+
+def _grey_white(mask, gm_fraction=0.4):
+    # Grey matter as a core of gm_fraction of the cord area around the centre of each slice, white matter as the
+    # rest of the cord, both with probability 1
+    import numpy as np
+
+    x, y = np.meshgrid(np.arange(mask.shape[0]), np.arange(mask.shape[1]), indexing='ij')
+    gm = np.zeros(mask.shape[:3], dtype=np.float32)
+    for z, centre in enumerate(_centre(mask)):
+        if centre is not None:
+            radius = np.sqrt(gm_fraction * mask[..., z].sum() / np.pi)
+            gm[..., z] = (np.hypot(x - centre[0], y - centre[1]) <= radius) & (mask[..., z] > 0)
+    return gm, (mask > 0) - gm
+
+
+def _levels(mask, num_levels=7):
+    # Vertebral levels numbered from the top (last) slice down
+    import numpy as np
+
+    num_slices = mask.shape[2]
+    levels = 1 + (num_slices - 1 - np.arange(num_slices)) * num_levels // num_slices
+    return (mask > 0.5) * levels[np.newaxis, np.newaxis, :].astype(np.float32)
+
+
+def _zero_field(shape, affine, filename):
+    import numpy as np
+
+    return _save(np.zeros(tuple(shape[:3]) + (1, 3), dtype=np.float32), affine, filename, vector=True)
+
+
+def _resample(input_image, reference_image, output_image):
+    data, _ = _load(input_image)
+    reference, affine = _load(reference_image)
+    return _save(_on_grid(data, reference.shape), affine, output_image)
+
+
+def _write_csv(filename, fieldnames, rows):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def _slice_rows(image_file, mask, values, per_slice, levels=None):
+    # SCT style rows of the mask weighted mean/std of values, per slice or over the whole mask
+    import numpy as np
+
+    slices = [[z] for z in range(mask.shape[2])] if per_slice else [list(range(mask.shape[2]))]
+    rows = []
+    for zs in slices:
+        weights = mask[..., zs]
+        total = float(weights.sum())
+        mean = float((values[..., zs] * weights).sum() / total) if total > 0 else float('nan')
+        std = float(np.sqrt((((values[..., zs] - mean) ** 2) * weights).sum() / total)) if total > 0 \
+            else float('nan')
+        level = ''
+        if levels is not None and len(zs) == 1:
+            level_values = levels[..., zs[0]][levels[..., zs[0]] > 0]
+            level = int(np.median(level_values)) if level_values.size else ''
+        rows.append({'Timestamp': time.strftime('%Y-%m-%d %H:%M:%S'), 'SCT Version': SCT_VERSION,
+                     'Filename': os.path.abspath(image_file),
+                     'Slice (I->S)': str(zs[0]) if len(zs) == 1 else '%d:%d' % (zs[0], zs[-1]),
+                     'VertLevel': level, 'size': total, 'mean': mean, 'std': std})
+    return rows
+
+
+def deepseg_sc(args):
+    data, affine = _load(_arg(args, '-i'))
+    folder = _arg(args, '-ofolder', '.')
+    _save(_cord(data), affine, os.path.join(folder, _base(_arg(args, '-i')) + '_seg.nii.gz'))
+
+
+def propseg(args):
+    data, affine = _load(_arg(args, '-i'))
+    folder = _arg(args, '-ofolder', '.')
+    cord = _cord(data)
+    _save(cord, affine, os.path.join(folder, _base(_arg(args, '-i')) + '_seg.nii.gz'))
+    _save(_centerline(cord), affine, os.path.join(folder, _base(_arg(args, '-i')) + '_centerline.nii.gz'))
+
+
+def get_centerline(args):
+    data, affine = _load(_arg(args, '-i'))
+    _save(_centerline(_cord(data)), affine, _base(_arg(args, '-i')) + '_centerline.nii.gz')
+
+
+def label_vertebrae(args):
+    seg, affine = _load(_arg(args, '-s'))
+    folder = _arg(args, '-ofolder', '.')
+    _save(_levels(_volume(seg)), affine, os.path.join(folder, _base(_arg(args, '-s')) + '_labeled.nii.gz'))
+
+
+def create_mask(args):
+    import numpy as np
+
+    data, affine = _load(_arg(args, '-i'))
+    centerline, _ = _load(_arg(args, '-p').split(',', 1)[1])
+    radius_mm = float(_arg(args, '-size', '41mm').rstrip('m')) / 2
+    zooms = _zooms(affine)
+    x, y = np.meshgrid(np.arange(data.shape[0]) * zooms[0], np.arange(data.shape[1]) * zooms[1], indexing='ij')
+    mask = np.zeros(data.shape[:3], dtype=np.float32)
+    for z, centre in enumerate(_centre(_volume(centerline))):
+        if centre is not None:
+            mask[..., z] = (x - centre[0] * zooms[0]) ** 2 + (y - centre[1] * zooms[1]) ** 2 <= radius_mm ** 2
+    _save(mask, affine, _arg(args, '-o', 'mask_' + _base(_arg(args, '-i')) + '.nii.gz'))
+
+
+def register_to_template(args):
+    data, affine = _load(_arg(args, '-i'))
+    volume = _volume(data)
+    _save(volume, affine, 'anat2template.nii.gz')
+    _save(volume, affine, 'template2anat.nii.gz')
+    _zero_field(volume.shape, affine, 'warp_anat2template.nii.gz')
+    _zero_field(volume.shape, affine, 'warp_template2anat.nii.gz')
+
+
+def warp_template(args):
+    destination, affine = _load(_arg(args, '-d'))
+    folder = os.path.join(_arg(args, '-ofolder', '.'), 'label', 'template')
+    cord = _cord(destination)
+    _save(cord, affine, os.path.join(folder, 'PAM50_cord.nii.gz'))
+    _save(_levels(cord), affine, os.path.join(folder, 'PAM50_levels.nii.gz'))
+    gm, wm = _grey_white(cord)
+    _save(gm, affine, os.path.join(folder, 'PAM50_gm.nii.gz'))
+    _save(wm, affine, os.path.join(folder, 'PAM50_wm.nii.gz'))
+
+
+def register_multimodal(args):
+    input_image, destination_image = _arg(args, '-i'), _arg(args, '-d')
+    input_base, destination_base = _base(input_image), _base(destination_image)
+    if input_base != destination_base:
+        warped_input, warped_destination = input_base + '_reg.nii.gz', destination_base + '_reg.nii.gz'
+    else:
+        warped_input, warped_destination = input_base + '_src_reg.nii.gz', destination_base + '_dest_reg.nii.gz'
+    _resample(input_image, destination_image, warped_input)
+    _resample(destination_image, input_image, warped_destination)
+    destination, destination_affine = _load(destination_image)
+    source, source_affine = _load(input_image)
+    _zero_field(destination.shape, destination_affine, 'warp_' + input_base + '2' + destination_base + '.nii.gz')
+    _zero_field(source.shape, source_affine, 'warp_' + destination_base + '2' + input_base + '.nii.gz')
+
+
+def apply_transfo(args):
+    _resample(_arg(args, '-i'), _arg(args, '-d'), _base(_arg(args, '-i')) + '_reg.nii.gz')
+
+
+def straighten_spinalcord(args):
+    data, affine = _load(_arg(args, '-i'))
+    _save(data, affine, _base(_arg(args, '-i')) + '_straight.nii.gz')
+    _zero_field(data.shape, affine, 'warp_curve2straight.nii.gz')
+    _zero_field(data.shape, affine, 'warp_straight2curve.nii.gz')
+
+
+def compute_mtr(args):
+    import numpy as np
+
+    mt_on, affine = _load(_arg(args, '-mt1'))
+    mt_off, _ = _load(_arg(args, '-mt0'))
+    mt_on = _on_grid(mt_on, mt_off.shape)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mtr = np.where(mt_off > 0, 100 * (mt_off - mt_on) / mt_off, 0)
+    _save(mtr.astype(np.float32), affine, 'mtr.nii.gz')
+
+
+def maths(args):
+    data, affine = _load(_arg(args, '-i'))
+    _save(_volume(data), affine, _arg(args, '-o', _base(_arg(args, '-i')) + '_mean.nii.gz'))
+
+
+def label_utils(args):
+    import numpy as np
+
+    seg, affine = _load(_arg(args, '-i'))
+    seg = _volume(seg)
+    labels = np.zeros(seg.shape, dtype=np.float32)
+    centres = [(z, c) for z, c in enumerate(_centre(seg)) if c is not None]
+    if centres and _arg(args, '-create-seg-mid') is not None:
+        z, centre = centres[len(centres) // 2]
+        labels[centre[0], centre[1], z] = float(_arg(args, '-create-seg-mid'))
+    _save(labels, affine, _arg(args, '-o', 'labels.nii.gz'))
+
+
+def process_segmentation(args):
+    seg, affine = _load(_arg(args, '-i'))
+    seg = _volume(seg)
+    zooms = _zooms(affine)
+    levels = _volume(_load(_arg(args, '-vertfile'))[0]) if _arg(args, '-vertfile') else None
+    per_slice = _arg(args, '-perslice', '0') == '1'
+    rows = []
+    for row in _slice_rows(_arg(args, '-i'), seg, seg, per_slice, levels):
+        # Cross-sectional area of the slices of the row
+        num_slices = 1 if per_slice else seg.shape[2]
+        rows.append({'Timestamp': row['Timestamp'], 'SCT Version': row['SCT Version'], 'Filename': row['Filename'],
+                     'Slice (I->S)': row['Slice (I->S)'], 'VertLevel': row['VertLevel'],
+                     'MEAN(area)': row['size'] * zooms[0] * zooms[1] / num_slices, 'STD(area)': 0.0})
+    _write_csv(_arg(args, '-o', 'csa.csv'), ['Timestamp', 'SCT Version', 'Filename', 'Slice (I->S)', 'VertLevel',
+                                             'MEAN(area)', 'STD(area)'], rows)
+
+
+def extract_metric(args):
+    values, _ = _load(_arg(args, '-i'))
+    values = _volume(values)
+    mask = _volume(_load(_arg(args, '-f'))[0]) if _arg(args, '-f') else (values != 0).astype(values.dtype)
+    levels = _volume(_load(_arg(args, '-vertfile'))[0]) if _arg(args, '-vertfile') else None
+    label = _base(_arg(args, '-f')) if _arg(args, '-f') else 'image'
+    rows = [{'Timestamp': row['Timestamp'], 'SCT Version': row['SCT Version'], 'Filename': row['Filename'],
+             'Slice (I->S)': row['Slice (I->S)'], 'VertLevel': row['VertLevel'], 'Label': label,
+             'Size [vox]': row['size'], 'WA()': row['mean'], 'STD()': row['std']}
+            for row in _slice_rows(_arg(args, '-i'), mask, values, _arg(args, '-perslice', '0') == '1', levels)]
+    _write_csv(_arg(args, '-o', 'extract_metric.csv'), ['Timestamp', 'SCT Version', 'Filename', 'Slice (I->S)',
+                                                        'VertLevel', 'Label', 'Size [vox]', 'WA()', 'STD()'], rows)
+
+
+def dmri_moco(args):
+    data, affine = _load(_arg(args, '-i'))
+    folder = _arg(args, '-ofolder', '.')
+    _save(data, affine, os.path.join(folder, _base(_arg(args, '-i')) + '_moco.nii.gz'))
+    _save(_volume(data), affine, os.path.join(folder, _base(_arg(args, '-i')) + '_moco_dwi_mean.nii.gz'))
+
+
+def dmri_compute_dti(args):
+    data, affine = _load(_arg(args, '-i'))
+    cord = _cord(data)
+    prefix = _arg(args, '-o', 'dti_')
+    # Anisotropic cord in isotropic tissue
+    _save(0.2 + 0.5 * cord, affine, prefix + 'FA.nii.gz')
+    _save(1e-3 * (1 - 0.2 * cord), affine, prefix + 'MD.nii.gz')
+    _save(1e-3 * (1 + 0.7 * cord), affine, prefix + 'AD.nii.gz')
+    _save(1e-3 * (1 - 0.6 * cord), affine, prefix + 'RD.nii.gz')
+
+
+def _write_composite(filename):
+    # Identity affine in the ITK HDF5 transform format if h5py is available, an empty placeholder otherwise
+    try:
+        import h5py
+        import numpy as np
+    except ImportError:
+        open(filename, 'wb').close()
+        return
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset('TransformGroup/0/TransformType', data=[np.bytes_('CompositeTransform_double_3_3')])
+        f.create_dataset('TransformGroup/1/TransformType', data=[np.bytes_('AffineTransform_double_3_3')])
+        f.create_dataset('TransformGroup/1/TransformParameters', data=np.r_[np.eye(3).ravel(), np.zeros(3)])
+        f.create_dataset('TransformGroup/1/TransformFixedParameters', data=np.zeros(3))
+
+
+def ants_registration(args):
+    line = ' '.join(args)
+    output = re.search(r'--output \[\s*([^,\]\s]+)\s*(?:,\s*([^,\]\s]+))?', line)
+    metric = re.search(r'--metric \w+\[\s*([^,\s]+)\s*,\s*([^,\s]+)\s*,', line)
+    prefix = output.group(1) if output else line.split('--output ')[1].split()[0]
+    if metric is not None and output is not None and output.group(2):
+        _resample(metric.group(2), metric.group(1), output.group(2))
+    if re.search(r'--write-composite-transform 1', line):
+        _write_composite(prefix + 'Composite.h5')
+        _write_composite(prefix + 'InverseComposite.h5')
+
+
+def ants_apply_transforms(args):
+    output = _arg(args, '--output', _arg(args, '-o'))
+    # Outputs written with a composite warp are given as [file,1]
+    output = output.strip('[]').split(',')[0]
+    _resample(_arg(args, '--input', _arg(args, '-i')), _arg(args, '--reference-image', _arg(args, '-r')), output)
+
+
+def image_math(args):
+    import numpy as np
+
+    # ImageMath dimension output operation images...
+    output, images = args[1], args[3:]
+    data, affine = _load(images[0])
+    if args[2] == 'MajorityVoting':
+        stack = np.stack([_on_grid(_volume(_load(f)[0]), data.shape) for f in images])
+        data = np.rint(np.median(stack, axis=0))
+    _save(data, affine, output)
+
+
+def fslmerge(args):
+    import numpy as np
+
+    # fslmerge -t output inputs...
+    output, inputs = args[1], args[2:]
+    first, affine = _load(inputs[0])
+    volumes = [_on_grid(_volume(_load(f)[0]), first.shape) for f in inputs]
+    if not os.path.splitext(output)[1]:
+        output += '.nii.gz'
+    _save(np.stack(volumes, axis=3), affine, output)
+
+
+STANDINS = {'sct_deepseg_sc': deepseg_sc, 'sct_propseg': propseg, 'sct_get_centerline': get_centerline,
+            'sct_label_vertebrae': label_vertebrae, 'sct_create_mask': create_mask,
+            'sct_register_to_template': register_to_template, 'sct_warp_template': warp_template,
+            'sct_register_multimodal': register_multimodal, 'sct_apply_transfo': apply_transfo,
+            'sct_straighten_spinalcord': straighten_spinalcord, 'sct_compute_mtr': compute_mtr,
+            'sct_maths': maths, 'sct_label_utils': label_utils, 'sct_process_segmentation': process_segmentation,
+            'sct_extract_metric': extract_metric, 'sct_dmri_moco': dmri_moco,
+            'sct_dmri_compute_dti': dmri_compute_dti, 'antsRegistration': ants_registration,
+            'antsApplyTransforms': ants_apply_transforms, 'ImageMath': image_math, 'fslmerge': fslmerge}
+
+
+def main(argv=None):
+    argv = sys.argv if argv is None else argv
+    command = os.path.basename(argv[0])
+    args = argv[1:]
+    if command not in STANDINS:
+        sys.stderr.write('%s has no stand-in\n' % command)
+        return 1
+    if '--version' in args or '-version' in args:
+        # nipype reads the ANTs version from the first line
+        print('ANTs Version: %s' % ANTS_VERSION if command.startswith(('ants', 'Image')) else SCT_VERSION)
+        return 0
+
+    start = time.time()
+    STANDINS[command](args)
+    # The work of the stand-in counts towards the delay
+    remaining = standin_delay(command) - (time.time() - start)
+    if remaining > 0:
+        time.sleep(remaining)
+    return 0
+
+
+def install_standins(bin_dir, commands=None):
+    # Writes an executable for each of commands (all stand-ins by default) into bin_dir, returns bin_dir
+    package_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.makedirs(bin_dir, exist_ok=True)
+    for command in commands if commands is not None else sorted(STANDINS):
+        if command not in STANDINS:
+            raise ValueError('%s has no stand-in' % command)
+        filename = os.path.join(bin_dir, command)
+        with open(filename, 'w') as f:
+            f.write('#!%s\nimport sys\nsys.path.insert(0, %r)\n'
+                    'from sct_pipeline.benchmark.standins import main\nsys.exit(main())\n'
+                    % (sys.executable, package_root))
+        os.chmod(filename, 0o755)
+    return os.path.abspath(bin_dir)
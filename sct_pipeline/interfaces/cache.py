@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from nipype.interfaces.base import CommandLineInputSpec, File, traits, isdefined, Directory
+
+'''
+Content addressed cache for the expensive SCT commands (sct_deepseg_sc, sct_label_vertebrae,
+sct_register_to_template, sct_warp_template). Results are keyed by the digest of the input files,
+the interface parameters and the tool version, so they can be shared between workflows that use
+different base directories. Cached files are stored per output field and hard-linked (or reflinked/copied
+across filesystems) to the paths the interface expects, so outputs named after their inputs are found when the
+same content comes from a file with another name. Nothing is cached if the SCT version can not be determined.
+'''
+
+_file_digests = {}
+
+
+def file_digest(filename, block_size=1 << 20):
+    # Digests are memoized on (path, size, mtime) so a file is only read once per process
+    stat = os.stat(filename)
+    memo_key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_digests:
+        sha = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
+        _file_digests[memo_key] = sha.hexdigest()
+    return _file_digests[memo_key]
+
+
+def sct_directory():
+    # SCT install folder from SCT_DIR or the location of the SCT commands (None if SCT is not found)
+    sct_dir = os.environ.get('SCT_DIR')
+    if sct_dir is None:
+        sct_exe = shutil.which('sct_deepseg_sc')
+        if sct_exe is not None:
+            sct_dir = os.path.dirname(os.path.dirname(os.path.realpath(sct_exe)))
+    return sct_dir
+
+
+def sct_version():
+    sct_dir = sct_directory()
+    if sct_dir is not None:
+        for version_file in [os.path.join(sct_dir, 'spinalcordtoolbox', 'version.txt'),
+                             os.path.join(sct_dir, 'version.txt')]:
+            if os.path.isfile(version_file):
+                with open(version_file) as f:
+                    return f.read().strip()
+    return 'unknown'
+
+
+def clone_file(src, dst):
+    # Hard link if possible, then try a reflink (copy-on-write clone), then fall back to a copy
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        import fcntl
+        FICLONE = 0x40049409
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+        return
+    except (OSError, ImportError):
+        if os.path.exists(dst):
+            os.remove(dst)
+    shutil.copy2(src, dst)
+
+
+class ResultCache(object):
+    def __init__(self, cache_dir, max_size_gb=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size_gb = max_size_gb
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fetch(self, key, outputs):
+        # outputs maps each output field to the list of files the interface expects. The cached files are linked
+        # to those paths, which can differ from the cached names (outputs named after their inputs).
+        entry_dir = self._entry_dir(key)
+        manifest_file = os.path.join(entry_dir, 'manifest.json')
+        try:
+            with open(manifest_file) as f:
+                cached = json.load(f)['outputs']
+            if sorted(cached) != sorted(outputs) or \
+                    any(len(cached[field]) != len(files) for field, files in outputs.items()):
+                return False
+            for field, files in outputs.items():
+                for rel_path, dst in zip(cached[field], files):
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    if os.path.lexists(dst):
+                        os.remove(dst)
+                    clone_file(os.path.join(entry_dir, 'files', rel_path), dst)
+        except (OSError, ValueError, KeyError):
+            # Missing or partially evicted entry (or written by an older version)
+            return False
+        # The manifest mtime is used as the last access time for LRU eviction
+        os.utime(manifest_file, None)
+        return True
+
+    def store(self, key, outputs):
+        # outputs maps each output field to the list of its files
+        entry_dir = self._entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+        # Build the entry in a temporary folder and rename it, so concurrent runs never see partial entries
+        tmp_dir = os.path.join(self.cache_dir, 'tmp', '%s.%d' % (key, os.getpid()))
+        cached = {}
+        for field, files in outputs.items():
+            cached[field] = []
+            for i, src in enumerate(files):
+                rel_path = os.path.join(field, str(i), os.path.basename(src))
+                dst = os.path.join(tmp_dir, 'files', rel_path)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                clone_file(src, dst)
+                cached[field].append(rel_path)
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+            json.dump({'outputs': cached, 'created': time.time()}, f)
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        # Returns (last access time, size in bytes, entry dir) for every complete entry
+        entries = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if prefix == 'tmp' or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, key)
+                try:
+                    last_access = os.path.getmtime(os.path.join(entry_dir, 'manifest.json'))
+                except OSError:
+                    continue
+                size = 0
+                for root, _, files in os.walk(entry_dir):
+                    size += sum(os.lstat(os.path.join(root, f)).st_size for f in files)
+                entries.append((last_access, size, entry_dir))
+        return entries
+
+    def evict(self, max_size_gb=None):
+        max_size_gb = max_size_gb if max_size_gb is not None else self.max_size_gb
+        if max_size_gb is None:
+            return
+        entries = sorted(self.entries())
+        total_size = sum(e[1] for e in entries)
+        max_size = max_size_gb * 1024 ** 3
+        for _, size, entry_dir in entries:
+            if total_size <= max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+
+
+def use_result_cache(nodes, cache_dir, cache_size_gb=None):
+    # Points the cached interfaces of the given nodes at a shared cache directory
+    for node in nodes:
+        node.inputs.cache_dir = os.path.abspath(cache_dir)
+        if cache_size_gb is not None:
+            node.inputs.cache_size_gb = cache_size_gb
+
+
+class CachedCommandInputSpec(CommandLineInputSpec):
+    cache_dir = Directory(desc='Shared result cache directory', nohash=True)
+    cache_size_gb = traits.Float(desc='Evict least recently used results above this size', nohash=True)
+
+
+class CachedCommandMixin(object):
+    # Mix into a CommandLine interface (before CommandLine) to look up its outputs in a ResultCache
+    # when cache_dir is set. Outputs must be written inside the node directory to be cached.
+
+    def _cache_key(self):
+        sha = hashlib.sha256()
+        sha.update(('%s:%s:%s\n' % (self.__class__.__name__, self.cmd, sct_version())).encode())
+        for name, value in sorted(self.inputs.get().items()):
+            spec = self.inputs.trait(name)
+            if not isdefined(value) or spec.nohash or name in ['environ', 'args']:
+                continue
+            if spec.is_trait_type(File) and os.path.isfile(value):
+                value = file_digest(value)
+            sha.update(('%s=%r\n' % (name, value)).encode())
+        return sha.hexdigest()
+
+    def _output_files(self, cwd=None):
+        # Files of each output field. With cwd, None if an existing output is outside of it (not cacheable).
+        outputs = {}
+        for field, value in self._list_outputs().items():
+            files = [f for f in (value if isinstance(value, list) else [value])
+                     if isdefined(f) and isinstance(f, str)]
+            if cwd is not None:
+                files = [f for f in files if os.path.isfile(f)]
+                if any(os.path.relpath(f, cwd).startswith(os.pardir) for f in files):
+                    return None
+            if files:
+                outputs[field] = files
+        return outputs
+
+    def _run_interface(self, runtime, correct_return_codes=(0,)):
+        # Results of an unknown SCT version could outlive an upgrade, so they are not cached
+        if not isdefined(self.inputs.cache_dir) or sct_version() == 'unknown':
+            return super(CachedCommandMixin, self)._run_interface(runtime, correct_return_codes)
+
+        max_size_gb = self.inputs.cache_size_gb if isdefined(self.inputs.cache_size_gb) else None
+        cache = ResultCache(self.inputs.cache_dir, max_size_gb)
+        key = self._cache_key()
+        if cache.fetch(key, self._output_files()):
+            runtime.returncode = 0
+            runtime.stdout = 'Outputs reused from cache entry %s' % key
+            runtime.stderr = ''
+            return runtime
+
+        runtime = super(CachedCommandMixin, self)._run_interface(runtime, correct_return_codes)
+        if runtime.returncode in correct_return_codes:
+            outputs = self._output_files(runtime.cwd)
+            if outputs:
+                cache.store(key, outputs)
+        return runtime
@@ -1,7 +1,10 @@
 import os
-from nipype.interfaces.base import CommandLine, CommandLineInputSpec, TraitedSpec, File, traits, isdefined, Directory
+from nipype.interfaces.base import BaseInterface, CommandLine, CommandLineInputSpec, TraitedSpec, File, traits, isdefined, Directory
 from nipype.utils.filemanip import split_filename
 
+from sct_pipeline.interfaces.image import ImageOutputInputSpec, image_info, image_data, image_filename, iter_chunks, \
+    save_image
+
 class MotionCorrectionInputSpec(CommandLineInputSpec):
     dwi_image = File(exists=True, desc='Input spine image', argstr='-i %s', mandatory=True)
     bvec = File(exists=True, desc='Input spine image', argstr='-bvec %s', mandatory=True)
@@ -25,8 +28,8 @@ class MotionCorrection(CommandLine):
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outfile = split_filename(self.inputs.spine_segmentation)[1] + '_moco.nii.gz'
-        meanfile = split_filename(self.inputs.spine_segmentation)[1] + '_moco_dwi_mean.nii.gz'
+        outfile = split_filename(self.inputs.dwi_image)[1] + '_moco.nii.gz'
+        meanfile = split_filename(self.inputs.dwi_image)[1] + '_moco_dwi_mean.nii.gz'
         if isdefined(self.inputs.output_directory):
             outputs['moco_dwi'] = os.path.abspath(os.path.join(self.inputs.output_directory, outfile))
             outputs['mean_moco_dwi'] = os.path.abspath(os.path.join(self.inputs.output_directory, meanfile))
@@ -36,35 +39,149 @@ class MotionCorrection(CommandLine):
         return outputs
 
 class ComputeDTIInputSpec(CommandLineInputSpec):
-    dwi_image = File(exists=True, desc='Input spine image', argstr='-i %s', mandatory=True)
-    bvec = File(exists=True, desc='Input spine image', argstr='-bvec %s', mandatory=True)
-    bval = File(exists=True, desc='Input spine image', argstr='-bval %s', mandatory=True)
+    dwi_image = File(exists=True, desc='Input DWI image', argstr='-i %s', mandatory=True)
+    bvec = File(exists=True, desc='Input bvec file', argstr='-bvec %s', mandatory=True)
+    bval = File(exists=True, desc='Input bval file', argstr='-bval %s', mandatory=True)
 
-    mask = File(exists=True, desc='Input spine segmentation image', argstr='-m %s')
+    mask = File(exists=True, desc='Only fit the tensor inside this mask', argstr='-m %s')
     method = traits.Enum('standard','restore', desc='DTI estimation method to use', argstr='-method %s')
     eigenvalue = traits.Enum('0','1', desc='1 if eigenvalues and eigenvectors should be output', argstr='-evecs %s')
-    output_prefix = traits.Str(desc='Output filename', argstr='-o %s')
+    output_prefix = traits.Str('dti_', usedefault=True, desc='Output prefix', argstr='-o %s')
 
 
 class ComputeDTIOutputSpec(TraitedSpec):
-    fa = File(exists=True, desc='hard segmentation')
-    md = File(exists=True, desc='hard segmentation')
-    rd = File(exists=True, desc='hard segmentation')
+    fa = File(exists=True, desc='Fractional anisotropy')
+    md = File(exists=True, desc='Mean diffusivity')
+    ad = File(exists=True, desc='Axial diffusivity')
+    rd = File(exists=True, desc='Radial diffusivity')
 
 
 class ComputeDTI(CommandLine):
-    input_spec = MotionCorrectionInputSpec
-    output_spec = MotionCorrectionOutputSpec
+    input_spec = ComputeDTIInputSpec
+    output_spec = ComputeDTIOutputSpec
     _cmd = 'sct_dmri_compute_dti'
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outfile = split_filename(self.inputs.spine_segmentation)[1] + '_moco.nii.gz'
-        meanfile = split_filename(self.inputs.spine_segmentation)[1] + '_moco_dwi_mean.nii.gz'
-        if isdefined(self.inputs.output_directory):
-            outputs['moco_dwi'] = os.path.abspath(os.path.join(self.inputs.output_directory, outfile))
-            outputs['mean_moco_dwi'] = os.path.abspath(os.path.join(self.inputs.output_directory, meanfile))
+        for metric in ['fa', 'md', 'ad', 'rd']:
+            outputs[metric] = os.path.abspath(self.inputs.output_prefix + metric.upper() + '.nii.gz')
+        return outputs
+
+
+class ComputeDTINativeInputSpec(ImageOutputInputSpec):
+    dwi_image = File(exists=True, desc='Input (motion corrected) DWI image', mandatory=True)
+    bvec = File(exists=True, desc='Input bvec file', mandatory=True)
+    bval = File(exists=True, desc='Input bval file', mandatory=True)
+
+    mask = File(exists=True, desc='Cord mask, the tensor is only fitted inside the dilated mask (all voxels if not '
+                                  'set)')
+    mask_dilation = traits.Int(2, usedefault=True, desc='In-plane dilation of the mask in voxels')
+    min_signal = traits.Float(1.0, usedefault=True, desc='Signals below this value are clipped before the log')
+    chunk_slices = traits.Int(8, usedefault=True, nohash=True, desc='Number of slices read at a time')
+    output_prefix = traits.Str('dti_', usedefault=True, desc='Output prefix')
+
+
+class ComputeDTINative(BaseInterface):
+    # In-process alternative to ComputeDTI. The tensor is fitted with weighted least squares on the log signal
+    # (OLS fit, then weights from the squared OLS predicted signal, as in dipy) for the voxels of the dilated
+    # mask only, with all voxels of a chunk solved in one batched call. b values are in s/mm2, so the
+    # diffusivities are in mm2/s as in sct_dmri_compute_dti.
+    input_spec = ComputeDTINativeInputSpec
+    output_spec = ComputeDTIOutputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel as nib
+        import numpy as np
+        from scipy import ndimage
+
+        dwi_info = image_info(self.inputs.dwi_image)
+        shape = dwi_info.shape[:3]
+        design = self._design_matrix(self.inputs.bval, self.inputs.bvec)
+        if len(dwi_info.shape) != 4 or dwi_info.shape[3] != design.shape[0]:
+            raise ValueError('The DWI image needs one volume per bval/bvec entry')
+
+        if isdefined(self.inputs.mask):
+            if image_info(self.inputs.mask).shape[:3] != shape:
+                raise ValueError('mask does not match the shape of the DWI image')
+            mask = image_data(self.inputs.mask) > 0
+            if self.inputs.mask_dilation > 0:
+                structure = ndimage.generate_binary_structure(2, 1)[:, :, None]
+                mask = ndimage.binary_dilation(mask, structure, iterations=self.inputs.mask_dilation)
         else:
-            outputs['moco_dwi'] = os.path.abspath(outfile)
-            outputs['mean_moco_dwi'] = os.path.abspath(meanfile)
-        return outputs
\ No newline at end of file
+            mask = np.ones(shape, dtype=bool)
+
+        maps = {metric: np.zeros(shape, dtype=np.float32) for metric in ['fa', 'md', 'ad', 'rd']}
+        for start, chunk in iter_chunks(self.inputs.dwi_image, self.inputs.chunk_slices, np.float32):
+            chunk_mask = mask[:, :, start:start + chunk.shape[2]]
+            if not chunk_mask.any():
+                continue
+            evals = self._fit(design, chunk[chunk_mask], self.inputs.min_signal)
+            for metric, values in self._scalar_maps(evals).items():
+                maps[metric][:, :, start:start + chunk.shape[2]][chunk_mask] = values
+
+        dwi_obj = nib.load(self.inputs.dwi_image)
+        header = dwi_obj.header.copy()
+        header.set_data_dtype(np.float32)
+        header.set_slope_inter(1, 0)
+        for metric, values in maps.items():
+            save_image(nib.Nifti1Image(values, dwi_obj.affine, header), self._output_name(metric),
+                       self.inputs.compression, self.inputs.compression_level, self.inputs.compression_threads)
+
+        return runtime
+
+    @staticmethod
+    def _design_matrix(bval_file, bvec_file):
+        # Rows of -b [gx2, gy2, gz2, 2gxgy, 2gxgz, 2gygz] and 1 for the log of the b0 signal
+        import numpy as np
+
+        bvals = np.loadtxt(bval_file, dtype=np.float64).ravel()
+        bvecs = np.loadtxt(bvec_file, dtype=np.float64)
+        if bvecs.ndim != 2 or 3 not in bvecs.shape:
+            raise ValueError('bvecs must be 3 x N or N x 3')
+        if bvecs.shape[0] == 3 and bvecs.shape[1] != 3:
+            bvecs = bvecs.T
+        if bvecs.shape[0] != bvals.size:
+            raise ValueError('bvals and bvecs have a different number of entries')
+        norms = np.linalg.norm(bvecs, axis=1, keepdims=True)
+        bvecs = np.divide(bvecs, norms, out=np.zeros_like(bvecs), where=norms > 0)
+        gx, gy, gz = bvecs.T
+        return np.stack([-bvals * gx * gx, -bvals * gy * gy, -bvals * gz * gz, -2 * bvals * gx * gy,
+                         -2 * bvals * gx * gz, -2 * bvals * gy * gz, np.ones(bvals.size)], axis=1)
+
+    @staticmethod
+    def _fit(design, signal, min_signal):
+        # Eigenvalues (voxels x 3, descending) of the WLS tensors of signal (voxels x volumes)
+        import numpy as np
+
+        log_signal = np.log(np.maximum(signal.astype(np.float64), min_signal))
+        params = log_signal.dot(np.linalg.pinv(design).T)
+        weights = np.exp(2 * params.dot(design.T))
+        # Normal equations of every voxel, B^T W B params = B^T W log(S)
+        normal = np.einsum('nk,vn,nl->vkl', design, weights, design)
+        rhs = np.einsum('nk,vn->vk', design, weights * log_signal)
+        try:
+            params = np.linalg.solve(normal, rhs[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            params = np.einsum('vkl,vl->vk', np.linalg.pinv(normal), rhs)
+        tensors = params[:, [0, 3, 4, 3, 1, 5, 4, 5, 2]].reshape(-1, 3, 3)
+        return np.linalg.eigvalsh(tensors)[:, ::-1]
+
+    @staticmethod
+    def _scalar_maps(evals):
+        import numpy as np
+
+        md = evals.mean(axis=1)
+        norm = np.sqrt(np.sum(evals ** 2, axis=1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fa = np.sqrt(1.5 * np.sum((evals - md[:, None]) ** 2, axis=1)) / norm
+        fa = np.clip(np.nan_to_num(fa), 0, 1)
+        return {'fa': fa, 'md': md, 'ad': evals[:, 0], 'rd': evals[:, 1:].mean(axis=1)}
+
+    def _output_name(self, metric):
+        return self.inputs.output_prefix + metric.upper()
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        for metric in ['fa', 'md', 'ad', 'rd']:
+            outputs[metric] = os.path.abspath(image_filename(self._output_name(metric), self.inputs.compression))
+        return outputs
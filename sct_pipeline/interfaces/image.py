@@ -0,0 +1,166 @@
+import os
+import gzip
+import shutil
+import functools
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from nipype.interfaces.base import BaseInterfaceInputSpec, traits
+
+'''
+Image access helpers for the in-process interfaces. Headers are read once per file and voxel data is
+only loaded when an interface needs it: memory-mapped for uncompressed NIfTI, in the on-disk data type
+(uint8/int16 labels are not converted to float64) and, for reductions, a few slices at a time.
+
+Images written by the in-process interfaces use the intermediate format of the pipeline: gzip (zlib level
+compression_level, nibabel uses 1), parallel (blocks deflated in threads and written as a multi-member gzip
+file, which any gzip reader can read) or none (uncompressed .nii, also memory-mappable by the next node).
+'''
+
+ImageInfo = namedtuple('ImageInfo', ['shape', 'affine', 'dtype', 'zooms', 'scaled'])
+
+
+def image_info(filename):
+    # Shape, affine, on-disk dtype and voxel size from the header only. Memoized on (path, size, mtime)
+    stat = os.stat(filename)
+    return _read_image_info(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=1024)
+def _read_image_info(filename, size, mtime_ns):
+    # size and mtime_ns are only part of the memo key, so that a rewritten file is read again
+    img = load_image(filename)
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+    return ImageInfo(shape=img.shape, affine=img.affine, dtype=img.get_data_dtype(), zooms=img.header.get_zooms(),
+                     scaled=(slope != 1 or inter != 0))
+
+
+def load_image(filename):
+    # Read-only memory map for uncompressed files. Compressed files are kept open, so reading them in
+    # chunks continues the decompression instead of restarting from the beginning of the file.
+    import nibabel as nib
+
+    return nib.load(filename, mmap='r', keep_file_open=True)
+
+
+def image_data(filename, dtype=None):
+    # Voxel data in the on-disk data type (floating point only if the header has a scaling), without the
+    # float64 copy made by get_fdata. Uncompressed files are returned as a read-only memory map.
+    import numpy as np
+
+    img = load_image(filename)
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+    if dtype is not None and np.issubdtype(dtype, np.floating) and (slope != 1 or inter != 0):
+        # Scaled in the requested precision, nibabel (and get_fdata) would scale in float64 first
+        data = np.asanyarray(img.dataobj.get_unscaled()).astype(dtype)
+        data *= data.dtype.type(slope)
+        data += data.dtype.type(inter)
+        return data
+    data = np.asanyarray(img.dataobj)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    return data
+
+
+def iter_chunks(filename, chunk_slices=16, dtype=None):
+    # Yields (first slice, data) for blocks of chunk_slices slices along the third axis
+    import numpy as np
+
+    img = load_image(filename)
+    for start in range(0, img.shape[2], chunk_slices):
+        chunk = np.asanyarray(img.dataobj[:, :, start:start + chunk_slices])
+        if dtype is not None:
+            chunk = chunk.astype(dtype, copy=False)
+        yield start, chunk
+
+
+def image_max(filename, chunk_slices=16):
+    return max(chunk.max() for _, chunk in iter_chunks(filename, chunk_slices))
+
+
+def masked_mean(filename, mask_filename, threshold=0.0, chunk_slices=16):
+    # Mean of the voxels where mask > threshold (nan if the mask is empty)
+    import numpy as np
+
+    if image_info(filename).shape[:3] != image_info(mask_filename).shape[:3]:
+        raise ValueError('%s does not match the shape of %s' % (mask_filename, filename))
+    total = 0.0
+    count = 0
+    for (_, chunk), (_, mask) in zip(iter_chunks(filename, chunk_slices), iter_chunks(mask_filename, chunk_slices)):
+        selected = mask > threshold
+        total += chunk[selected].sum(dtype=np.float64)
+        count += np.count_nonzero(selected)
+    return total / count if count > 0 else float('nan')
+
+
+def image_filename(name, compression='gzip'):
+    # Replaces (or adds) the NIfTI extension of name to match the compression
+    for ext in ['.nii.gz', '.nii']:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    return name + ('.nii' if compression == 'none' else '.nii.gz')
+
+
+def write_parallel_gzip(data, filename, level=1, num_threads=0, block_size=1 << 22):
+    # Each block is an independent gzip member, zlib releases the GIL so the blocks compress in parallel
+    num_threads = num_threads if num_threads > 0 else os.cpu_count()
+    blocks = [memoryview(data)[i:i + block_size] for i in range(0, len(data), block_size)]
+    with ThreadPoolExecutor(max_workers=num_threads) as pool, open(filename, 'wb') as f:
+        for member in pool.map(lambda b: gzip.compress(b, compresslevel=level, mtime=0), blocks):
+            f.write(member)
+
+
+def save_image(img, name, compression='gzip', level=1, num_threads=0):
+    # Writes img with the given intermediate format and returns the filename
+    import nibabel as nib
+
+    filename = image_filename(name, compression)
+    if compression == 'none' or (compression == 'gzip' and level == nib.openers.Opener.default_compresslevel):
+        img.to_filename(filename)
+    elif compression == 'gzip':
+        with gzip.GzipFile(filename, 'wb', compresslevel=level, mtime=0) as f:
+            img.to_file_map({'image': nib.FileHolder(filename, fileobj=f)})
+    else:
+        write_parallel_gzip(img.to_bytes(), filename, level, num_threads)
+    return filename
+
+
+def compress_file(in_file, out_file, level=1, num_threads=0):
+    # Copies an image to out_file, compressing or decompressing it to match the extension of out_file
+    in_compressed = in_file.endswith('.gz')
+    out_compressed = out_file.endswith('.gz')
+    if in_compressed == out_compressed:
+        shutil.copyfile(in_file, out_file)
+    elif in_compressed:
+        with gzip.open(in_file, 'rb') as fin, open(out_file, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, 1 << 22)
+    else:
+        with open(in_file, 'rb') as fin:
+            write_parallel_gzip(fin.read(), out_file, level, num_threads)
+
+
+class ImageOutputInputSpec(BaseInterfaceInputSpec):
+    compression = traits.Enum('gzip', 'parallel', 'none', usedefault=True,
+                              desc='Output format: gzip, multi-threaded gzip or uncompressed .nii')
+    compression_level = traits.Range(1, 9, 1, usedefault=True, desc='zlib compression level')
+    compression_threads = traits.Int(0, usedefault=True, nohash=True,
+                                     desc='Threads used by parallel compression (0 for all cores)')
+
+
+def apply_intermediate_format(wf, compression='gzip', level=1, num_threads=0):
+    # Sets the output format of every in-process interface of the workflow that writes images. FSL outputs
+    # follow the same setting, the SCT commands always write .nii.gz.
+    fsl_output_type = 'NIFTI' if compression == 'none' else 'NIFTI_GZ'
+    for node in wf._get_all_nodes():
+        # trait_names() does not add the trait to the dynamic input specs of MapNodes, unlike hasattr
+        input_names = node.inputs.trait_names()
+        if 'compression' in input_names:
+            node.inputs.compression = compression
+            node.inputs.compression_level = level
+            node.inputs.compression_threads = num_threads
+            if compression == 'parallel':
+                node.n_procs = max(node.n_procs, num_threads if num_threads > 0 else os.cpu_count())
+        elif 'output_type' in input_names and node.interface.__class__.__module__.startswith(
+                'nipype.interfaces.fsl'):
+            node.inputs.output_type = fsl_output_type
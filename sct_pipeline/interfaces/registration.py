@@ -1,7 +1,12 @@
 import os
-from nipype.interfaces.base import CommandLine, CommandLineInputSpec, TraitedSpec, File, traits, isdefined, Directory
+from nipype.interfaces.base import BaseInterface, CommandLine, CommandLineInputSpec, TraitedSpec, File, traits, isdefined, Directory, \
+    InputMultiPath, OutputMultiPath
 from nipype.utils.filemanip import split_filename
 
+from sct_pipeline.interfaces.cache import CachedCommandInputSpec, CachedCommandMixin, sct_directory
+from sct_pipeline.interfaces.image import ImageOutputInputSpec, image_info, image_data, image_filename, save_image
+from sct_pipeline.interfaces.transforms import INTERPOLATIONS, resample_images
+
 '''
 sct_maths
 sct_propseg
@@ -19,7 +24,7 @@ sct_extract_metric
 sct_process_segmentation
 '''
 
-class RegisterToTemplateInputSpec(CommandLineInputSpec):
+class RegisterToTemplateInputSpec(CachedCommandInputSpec):
     input_image = File(exists=True, desc='Input spine image', argstr='-i %s', mandatory=True)
     spine_segmentation = File(exists=True, desc='Input spine segmentation', argstr='-s %s', mandatory=True)
     contrast = traits.Enum('t1', 't2', 't2s', desc='Input image contrast type', argstr='-c %s')
@@ -35,7 +40,7 @@ class RegisterToTemplateOutputSpec(TraitedSpec):
     warp_template2anat = File(exists=True, desc='Output CSV')
 
 
-class RegisterToTemplate(CommandLine):
+class RegisterToTemplate(CachedCommandMixin, CommandLine):
     input_spec = RegisterToTemplateInputSpec
     output_spec = RegisterToTemplateOutputSpec
     _cmd = 'sct_register_to_template'
@@ -51,7 +56,7 @@ class RegisterToTemplate(CommandLine):
         return outputs
 
 
-class WarpTemplateInputSpec(CommandLineInputSpec):
+class WarpTemplateInputSpec(CachedCommandInputSpec):
     destination_image = File(exists=True, desc='Input spine image', argstr='-d %s', mandatory=True)
     warping_field = File(exists=True, desc='Input spine segmentation', argstr='-w %s', mandatory=True)
     warp_white_matter = traits.Enum(0, 1, desc='Input image contrast type', argstr='-a %s')
@@ -66,7 +71,7 @@ class WarpTemplateOutputSpec(TraitedSpec):
     # What other outputs are needed?
 
 
-class WarpTemplate(CommandLine):
+class WarpTemplate(CachedCommandMixin, CommandLine):
     input_spec = WarpTemplateInputSpec
     output_spec = WarpTemplateOutputSpec
     _cmd = 'sct_warp_template'
@@ -81,6 +86,123 @@ class WarpTemplate(CommandLine):
 
         return outputs
 
+
+# Interpolation used for each template file, levels are labels so they are not interpolated
+TEMPLATE_INTERPOLATION = {'cord': 'linear', 'gm': 'linear', 'wm': 'linear', 'levels': 'nn'}
+
+
+class WarpTemplateNativeInputSpec(ImageOutputInputSpec):
+    destination_image = File(exists=True, desc='Image defining the output space', mandatory=True)
+    warping_field = File(exists=True, desc='Template to destination warping field (warp_template2anat)',
+                         mandatory=True)
+    template_labels = traits.List(traits.Enum('cord', 'levels', 'gm', 'wm'),
+                                  ['cord', 'levels', 'gm', 'wm'], usedefault=True,
+                                  desc='Template files to warp, the rest of the atlas is skipped')
+    template_dir = Directory(exists=True, desc='PAM50 folder (defaults to $SCT_DIR/data/PAM50)')
+    slab_size = traits.Int(8, usedefault=True, nohash=True, desc='Number of slices resampled at a time')
+
+
+class WarpTemplateNative(BaseInterface):
+    # In-process alternative to WarpTemplate that only warps the template files a workflow reads. The warping
+    # field is loaded once and the sampling positions/weights of every slab are shared by all the labels.
+    input_spec = WarpTemplateNativeInputSpec
+    output_spec = WarpTemplateOutputSpec
+
+    def _template_file(self, label):
+        if isdefined(self.inputs.template_dir):
+            template_dir = self.inputs.template_dir
+        else:
+            sct_dir = sct_directory()
+            if sct_dir is None:
+                raise RuntimeError('SCT_DIR is not set and SCT could not be found, set template_dir')
+            template_dir = os.path.join(sct_dir, 'data', 'PAM50')
+        return os.path.join(template_dir, 'template', 'PAM50_%s.nii.gz' % label)
+
+    def _run_interface(self, runtime):
+        import nibabel as nib
+
+        labels = list(self.inputs.template_labels)
+        outputs = resample_images([self._template_file(label) for label in labels],
+                                  [TEMPLATE_INTERPOLATION[label] for label in labels],
+                                  self.inputs.destination_image, [self.inputs.warping_field],
+                                  self.inputs.slab_size)
+
+        dest_obj = nib.load(self.inputs.destination_image)
+        os.makedirs(os.path.join('label', 'template'), exist_ok=True)
+        for label, data in zip(labels, outputs):
+            header = dest_obj.header.copy()
+            header.set_data_dtype(data.dtype)
+            header.set_slope_inter(1, 0)
+            save_image(nib.Nifti1Image(data, dest_obj.affine, header), self._output_name(label),
+                       self.inputs.compression, self.inputs.compression_level, self.inputs.compression_threads)
+
+        return runtime
+
+    def _output_name(self, label):
+        # Same layout as sct_warp_template, so both interfaces can be swapped in a workflow
+        return os.path.join('label', 'template', 'PAM50_%s' % label)
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        for label in self.inputs.template_labels:
+            if label in outputs:
+                outputs[label] = os.path.abspath(image_filename(self._output_name(label), self.inputs.compression))
+
+        return outputs
+
+
+class ApplyTransformsNativeInputSpec(ImageOutputInputSpec):
+    input_images = InputMultiPath(File(exists=True), desc='Images to resample', mandatory=True)
+    interpolations = traits.List(traits.Enum(*INTERPOLATIONS), mandatory=True,
+                                 desc='Interpolation of each input image (linear for soft segs, nn for labels)')
+    reference_image = File(exists=True, desc='Image defining the output space', mandatory=True)
+    transforms = InputMultiPath(File(exists=True), mandatory=True,
+                                desc='Warping fields, .mat or .h5 composite transforms, the last one is applied first '
+                                     '(same order as antsApplyTransforms)')
+    slab_size = traits.Int(8, usedefault=True, nohash=True, desc='Number of slices resampled at a time')
+
+
+class ApplyTransformsNativeOutputSpec(TraitedSpec):
+    output_images = OutputMultiPath(File(exists=True), desc='Resampled images, in the order of input_images')
+
+
+class ApplyTransformsNative(BaseInterface):
+    # In-process alternative to ApplyTransform/ants.ApplyTransforms for several images sharing the same
+    # transforms: the transforms are read and the reference points mapped once for all the images.
+    input_spec = ApplyTransformsNativeInputSpec
+    output_spec = ApplyTransformsNativeOutputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel as nib
+
+        outputs = resample_images(self.inputs.input_images, self.inputs.interpolations, self.inputs.reference_image,
+                                  self.inputs.transforms, self.inputs.slab_size)
+
+        ref_obj = nib.load(self.inputs.reference_image)
+        for name, data in zip(self._output_names(), outputs):
+            header = ref_obj.header.copy()
+            header.set_data_dtype(data.dtype)
+            header.set_slope_inter(1, 0)
+            save_image(nib.Nifti1Image(data, ref_obj.affine, header), name,
+                       self.inputs.compression, self.inputs.compression_level, self.inputs.compression_threads)
+
+        return runtime
+
+    def _output_names(self):
+        # <input>_reg as sct_apply_transfo, prefixed with the position of the image if two inputs have the same name
+        bases = [split_filename(f)[1] for f in self.inputs.input_images]
+        if len(set(bases)) == len(bases):
+            return [base + '_reg' for base in bases]
+        return ['%d_%s_reg' % (i, base) for i, base in enumerate(bases)]
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output_images'] = [os.path.abspath(image_filename(name, self.inputs.compression))
+                                    for name in self._output_names()]
+
+        return outputs
+
+
 class RegisterMultimodalInputSpec(CommandLineInputSpec):
     input_image = File(exists=True, desc='Input spine image', argstr='-i %s', mandatory=True)
     destination_image = File(exists=True, desc='Input spine image', argstr='-d %s', mandatory=True)
@@ -125,6 +247,188 @@ class RegisterMultimodal(CommandLine):
         return outputs
 
 
+def _correlate(a, b, shape):
+    # sum_x a(x) b(x + u) for every shift u of every slice (axes 0 and 1), zero padded to shape
+    import numpy as np
+
+    return np.fft.irfft2(np.conj(np.fft.rfft2(a, shape, axes=(0, 1))) * np.fft.rfft2(b, shape, axes=(0, 1)),
+                         shape, axes=(0, 1))
+
+
+def slice_shifts(fixed, moving, mask, max_shift, min_overlap=0.5):
+    # In-plane translation (voxels) of every slice such that moving(x + u) matches fixed(x) inside mask, from the
+    # masked normalized cross-correlation of Padfield (2012) computed with FFTs for all slices at once. Returns
+    # the shifts (slices x 2) and the correlation at the shift (nan for slices without mask).
+    import numpy as np
+
+    # The correlations only need the mask bounding box grown by max_shift
+    mask = np.asarray(mask) > 0
+    nonzero = np.flatnonzero(np.any(mask, axis=(1, 2))), np.flatnonzero(np.any(mask, axis=(0, 2)))
+    if nonzero[0].size == 0:
+        return np.full((fixed.shape[2], 2), np.nan), np.full(fixed.shape[2], np.nan)
+    box = tuple(slice(max(n[0] - m - 1, 0), n[-1] + m + 2) for n, m in zip(nonzero, max_shift))
+    fixed = fixed[box].astype(np.float64)
+    moving = moving[box].astype(np.float64)
+    mask = mask[box].astype(np.float64)
+    inside = np.ones(moving.shape[:2] + (1,))
+    shape = (2 * fixed.shape[0], 2 * fixed.shape[1])
+
+    overlap = _correlate(mask, inside, shape)
+    sum_f = _correlate(fixed * mask, inside, shape)
+    sum_g = _correlate(mask, moving, shape)
+    sum_ff = _correlate(fixed * fixed * mask, inside, shape)
+    sum_gg = _correlate(mask, moving * moving, shape)
+    sum_fg = _correlate(fixed * mask, moving, shape)
+
+    # Only the shifts within max_shift are evaluated
+    ux, uy = np.meshgrid(np.arange(-max_shift[0], max_shift[0] + 1), np.arange(-max_shift[1], max_shift[1] + 1),
+                         indexing='ij')
+    ix, iy = ux % shape[0], uy % shape[1]
+    overlap, sum_f, sum_g, sum_ff, sum_gg, sum_fg = [c[ix, iy] for c in [overlap, sum_f, sum_g, sum_ff, sum_gg,
+                                                                         sum_fg]]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        numerator = sum_fg - sum_f * sum_g / overlap
+        denominator = (sum_ff - sum_f * sum_f / overlap) * (sum_gg - sum_g * sum_g / overlap)
+        ncc = numerator / np.sqrt(denominator)
+    valid = (overlap >= min_overlap * np.max(overlap, axis=(0, 1))) & (denominator > 0)
+    ncc = np.where(valid, ncc, -np.inf)
+
+    num_slices = fixed.shape[2]
+    best = np.argmax(ncc.reshape(-1, num_slices), axis=0)
+    bx, by = np.unravel_index(best, ncc.shape[:2])
+    slices = np.arange(num_slices)
+    score = ncc[bx, by, slices]
+    shifts = np.stack([ux[bx, 0], uy[0, by]], axis=1).astype(np.float64)
+
+    # Sub-voxel refinement with a parabola through the maximum and its neighbours
+    for axis, (index, size) in enumerate([(bx, ncc.shape[0]), (by, ncc.shape[1])]):
+        lower = np.clip(index - 1, 0, size - 1)
+        upper = np.clip(index + 1, 0, size - 1)
+        if axis == 0:
+            c_lower, c_upper = ncc[lower, by, slices], ncc[upper, by, slices]
+        else:
+            c_lower, c_upper = ncc[bx, lower, slices], ncc[bx, upper, slices]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            curvature = c_lower - 2 * score + c_upper
+            refine = (lower != index) & (upper != index) & np.isfinite(c_lower) & np.isfinite(c_upper) & \
+                (curvature < 0)
+            offset = np.where(refine, 0.5 * (c_lower - c_upper) / curvature, 0)
+        shifts[:, axis] += offset
+
+    score = np.where(np.isfinite(score), score, np.nan)
+    shifts[~np.isfinite(score)] = np.nan
+    return shifts, score
+
+
+def regularize_shifts(shifts, degree):
+    # Polynomial fit of the shifts along z (as the poly parameter of slicereg), slices without a shift get the
+    # value of the fit at the nearest slice with one
+    import numpy as np
+
+    valid = np.flatnonzero(np.all(np.isfinite(shifts), axis=1))
+    if valid.size == 0:
+        return np.zeros(shifts.shape)
+    degree = min(degree, valid.size - 1)
+    z = np.clip(np.arange(shifts.shape[0]), valid[0], valid[-1])
+    return np.stack([np.polyval(np.polyfit(valid, shifts[valid, axis], degree), z) for axis in range(2)], axis=1)
+
+
+class RegisterSlicewiseNativeInputSpec(ImageOutputInputSpec):
+    input_image = File(exists=True, desc='Image to register (e.g. MT off)', mandatory=True)
+    destination_image = File(exists=True, desc='Destination image (e.g. MT on)', mandatory=True)
+    mask = File(exists=True, desc='Mask of the destination where the correlation is computed', mandatory=True)
+    max_shift = traits.Float(5.0, usedefault=True, desc='Largest in-plane shift searched (mm)')
+    poly = traits.Int(5, usedefault=True, desc='Degree of the polynomial regularizing the shifts along z')
+    interpolation = traits.Enum('spline', 'linear', 'nn', usedefault=True, desc='Interpolation of the output')
+
+
+class RegisterSlicewiseNative(BaseInterface):
+    # In-process alternative to RegisterMultimodal with param step=1,type=im,algo=slicereg,metric=CC: one in-plane
+    # translation per slice from the masked NCC, regularized along z, and a single resampling of the input.
+    # The input is first resampled on the destination grid if the grids differ, the warping fields are written
+    # on the destination grid.
+    input_spec = RegisterSlicewiseNativeInputSpec
+    output_spec = RegisterMultimodalOutputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel as nib
+        import numpy as np
+
+        dest_obj = nib.load(self.inputs.destination_image)
+        dest_info = image_info(self.inputs.destination_image)
+        input_info = image_info(self.inputs.input_image)
+        if len(dest_info.shape) != 3 or image_info(self.inputs.mask).shape[:3] != dest_info.shape:
+            raise ValueError('The destination image must be 3D and have the same shape as the mask')
+        destination = image_data(self.inputs.destination_image, np.float32)
+        if input_info.shape[:3] == dest_info.shape and np.allclose(input_info.affine, dest_info.affine, atol=1e-5):
+            moving = image_data(self.inputs.input_image, np.float32).reshape(dest_info.shape)
+        else:
+            moving = resample_images([self.inputs.input_image], ['linear'], self.inputs.destination_image, [])[0]
+
+        zooms = np.sqrt(np.sum(dest_info.affine[:3, :2] ** 2, axis=0))
+        max_shift = np.maximum(np.ceil(self.inputs.max_shift / zooms), 1).astype(int)
+        shifts, _ = slice_shifts(destination, moving, image_data(self.inputs.mask), max_shift)
+        shifts = regularize_shifts(shifts, self.inputs.poly)
+
+        names = self._output_names()
+        order = {'nn': 0, 'linear': 1, 'spline': 3}[self.inputs.interpolation]
+        for data, sign, name in [(moving, 1, names['warped_input_image']),
+                                 (destination, -1, names['warped_destination_image'])]:
+            self._save(self._shift(data, sign * shifts, order), dest_obj, name)
+
+        # ITK displacement fields (LPS, x, y, z, 1, 3) mapping the destination grid to the input and back
+        displacement = np.zeros(dest_info.shape + (1, 3), dtype=np.float32)
+        displacement[..., 0, :] = shifts.dot(dest_info.affine[:3, :2].T)[None, None] * np.array([-1, -1, 1])
+        for field, name in [(displacement, names['warpfield_input_to_destination']),
+                            (-displacement, names['warpfield_destination_to_input'])]:
+            self._save(field, dest_obj, name)
+
+        return runtime
+
+    @staticmethod
+    def _shift(data, shifts, order):
+        # data(x + shift of the slice), 0 outside of the image
+        import numpy as np
+        from scipy import ndimage
+
+        i, j, k = np.meshgrid(*[np.arange(s, dtype=np.float32) for s in data.shape], indexing='ij')
+        coords = np.stack([i + shifts[:, 0].astype(np.float32), j + shifts[:, 1].astype(np.float32), k])
+        return ndimage.map_coordinates(data, coords, order=order, mode='constant', cval=0.0).astype(np.float32)
+
+    def _save(self, data, ref_obj, name):
+        import nibabel as nib
+        import numpy as np
+
+        header = ref_obj.header.copy()
+        header.set_data_dtype(np.float32)
+        header.set_slope_inter(1, 0)
+        img = nib.Nifti1Image(data, ref_obj.affine, header)
+        if data.ndim == 5:
+            img.header.set_intent('vector')
+        save_image(img, name, self.inputs.compression, self.inputs.compression_level, self.inputs.compression_threads)
+
+    def _output_names(self):
+        # Same names as sct_register_multimodal
+        input_base = split_filename(self.inputs.input_image)[1]
+        dest_base = split_filename(self.inputs.destination_image)[1]
+        if input_base != dest_base:
+            names = {'warped_input_image': input_base + '_reg',
+                     'warped_destination_image': dest_base + '_reg'}
+        else:
+            names = {'warped_input_image': input_base + '_src_reg',
+                     'warped_destination_image': dest_base + '_dest_reg'}
+        names['warpfield_input_to_destination'] = 'warp_' + input_base + '2' + dest_base
+        names['warpfield_destination_to_input'] = 'warp_' + dest_base + '2' + input_base
+        return names
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        for output, name in self._output_names().items():
+            outputs[output] = os.path.abspath(image_filename(name, self.inputs.compression))
+
+        return outputs
+
+
 class GetCenterlineInputSpec(CommandLineInputSpec):
     input_image = File(exists=True, desc='Input spine image', argstr='-i %s', mandatory=True)
     contrast = traits.Enum('t1', 't2', 't2s', 'dwi', desc='Input image contrast type', argstr='-c %s')
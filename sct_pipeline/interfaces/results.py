@@ -0,0 +1,193 @@
+import os
+import csv
+import re
+import uuid
+from urllib.parse import quote
+
+from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, TraitedSpec, File, traits, isdefined, \
+    InputMultiPath
+
+'''
+Cohort results store. The metric CSVs of a subject (sct_extract_metric, sct_process_segmentation, the native
+metric interfaces) are converted to one long table with a row per patient, scan, acquisition run,
+slice/level, ROI and metric, and written as <store>/<patient_id>/<scan_id>.<workflow>.parquet (needs
+pyarrow). Each file is written to a temporary name and renamed, so runs of different subjects (or a rerun of
+the same subject) can write to the same store concurrently and readers never see a partial file.
+read_results only opens the files of the requested patients and only reads the requested columns.
+'''
+
+COLUMNS = [('patient_id', 'string'), ('scan_id', 'string'), ('workflow', 'string'), ('run', 'int32'),
+           ('source', 'string'), ('roi', 'string'), ('scope', 'string'), ('slice', 'int32'),
+           ('vertebral_level', 'int32'), ('metric', 'string'), ('value', 'float64'), ('std', 'float64'),
+           ('weight', 'float64')]
+
+# Columns of the SCT CSVs holding the value of a metric, e.g. MEAN(area) or WA()
+_SCT_VALUE = re.compile(r'^(MEAN|WA|BIN|ML|MAP|MEDIAN|MAX)\((.*)\)$')
+
+
+def _schema():
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError('pyarrow is needed to use the results store')
+
+    return pa.schema([(name, getattr(pa, dtype)()) for name, dtype in COLUMNS])
+
+
+def _number(value, convert=float):
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _read_rows(filename):
+    # The SCT CSVs use commas, ComputeAvgGMWMMTR spaces
+    with open(filename, newline='') as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            delimiter = csv.Sniffer().sniff(sample, delimiters=',\t; ').delimiter
+        except csv.Error:
+            delimiter = ','
+        return list(csv.DictReader(f, delimiter=delimiter))
+
+
+def _sct_scope(slices, level):
+    # Single slice, single level (slice range) or whole ROI rows of the SCT CSVs
+    slice_number = _number(slices, int)
+    level_number = _number(level, int)
+    if slice_number is not None:
+        return 'slice', slice_number, level_number
+    if level_number is not None:
+        return 'level', None, level_number
+    return 'all', None, None
+
+
+def read_metric_csv(filename, source):
+    # Long format rows (without the subject columns) of a metric CSV written by the pipelines
+    rows = []
+    for row in _read_rows(filename):
+        row = {k.strip(): (v.strip() if isinstance(v, str) else v) for k, v in row.items() if k is not None}
+        if 'roi' in row and 'mean' in row:
+            # ExtractMetricsNative
+            rows.append({'roi': row['roi'], 'scope': row['scope'], 'slice': _number(row['slice'], int),
+                         'vertebral_level': _number(row['vertebral_level'], int), 'metric': source,
+                         'value': _number(row['mean']), 'std': _number(row['std']),
+                         'weight': _number(row['weight_sum'])})
+        elif 'Slice (I->S)' in row:
+            # sct_extract_metric, sct_process_segmentation and ProcessSegNative
+            scope, slice_number, level = _sct_scope(row['Slice (I->S)'], row.get('VertLevel'))
+            roi = row.get('Label') or 'cord'
+            for column, value in row.items():
+                match = _SCT_VALUE.match(column)
+                if match is None or _number(value) is None:
+                    continue
+                rows.append({'roi': roi, 'scope': scope, 'slice': slice_number, 'vertebral_level': level,
+                             'metric': match.group(2) or source, 'value': _number(value),
+                             'std': _number(row.get('STD(%s)' % match.group(2))),
+                             'weight': _number(row.get('Size [vox]'))})
+        else:
+            # ROI_METRIC columns of a single row, e.g. ComputeAvgGMWMMTR
+            for column, value in row.items():
+                roi, _, metric = column.partition('_')
+                rows.append({'roi': roi.lower(), 'scope': 'all', 'slice': None, 'vertebral_level': None,
+                             'metric': metric or source, 'value': _number(value), 'std': None, 'weight': None})
+    return rows
+
+
+def subject_results_file(store_dir, patient_id, scan_id, workflow):
+    name = quote(scan_id, safe='') + '.' + workflow if scan_id else workflow
+    return os.path.join(store_dir, quote(patient_id, safe=''), name + '.parquet')
+
+
+def write_subject_results(store_dir, patient_id, scan_id, workflow, rows):
+    # Replaces the results of the subject for this workflow, rows are dicts with the columns of read_metric_csv
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if not patient_id:
+        raise ValueError('A patient_id is needed to store results')
+    schema = _schema()
+    subject = {'patient_id': patient_id, 'scan_id': scan_id or '', 'workflow': workflow}
+    columns = {}
+    for name, _ in COLUMNS:
+        columns[name] = [subject[name]] * len(rows) if name in subject else [row.get(name) for row in rows]
+    table = pa.Table.from_pydict(columns, schema=schema)
+
+    results_file = subject_results_file(store_dir, patient_id, scan_id, workflow)
+    os.makedirs(os.path.dirname(results_file), exist_ok=True)
+    tmp_file = '%s.tmp-%s' % (results_file, uuid.uuid4().hex)
+    try:
+        pq.write_table(table, tmp_file)
+        os.replace(tmp_file, results_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return results_file
+
+
+def read_results(store_dir, columns=None, patient_ids=None, scan_ids=None, workflows=None, sources=None,
+                 metrics=None):
+    # pyarrow Table of the store (use to_pandas() for a DataFrame). Only the files of patient_ids are opened
+    # and only columns are read, the other arguments select rows (workflows are the pipelines, mtr or dti).
+    import glob
+    import pyarrow.dataset as ds
+
+    schema = _schema()
+    patient_dirs = ['*'] if patient_ids is None else [glob.escape(quote(p, safe='')) for p in patient_ids]
+    files = [f for d in patient_dirs for f in glob.glob(os.path.join(glob.escape(store_dir), d, '*.parquet'))]
+    if not files:
+        return schema.empty_table() if columns is None else schema.empty_table().select(columns)
+
+    dataset = ds.dataset(sorted(files), schema=schema, format='parquet')
+    expression = None
+    for name, values in [('patient_id', patient_ids), ('scan_id', scan_ids), ('workflow', workflows),
+                         ('source', sources), ('metric', metrics)]:
+        if values is not None:
+            condition = ds.field(name).isin(list(values))
+            expression = condition if expression is None else expression & condition
+    return dataset.to_table(columns=columns, filter=expression)
+
+
+class StoreResultsInputSpec(BaseInterfaceInputSpec):
+    store_dir = traits.Str(desc='Cohort results store directory', mandatory=True)
+    patient_id = traits.Str(desc='Patient id', mandatory=True)
+    scan_id = traits.Str('', usedefault=True, desc='Scan id')
+    workflow = traits.Str(desc='Pipeline writing the results (mtr or dti)', mandatory=True)
+    csv_files = InputMultiPath(File(exists=True), desc='Metric CSVs', mandatory=True)
+    sources = traits.List(traits.Str(), desc='Name of each CSV (used as metric name when the CSV has none)',
+                          mandatory=True)
+    runs = traits.List(traits.Int(), desc='Acquisition run of each CSV (1 if not set)')
+
+
+class StoreResultsOutputSpec(TraitedSpec):
+    results_file = File(exists=True, desc='Results file of the subject in the store')
+
+
+class StoreResults(BaseInterface):
+    # Appends the metrics of a subject to the cohort results store
+    input_spec = StoreResultsInputSpec
+    output_spec = StoreResultsOutputSpec
+
+    def _run_interface(self, runtime):
+        runs = self.inputs.runs if isdefined(self.inputs.runs) else [1] * len(self.inputs.csv_files)
+        if not len(self.inputs.csv_files) == len(self.inputs.sources) == len(runs):
+            raise ValueError('One source name (and run) is needed for each CSV file')
+        rows = []
+        for csv_file, source, run in zip(self.inputs.csv_files, self.inputs.sources, runs):
+            for row in read_metric_csv(csv_file, source):
+                row['source'] = source
+                row['run'] = run
+                rows.append(row)
+        write_subject_results(os.path.abspath(self.inputs.store_dir), self.inputs.patient_id, self.inputs.scan_id,
+                              self.inputs.workflow, rows)
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['results_file'] = subject_results_file(os.path.abspath(self.inputs.store_dir),
+                                                       self.inputs.patient_id, self.inputs.scan_id,
+                                                       self.inputs.workflow)
+        return outputs
@@ -1,9 +1,12 @@
 import os
-from nipype.interfaces.base import CommandLine, CommandLineInputSpec, TraitedSpec, File, traits, isdefined, Directory, InputMultiPath
+from nipype.interfaces.base import BaseInterface, CommandLine, CommandLineInputSpec, TraitedSpec, File, traits, isdefined, Directory, InputMultiPath
 from nipype.utils.filemanip import split_filename
 
 from nipype.interfaces.ants.base import ANTSCommand, ANTSCommandInputSpec
 
+from sct_pipeline.interfaces.cache import CachedCommandInputSpec, CachedCommandMixin
+from sct_pipeline.interfaces.image import ImageOutputInputSpec, image_info, image_data, image_filename, save_image
+
 '''
 sct_maths
 sct_propseg
@@ -22,7 +25,7 @@ sct_process_segmentation
 '''
 
 
-class DeepSegInputSpec(CommandLineInputSpec):
+class DeepSegInputSpec(CachedCommandInputSpec):
     input_image = File(exists=True, desc='Input spine image', argstr='-i %s', mandatory=True)
     contrast = traits.Enum('t1','t2','t2s','dwi', desc='Input image contrast type', argstr='-c %s', mandatory=True)
     #centerline = traits.Enum('svm','cnn','file', desc='Method to obtain centerline (viewer method disabled)', argstr='-centerline %s')
@@ -36,7 +39,7 @@ class DeepSegInputSpec(CommandLineInputSpec):
 class DeepSegOutputSpec(TraitedSpec):
     spine_segmentation = File(exists=True, desc='segmentation')
 
-class DeepSeg(CommandLine):
+class DeepSeg(CachedCommandMixin, CommandLine):
     input_spec = DeepSegInputSpec
     output_spec = DeepSegOutputSpec
     _cmd = 'sct_deepseg_sc'
@@ -56,6 +59,7 @@ class PropSegInputSpec(CommandLineInputSpec):
     input_image = File(exists=True, desc='Input spine image', argstr='-i %s', mandatory=True)
     contrast = traits.Enum('t1','t2','t2s','dwi', desc='Input image contrast type', argstr='-c %s', mandatory=True)
     output_file = File(desc='output filename', argstr='-o %s')
+    output_directory = Directory(desc='output directory', argstr='-ofolder %s')
 
 
 class PropSegOutputSpec(TraitedSpec):
@@ -85,7 +89,7 @@ class PropSeg(CommandLine):
         return outputs
 
 
-class LabelVertebraeInputSpec(CommandLineInputSpec):
+class LabelVertebraeInputSpec(CachedCommandInputSpec):
     input_image = File(exists=True, desc='Input spine image', argstr='-i %s', mandatory=True)
     spine_segmentation = File(exists=True, desc='Input spine segmentation image', argstr='-s %s', mandatory=True)
     contrast = traits.Enum('t1','t2', desc='Input image contrast type', argstr='-c %s', mandatory=True)
@@ -99,7 +103,7 @@ class LabelVertebraeOutputSpec(TraitedSpec):
     labels = File(exists=True, desc='hard segmentation')
 
 
-class LabelVertebrae(CommandLine):
+class LabelVertebrae(CachedCommandMixin, CommandLine):
     input_spec = LabelVertebraeInputSpec
     output_spec = LabelVertebraeOutputSpec
     _cmd = 'sct_label_vertebrae'
@@ -146,7 +150,7 @@ class LabelFusionInputSpec(ANTSCommandInputSpec):
     output_image = File(
         position=2,
         argstr="%s",
-        name_source=["op1"],
+        name_source=["images"],
         name_template="%s_maths",
         desc="output image file",
         keep_extension=True,
@@ -179,7 +183,76 @@ class LabelFusion(ANTSCommand):
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['output_image'] = os.path.abspath(self.inputs.output_image)
+        # Named after the first input image unless set
+        outputs['output_image'] = os.path.abspath(self._filename_from_source('output_image'))
 
         return outputs
 
+
+class LabelFusionNativeInputSpec(ImageOutputInputSpec):
+    images = InputMultiPath(File(exists=True), mandatory=True, desc='input label images')
+    operation = traits.Enum('MajorityVoting', 'AverageLabels', mandatory=True,
+                            desc='MajorityVoting outputs the most voted label (ties go to the lowest label, '
+                                 'sct_pipeline_benchmark --compare labelfusion reports how ImageMath breaks them). '
+                                 'AverageLabels outputs a 4D image with the fraction of votes for labels 1 to '
+                                 'max_label.')
+    max_label = traits.Range(1, 65535, 9, usedefault=True, desc='Largest label value in the input images')
+    output_image = traits.Str('fused_labels.nii.gz', usedefault=True, desc='output image file')
+
+
+class LabelFusionNative(BaseInterface):
+    # In-process alternative to LabelFusion. Label images are read one at a time and only the per-label
+    # vote counts are kept, so memory depends on max_label and the image size but not the number of images.
+    input_spec = LabelFusionNativeInputSpec
+    output_spec = LabelFusionOutputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel as nib
+        import numpy as np
+
+        num_images = len(self.inputs.images)
+        count_dtype = np.uint8 if num_images < 256 else np.uint16
+        if num_images > np.iinfo(np.uint16).max:
+            raise ValueError('Too many images for label fusion (at most %d)' % np.iinfo(np.uint16).max)
+
+        # Shapes are checked from the headers before any label image is read
+        shape = image_info(self.inputs.images[0]).shape[:3]
+        for f in self.inputs.images:
+            if image_info(f).shape[:3] != shape:
+                raise ValueError('All label images must have the same shape (%s does not)' % f)
+        ref_obj = nib.load(self.inputs.images[0])
+        num_voxels = int(np.prod(shape))
+        votes = np.zeros((self.inputs.max_label + 1, num_voxels), dtype=count_dtype)
+        voxel_index = np.arange(num_voxels)
+
+        for f in self.inputs.images:
+            labels = np.rint(image_data(f)).astype(np.intp).ravel()
+            if labels.min() < 0 or labels.max() > self.inputs.max_label:
+                raise ValueError('%s has labels outside of 0 to %d' % (f, self.inputs.max_label))
+            # Each voxel appears once per image, so a fancy-indexed increment is safe here
+            votes[labels, voxel_index] += 1
+
+        header = ref_obj.header.copy()
+        if self.inputs.operation == 'MajorityVoting':
+            # argmax returns the first maximum, so ties are broken in favour of the lowest label
+            fused = np.argmax(votes, axis=0).reshape(shape)
+            fused = fused.astype(np.uint8 if self.inputs.max_label < 256 else np.uint16)
+            header.set_data_dtype(fused.dtype)
+        else:
+            fused = np.empty(shape + (self.inputs.max_label,), dtype=np.float32)
+            for label in range(1, self.inputs.max_label + 1):
+                fused[..., label - 1] = votes[label].reshape(shape) / np.float32(num_images)
+            header.set_data_dtype(np.float32)
+        header.set_slope_inter(1, 0)
+
+        fused_obj = nib.Nifti1Image(fused, ref_obj.affine, header)
+        save_image(fused_obj, self.inputs.output_image, self.inputs.compression, self.inputs.compression_level,
+                   self.inputs.compression_threads)
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output_image'] = os.path.abspath(image_filename(self.inputs.output_image, self.inputs.compression))
+
+        return outputs
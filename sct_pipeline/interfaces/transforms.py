@@ -0,0 +1,254 @@
+import os
+
+from sct_pipeline.interfaces.image import image_info, image_data
+
+'''
+ITK transforms and resampling for the in-process interfaces. ITK works in LPS physical coordinates, the
+transforms are converted to RAS when they are read so they can be combined with the NIfTI affines.
+
+Supported files: displacement fields stored as NIfTI (x, y, z, 1, 3) (sct_straighten_spinalcord,
+sct_register_*, antsRegistration warps), ITK affine .mat files and .h5 composite transforms
+(antsRegistration with write_composite_transform, needs h5py) made of affine and displacement field
+transforms. Interpolation follows ITK: points more than half a voxel outside the input are 0, linear
+interpolation clamps the neighbours to the volume and nearest neighbour rounds half up.
+'''
+
+INTERPOLATIONS = ['linear', 'nn']
+
+
+def _lps_to_ras():
+    import numpy as np
+
+    return np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+class AffineTransform(object):
+    # matrix maps RAS points of the reference space to RAS points of the input space
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    def transform_points(self, points):
+        return self.matrix[:3, :3].dot(points) + self.matrix[:3, 3:]
+
+
+class DisplacementField(object):
+    # field is (x, y, z, 3) in RAS on the voxel grid given by affine
+    def __init__(self, field, affine):
+        import numpy as np
+
+        self.field = field
+        self.affine = affine
+        self.shape = field.shape[:3]
+        self._inverse = np.linalg.inv(affine)
+        self._flat = field.reshape(-1, 3)
+
+    def on_grid(self, affine, shape):
+        import numpy as np
+
+        return tuple(shape[:3]) == tuple(self.shape) and np.allclose(affine, self.affine, atol=1e-5)
+
+    def transform_points(self, points):
+        import numpy as np
+
+        coords = self._inverse[:3, :3].dot(points) + self._inverse[:3, 3:]
+        # The displacement of the nearest voxel is used outside the field, as in ITK
+        coords = np.clip(coords, 0, np.array(self.shape)[:, None] - 1)
+        displacement = np.zeros(points.shape, dtype=np.float32)
+        for flat, weight in linear_corners(coords, self.shape):
+            displacement += (self._flat[flat] * weight[:, None]).T
+        return points + displacement
+
+
+def _itk_affine(parameters, fixed_parameters):
+    # MatrixOffsetTransformBase: y = M (x - c) + c + t in LPS
+    import numpy as np
+
+    matrix = np.asarray(parameters[:9], dtype=np.float64).reshape(3, 3)
+    translation = np.asarray(parameters[9:12], dtype=np.float64)
+    center = np.asarray(fixed_parameters[:3], dtype=np.float64) if len(fixed_parameters) else np.zeros(3)
+    lps = np.eye(4)
+    lps[:3, :3] = matrix
+    lps[:3, 3] = translation + center - matrix.dot(center)
+    return AffineTransform(_lps_to_ras().dot(lps).dot(_lps_to_ras()))
+
+
+def _itk_displacement_field(parameters, fixed_parameters):
+    # Fixed parameters are size, origin, spacing and direction, the field is stored with x varying fastest
+    import numpy as np
+
+    size = [int(s) for s in fixed_parameters[:3]]
+    origin = np.asarray(fixed_parameters[3:6], dtype=np.float64)
+    spacing = np.asarray(fixed_parameters[6:9], dtype=np.float64)
+    direction = np.asarray(fixed_parameters[9:18], dtype=np.float64).reshape(3, 3)
+    lps = np.eye(4)
+    lps[:3, :3] = direction * spacing
+    lps[:3, 3] = origin
+    field = np.asarray(parameters, dtype=np.float32).reshape(size[2], size[1], size[0], 3).transpose(2, 1, 0, 3)
+    field = field * np.array([-1, -1, 1], dtype=np.float32)
+    return DisplacementField(np.ascontiguousarray(field), _lps_to_ras().dot(lps))
+
+
+def _itk_transform(transform_type, parameters, fixed_parameters, filename):
+    if transform_type.startswith(('AffineTransform', 'MatrixOffsetTransformBase')):
+        return _itk_affine(parameters, fixed_parameters)
+    if transform_type.startswith('DisplacementFieldTransform'):
+        return _itk_displacement_field(parameters, fixed_parameters)
+    raise ValueError('Unsupported transform %s in %s' % (transform_type, filename))
+
+
+def _read_displacement_field(filename):
+    import numpy as np
+
+    info = image_info(filename)
+    if info.shape[-1] != 3 or len(info.shape) < 4 or np.prod(info.shape[3:-1]) != 1:
+        raise ValueError('%s is not a displacement field' % filename)
+    field = image_data(filename, np.float32).reshape(info.shape[:3] + (3,))
+    return DisplacementField(field * np.array([-1, -1, 1], dtype=np.float32), info.affine)
+
+
+def _read_mat_transform(filename):
+    import scipy.io
+
+    mat = scipy.io.loadmat(filename)
+    for key in mat:
+        if key.endswith('_3_3'):
+            return _itk_transform(key, mat[key].ravel(), mat['fixed'].ravel(), filename)
+    raise ValueError('No 3D transform in %s' % filename)
+
+
+def _read_h5_transforms(filename):
+    import numpy as np
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('h5py is needed to read the composite transform %s' % filename)
+
+    transforms = []
+    with h5py.File(filename, 'r') as f:
+        group = f['TransformGroup']
+        for key in sorted(group, key=int):
+            transform_type = group[key]['TransformType'][0]
+            if isinstance(transform_type, bytes):
+                transform_type = transform_type.decode()
+            if transform_type.startswith('CompositeTransform'):
+                continue
+            transforms.append(_itk_transform(transform_type, np.asarray(group[key]['TransformParameters']),
+                                             np.asarray(group[key]['TransformFixedParameters']), filename))
+    return transforms
+
+
+def load_transforms(filenames):
+    # Transforms in the order of antsApplyTransforms (and of the components of a composite transform): the
+    # last one is applied first to the points of the reference space
+    transforms = []
+    for filename in filenames:
+        if filename.endswith(('.nii', '.nii.gz')):
+            transforms.append(_read_displacement_field(filename))
+        elif filename.endswith('.mat'):
+            transforms.append(_read_mat_transform(filename))
+        elif filename.endswith('.h5'):
+            transforms += _read_h5_transforms(filename)
+        else:
+            raise ValueError('Unsupported transform file %s' % os.path.basename(filename))
+    return transforms
+
+
+def linear_corners(coords, shape):
+    # Flat indices and weights of the 8 neighbours of each point (coords is 3 x N in voxels), neighbours
+    # outside the volume are clamped to the border
+    import numpy as np
+
+    base = np.floor(coords)
+    frac = (coords - base).astype(np.float32)
+    base = base.astype(np.intp)
+    upper = np.array(shape)[:, None] - 1
+    corners = []
+    for corner in np.ndindex(2, 2, 2):
+        index = np.clip(base + np.array(corner)[:, None], 0, upper)
+        weight = np.ones(coords.shape[1], dtype=np.float32)
+        for axis in range(3):
+            weight *= frac[axis] if corner[axis] else 1 - frac[axis]
+        corners.append((np.ravel_multi_index(index, shape[:3]), weight))
+    return corners
+
+
+def nearest_index(coords, shape):
+    import numpy as np
+
+    index = np.clip(np.floor(coords + 0.5).astype(np.intp), 0, np.array(shape)[:, None] - 1)
+    return np.ravel_multi_index(index, shape[:3])
+
+
+def inside_volume(coords, shape):
+    import numpy as np
+
+    return np.all((coords >= -0.5) & (coords < np.array(shape)[:, None] - 0.5), axis=0)
+
+
+def _map_slab(transforms, affine, shape, start, stop):
+    # RAS points of the input space for the reference voxels of slices start:stop
+    import numpy as np
+
+    nx, ny = shape[:2]
+    ijk = np.stack(np.meshgrid(np.arange(nx), np.arange(ny), np.arange(start, stop), indexing='ij')).reshape(3, -1)
+    points = affine[:3, :3].dot(ijk) + affine[:3, 3:]
+    for n, transform in enumerate(reversed(transforms)):
+        if n == 0 and isinstance(transform, DisplacementField) and transform.on_grid(affine, shape):
+            # Field defined on the reference grid (e.g. sct warps): no need to interpolate it
+            points = points + transform.field[:, :, start:stop].reshape(-1, 3).T
+        else:
+            points = transform.transform_points(points)
+    return points
+
+
+def resample_images(input_files, interpolations, reference_file, transforms, slab_size=8):
+    # Resamples input_files on the grid of reference_file. The transforms are read once and the mapped points,
+    # the interpolation indices and weights of every slab are shared by the inputs with the same grid.
+    # Linear interpolation returns float32, nearest neighbour keeps the data type of the input.
+    import numpy as np
+
+    if len(interpolations) != len(input_files):
+        raise ValueError('One interpolation is needed for each input image')
+    transforms = load_transforms(transforms)
+    ref_info = image_info(reference_file)
+    ref_shape = ref_info.shape[:3]
+
+    infos = [image_info(f) for f in input_files]
+    for f, info in zip(input_files, infos):
+        if np.prod(info.shape[3:]) != 1:
+            raise ValueError('%s is not a 3D image' % f)
+    data = [image_data(f).reshape(-1) for f in input_files]
+    outputs = [np.zeros(ref_shape, dtype=np.float32 if interp == 'linear' else d.dtype)
+               for interp, d in zip(interpolations, data)]
+
+    grids = []
+    for info in infos:
+        grid = (info.shape[:3], info.affine.tobytes())
+        if grid not in grids:
+            grids.append(grid)
+
+    for start in range(0, ref_shape[2], slab_size):
+        stop = min(start + slab_size, ref_shape[2])
+        slab_shape = ref_shape[:2] + (stop - start,)
+        points = _map_slab(transforms, ref_info.affine, ref_shape, start, stop)
+        for grid in grids:
+            members = [i for i, info in enumerate(infos) if (info.shape[:3], info.affine.tobytes()) == grid]
+            shape, affine = infos[members[0]].shape[:3], infos[members[0]].affine
+            inverse = np.linalg.inv(affine)
+            coords = inverse[:3, :3].dot(points) + inverse[:3, 3:]
+            inside = inside_volume(coords, shape)
+            corners = None
+            flat = None
+            for i in members:
+                if interpolations[i] == 'linear':
+                    if corners is None:
+                        corners = linear_corners(coords, shape)
+                    values = np.zeros(coords.shape[1], dtype=np.float32)
+                    for corner, weight in corners:
+                        values += data[i][corner] * weight
+                else:
+                    if flat is None:
+                        flat = nearest_index(coords, shape)
+                    values = data[i][flat]
+                outputs[i][:, :, start:stop] = np.where(inside, values, 0).reshape(slab_shape)
+    return outputs
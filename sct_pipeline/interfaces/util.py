@@ -2,6 +2,9 @@ import os
 from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, CommandLine, CommandLineInputSpec, TraitedSpec, File, traits, isdefined, Directory
 from nipype.utils.filemanip import split_filename
 
+from sct_pipeline.interfaces.image import (ImageOutputInputSpec, image_info, image_data, image_filename, image_max,
+                                           masked_mean, save_image)
+
 '''
 sct_maths
 sct_propseg
@@ -19,14 +22,20 @@ sct_extract_metric
 sct_process_segmentation
 '''
 
-class GenerateTemplateInputSpec(BaseInterfaceInputSpec):
-    input_file = File(exists=True, desc='input image', mandatory=True)
+class GenerateTemplateInputSpec(ImageOutputInputSpec):
+    input_file = File(exists=True, desc='input 4D image', mandatory=True, xor=['input_files'])
+    input_files = traits.List(File(exists=True), desc='input 3D images, averaged one at a time without merging',
+                              mandatory=True, xor=['input_file'])
     flip_axis = traits.Int(0, desc='Axis number to flip (-1 to not flip)', usedefault=True)
+    accumulator_dtype = traits.Enum('float64', 'float32', desc='Data type of the running sum', usedefault=True)
+    previous_template = File(exists=True, desc='Existing template to update with the input images')
+    previous_count = traits.Int(0, desc='Number of images averaged in previous_template', usedefault=True)
     output_name = traits.Str(desc='Filename for output template')
 
 
 class GenerateTemplateOutputSpec(TraitedSpec):
     template_file = File(exists=True, desc='output template')
+    num_images = traits.Int(desc='Number of images averaged in the template')
 
 
 class GenerateTemplate(BaseInterface):
@@ -37,35 +46,62 @@ class GenerateTemplate(BaseInterface):
         import nibabel as nib
         import numpy as np
 
-        vol_obj = nib.load(self.inputs.input_file)
-        vol_data = vol_obj.get_fdata()
-
-        if self.inputs.flip_axis == -1:
-            template_data = np.average(vol_data, axis=-1)
-        else:
-            template_data = (np.average(vol_data, axis=-1) + np.average(np.flip(vol_data, axis=self.inputs.flip_axis), axis=-1)) / 2
-
-        template_obj = nib.Nifti1Image(template_data, vol_obj.affine, vol_obj.header)
-        if isdefined(self.inputs.output_name):
-            output_name = self.inputs.output_name + '.nii.gz'
+        # Volumes are added to a running sum one at a time, so only one volume is held in memory
+        dtype = np.dtype(self.inputs.accumulator_dtype)
+        if isdefined(self.inputs.input_files):
+            # Shapes are checked from the headers before any voxel data is read
+            for f in self.inputs.input_files:
+                if image_info(f).shape[:3] != image_info(self.inputs.input_files[0]).shape[:3]:
+                    raise ValueError('All volumes must have the same shape to generate a template')
+            ref_obj = nib.load(self.inputs.input_files[0])
+            volumes = (image_data(f, dtype) for f in self.inputs.input_files)
+            num_volumes = len(self.inputs.input_files)
         else:
-            output_name = 'template.nii.gz'
-        template_obj.to_filename(output_name)
+            ref_obj = nib.load(self.inputs.input_file)
+            num_volumes = ref_obj.shape[3] if len(ref_obj.shape) > 3 else 1
+            if num_volumes == 1:
+                volumes = iter([ref_obj.get_fdata(dtype=dtype).reshape(ref_obj.shape[:3])])
+            else:
+                volumes = (np.asarray(ref_obj.dataobj[..., i], dtype=dtype) for i in range(num_volumes))
+
+        template_data = np.zeros(ref_obj.shape[:3], dtype=dtype)
+        for vol_data in volumes:
+            if vol_data.shape != template_data.shape:
+                raise ValueError('All volumes must have the same shape to generate a template')
+            template_data += vol_data
+        # Running mean update of an existing template, so only the new images need to be registered and loaded
+        if isdefined(self.inputs.previous_template) and self.inputs.previous_count > 0:
+            template_data += image_data(self.inputs.previous_template, dtype) * self.inputs.previous_count
+            num_volumes += self.inputs.previous_count
+        template_data /= num_volumes
+        self._num_images = num_volumes
+
+        # The average of the flipped volumes is the flipped average, so no flipped copies are needed
+        if self.inputs.flip_axis != -1:
+            template_data = (template_data + np.flip(template_data, axis=self.inputs.flip_axis)) / 2
+
+        header = ref_obj.header.copy()
+        header.set_data_dtype(np.float32)
+        template_obj = nib.Nifti1Image(template_data, ref_obj.affine, header)
+        save_image(template_obj, self._output_name(), self.inputs.compression, self.inputs.compression_level,
+                   self.inputs.compression_threads)
 
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        if isdefined(self.inputs.output_name):
-            outputs['template_file'] = os.path.abspath(self.inputs.output_name + '.nii.gz')
-        else:
-            outputs['template_file'] = os.path.abspath('template.nii.gz')
+        outputs['template_file'] = os.path.abspath(image_filename(self._output_name(), self.inputs.compression))
+        if hasattr(self, '_num_images'):
+            outputs['num_images'] = self._num_images
         return outputs
 
+    def _output_name(self):
+        return self.inputs.output_name if isdefined(self.inputs.output_name) else 'template'
+
 class MeanInputSpec(CommandLineInputSpec):
     input_image = File(exists=True, desc='Input spine image', argstr='-i %s', mandatory=True)
     dimension = traits.Enum('t','x','y','dwi', desc='Dimension to take mean over', argstr='-mean %s', mandatory=True)
-    output_file = File(desc='output filename', argstr='-o %s')
+    output_file = File(desc='output filename', argstr='-o %s', genfile=True)
 
 
 class MeanOutputSpec(TraitedSpec):
@@ -79,13 +115,16 @@ class Mean(CommandLine):
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outfile = split_filename(self.inputs.input_image)[1] + '_seg.nii.gz'
-        if isdefined(self.inputs.output_directory):
-            outputs['spine_segmentation'] = os.path.abspath(os.path.join(self.inputs.output_directory, outfile))
-        else:
-            outputs['spine_segmentation'] = os.path.abspath(outfile)
+        outputs['mean_image'] = self._gen_filename('output_file')
         return outputs
 
+    def _gen_filename(self, name):
+        if name == 'output_file':
+            if isdefined(self.inputs.output_file):
+                return os.path.abspath(self.inputs.output_file)
+            return os.path.abspath(split_filename(self.inputs.input_image)[1] + '_mean.nii.gz')
+        return None
+
 
 class LabelUtilsInputSpec(CommandLineInputSpec):
     input_image = File(exists=True, desc='Input spine image', argstr='-i %s', mandatory=True)
@@ -187,16 +226,69 @@ class ComputeMTR(CommandLine):
         return outputs
 
 
-class ThresholdLabelsInputSpec(BaseInterfaceInputSpec):
+class ComputeMTRNativeInputSpec(ImageOutputInputSpec):
+    mt_on_image = File(exists=True, desc='Input MT on image (mt1)', mandatory=True)
+    mt_off_image = File(exists=True, desc='Input MT off image (mt0)', mandatory=True)
+    threshold = traits.Float(100.0, desc='Clip MTR values above this threshold (same as sct_compute_mtr)',
+                             usedefault=True)
+    output_name = traits.Str('mtr', desc='Filename for output MTR (without extension)', usedefault=True)
+
+
+class ComputeMTRNative(BaseInterface):
+    # In-process replacement for ComputeMTR, avoids starting the SCT interpreter for a voxelwise operation
+    input_spec = ComputeMTRNativeInputSpec
+    output_spec = ComputeMTROutputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel as nib
+        import numpy as np
+
+        if image_info(self.inputs.mt_on_image).shape != image_info(self.inputs.mt_off_image).shape:
+            raise ValueError('MT on and MT off images must have the same shape')
+        mt1_obj = nib.load(self.inputs.mt_on_image)
+
+        # Converted directly to float32, so no float64 copy of either volume is made
+        mt1 = image_data(self.inputs.mt_on_image, np.float32)
+        mt0 = image_data(self.inputs.mt_off_image, np.float32)
+
+        mtr = np.zeros(mt0.shape, dtype=np.float32)
+        valid = mt0 != 0
+        np.subtract(mt0, mt1, out=mtr, where=valid)
+        np.divide(mtr, mt0, out=mtr, where=valid)
+        mtr *= 100
+        mtr[~np.isfinite(mtr)] = 0
+        np.clip(mtr, 0, self.inputs.threshold, out=mtr)
+
+        header = mt1_obj.header.copy()
+        header.set_data_dtype(np.float32)
+        header.set_slope_inter(1, 0)
+        mtr_obj = nib.Nifti1Image(mtr, mt1_obj.affine, header)
+        save_image(mtr_obj, self.inputs.output_name, self.inputs.compression, self.inputs.compression_level,
+                   self.inputs.compression_threads)
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['mtr_image'] = os.path.abspath(image_filename(self.inputs.output_name, self.inputs.compression))
+        return outputs
+
+
+class ThresholdLabelsInputSpec(ImageOutputInputSpec):
     label_files = traits.List(File(exists=True), desc='Vertebrae label image', mandatory=True)
     threshold = traits.Bool(default_value=False, desc='If true, threshold to a binary mask.')
     num_additional_labels_removed = traits.Int(default_value=0, desc='Number of additional labels to remove. '
                                                                      'If set to 1, this will remove an additional '
                                                                      'label.')
+    max_common_label = traits.Int(desc='Use this label as the largest common label instead of computing it from '
+                                       'the label files (e.g. when adding subjects to an existing template)')
+    num_threads = traits.Int(1, desc='Number of label files read and written in parallel', usedefault=True,
+                             nohash=True)
 
 
 class ThresholdLabelsOutputSpec(TraitedSpec):
     thresholded_label_files = traits.List(File(exists=True), desc='Output labels')
+    max_common_label = traits.Int(desc='Largest label kept in the thresholded label files')
 
 
 class ThresholdLabels(BaseInterface):
@@ -204,42 +296,47 @@ class ThresholdLabels(BaseInterface):
     output_spec = ThresholdLabelsOutputSpec
 
     def _run_interface(self, runtime):
-        import nibabel as nib
-        import numpy as np
-
-        vol_list = []
-        header_list = []
-        affine_list = []
-        max_common_label = np.inf
+        from concurrent.futures import ThreadPoolExecutor
 
-        for f in self.inputs.label_files:
-            vol_obj = nib.load(f)
-            vol_data = vol_obj.get_fdata()
-            vol_list.append(vol_data)
-            header_list.append(vol_obj.header)
-            affine_list.append(vol_obj.affine)
+        # Pass one only reads the maxima (chunked, one file at a time), pass two thresholds and writes every file
+        # independently, so at most num_threads label volumes are in memory. Writing is mostly gzip time, which
+        # runs outside the GIL, so threads are enough to overlap it.
+        with ThreadPoolExecutor(max_workers=self.inputs.num_threads) as pool:
+            if isdefined(self.inputs.max_common_label):
+                max_common_label = self.inputs.max_common_label
+            else:
+                max_common_label = min(pool.map(image_max, self.inputs.label_files))
+                max_common_label = max_common_label - self.inputs.num_additional_labels_removed
+            self._max_common_label = int(max_common_label)
 
-            max_label = np.max(vol_data)
-            if max_label < max_common_label:
-                max_common_label = max_label
+            list(pool.map(self._threshold_file, self.inputs.label_files))
 
-        max_common_label = max_common_label - self.inputs.num_additional_labels_removed
+        return runtime
 
-        for idx, f in enumerate(self.inputs.label_files):
-            vol_data = vol_list[idx]
-            vol_data[vol_data > max_common_label] = 0
-            if self.inputs.threshold is True:
-                vol_data[vol_data > 0] = 1
-            vol_obj = nib.Nifti1Image(vol_data, affine_list[idx], header_list[idx])
+    def _threshold_file(self, label_file):
+        import nibabel as nib
+        import numpy as np
 
-            output_name = split_filename(f)[1] + '_thresh.nii.gz'
-            vol_obj.to_filename(output_name)
+        vol_obj = nib.load(label_file)
+        # Labels are kept in their on-disk integer type (writable copy of the memory map)
+        vol_data = np.array(image_data(label_file))
+        vol_data[vol_data > self._max_common_label] = 0
+        if self.inputs.threshold is True:
+            vol_data[vol_data > 0] = 1
 
-        return runtime
+        header = vol_obj.header.copy()
+        header.set_data_dtype(vol_data.dtype)
+        header.set_slope_inter(1, 0)
+        save_image(nib.Nifti1Image(vol_data, vol_obj.affine, header), split_filename(label_file)[1] + '_thresh',
+                   self.inputs.compression, self.inputs.compression_level, self.inputs.compression_threads)
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['thresholded_label_files'] = [os.path.abspath(split_filename(f)[1] + '_thresh.nii.gz') for f in self.inputs.label_files]
+        outputs['thresholded_label_files'] = [os.path.abspath(image_filename(split_filename(f)[1] + '_thresh',
+                                                                             self.inputs.compression))
+                                              for f in self.inputs.label_files]
+        if hasattr(self, '_max_common_label'):
+            outputs['max_common_label'] = self._max_common_label
 
         return outputs
 
@@ -258,16 +355,11 @@ class ComputeAvgGMWMMTR(BaseInterface):
     output_spec = ComputeAvgGMWMMTROutputSpec
 
     def _run_interface(self, runtime):
-        import nibabel as nib
-        import numpy as np
         import csv
 
-        mtr_data = nib.load(self.inputs.mtr_file).get_fdata()
-        gm_data = nib.load(self.inputs.gm_file).get_fdata()
-        wm_data = nib.load(self.inputs.wm_file).get_fdata()
-
-        avg_wm = np.average(mtr_data[wm_data > 0.85])
-        avg_gm = np.average(mtr_data[gm_data > 0.85])
+        # Averages are accumulated a few slices at a time instead of loading the three volumes as float64
+        avg_wm = masked_mean(self.inputs.mtr_file, self.inputs.wm_file, 0.85)
+        avg_gm = masked_mean(self.inputs.mtr_file, self.inputs.gm_file, 0.85)
 
         output_name = split_filename(self.inputs.mtr_file)[1] + '.csv'
         with open(output_name, 'w', newline='') as csvfile:
@@ -283,4 +375,444 @@ class ComputeAvgGMWMMTR(BaseInterface):
 
         return outputs
 
-# TODO: Output spine images?
\ No newline at end of file
+
+def _parse_range(range_str):
+    # Parses SCT style ranges of the form start:end (inclusive) or a single value
+    values = [int(v) for v in range_str.split(':')]
+    if len(values) == 1:
+        return values[0], values[0]
+    return values[0], values[-1]
+
+
+class ExtractMetricsNativeInputSpec(BaseInterfaceInputSpec):
+    input_image = File(exists=True, desc='Input metric image', mandatory=True)
+    cord_file = File(exists=True, desc='Cord label image')
+    gm_file = File(exists=True, desc='Gray matter label image')
+    wm_file = File(exists=True, desc='White matter label image')
+    levels_file = File(exists=True, desc='Vertebral level image')
+    vertebrae = traits.Str(desc='Vertebral levels of the form start:end (requires levels_file)')
+    mask_threshold = traits.Float(desc='If set, label images are binarized at this value instead of being used '
+                                       'as weights')
+    output_filename = traits.Str('metrics.csv', desc='Output filename', usedefault=True)
+
+
+class ExtractMetricsNativeOutputSpec(TraitedSpec):
+    output_csv = File(exists=True, desc='Output CSV')
+
+
+class ExtractMetricsNative(BaseInterface):
+    # Loads the metric image once and computes weighted mean, std and voxel counts per slice, per vertebral
+    # level and over the whole ROI for every label image in a single pass. Replaces ExtractMetric and
+    # ComputeAvgGMWMMTR, which each reload the same images.
+    input_spec = ExtractMetricsNativeInputSpec
+    output_spec = ExtractMetricsNativeOutputSpec
+
+    def _run_interface(self, runtime):
+        import numpy as np
+        import csv
+
+        metric_info = image_info(self.inputs.input_image)
+        metric_data = image_data(self.inputs.input_image, np.float32).ravel()
+        num_slices = metric_info.shape[2]
+
+        levels_data = None
+        if isdefined(self.inputs.levels_file):
+            levels_data = np.rint(image_data(self.inputs.levels_file)).astype(np.int32).ravel()
+        elif isdefined(self.inputs.vertebrae):
+            raise ValueError('levels_file is needed to restrict the metrics to vertebral levels')
+
+        rows = []
+        for roi in ['cord', 'gm', 'wm']:
+            roi_file = getattr(self.inputs, roi + '_file')
+            if not isdefined(roi_file):
+                continue
+            if image_info(roi_file).shape[:3] != metric_info.shape[:3]:
+                raise ValueError('%s image does not match the shape of the metric image' % roi)
+
+            # Only the voxels inside the label are kept, everything after this works on flat arrays
+            weights = image_data(roi_file).ravel()
+            if isdefined(self.inputs.mask_threshold):
+                index = np.flatnonzero(weights > self.inputs.mask_threshold)
+                weights = np.ones(index.size, dtype=np.float64)
+            else:
+                index = np.flatnonzero(weights > 0)
+                weights = weights[index].astype(np.float64)
+            values = metric_data[index].astype(np.float64)
+            slices = index % num_slices
+
+            levels = None
+            if levels_data is not None:
+                levels = levels_data[index]
+                if isdefined(self.inputs.vertebrae):
+                    vert_min, vert_max = _parse_range(self.inputs.vertebrae)
+                    keep = (levels >= vert_min) & (levels <= vert_max)
+                    weights, values, slices, levels = weights[keep], values[keep], slices[keep], levels[keep]
+
+            stats = self._weighted_stats(slices, weights, values, num_slices)
+            for z in np.flatnonzero(stats[3]):
+                rows.append([roi, 'slice', z, ''] + [stats[i][z] for i in range(4)])
+
+            if levels is not None and levels.size > 0:
+                stats = self._weighted_stats(levels, weights, values, levels.max() + 1)
+                for level in np.flatnonzero(stats[3]):
+                    if level > 0:
+                        rows.append([roi, 'level', '', level] + [stats[i][level] for i in range(4)])
+
+            stats = self._weighted_stats(np.zeros(weights.size, dtype=np.intp), weights, values, 1)
+            rows.append([roi, 'all', '', self.inputs.vertebrae if isdefined(self.inputs.vertebrae) else ''] +
+                        [stats[i][0] for i in range(4)])
+
+        with open(self.inputs.output_filename, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['roi', 'scope', 'slice', 'vertebral_level', 'mean', 'std', 'weight_sum', 'num_voxels'])
+            writer.writerows(rows)
+
+        return runtime
+
+    @staticmethod
+    def _weighted_stats(keys, weights, values, length):
+        import numpy as np
+
+        weight_sum = np.bincount(keys, weights=weights, minlength=length)
+        value_sum = np.bincount(keys, weights=weights * values, minlength=length)
+        square_sum = np.bincount(keys, weights=weights * values * values, minlength=length)
+        num_voxels = np.bincount(keys, minlength=length)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = value_sum / weight_sum
+            std = np.sqrt(np.maximum(square_sum / weight_sum - mean * mean, 0))
+
+        return mean, std, weight_sum, num_voxels
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output_csv'] = os.path.abspath(self.inputs.output_filename)
+        return outputs
+
+class ProcessSegNativeInputSpec(BaseInterfaceInputSpec):
+    input_image = File(exists=True, desc='Cord segmentation (binary or soft)', mandatory=True)
+    slices = traits.Str(desc='Slice range of the form start:end')
+    per_slice = traits.Enum(0, 1, desc='1 if per slice metrics should be computed, 0 otherwise', usedefault=True)
+    per_level = traits.Enum(0, 1, desc='1 if per level metrics should be computed, 0 otherwise', usedefault=True)
+    vertebrae = traits.Str(desc='Vertebral levels of the form start:end (requires vertebrae_image)')
+    vertebrae_image = File(exists=True, desc='Vertebral level image')
+    angle_correction = traits.Bool(True, desc='Correct the metrics for the angle between the centerline and the '
+                                              'slice normal', usedefault=True)
+    output_filename = traits.Str('csa.csv', desc='Output filename', usedefault=True)
+
+
+class ProcessSegNativeOutputSpec(TraitedSpec):
+    output_csv = File(exists=True, desc='Output CSV')
+
+
+class ProcessSegNative(BaseInterface):
+    # In-process sct_process_segmentation. Area, centre of mass and second moments of every axial slice are
+    # computed with one bincount pass over the cord voxels, the centerline is a polynomial fit of the centres
+    # of mass. Diameters, eccentricity and orientation come from the ellipse with the same second moments
+    # (as skimage regionprops), solidity is not computed. The slice vertebral level is the level with the
+    # largest cord weight in the slice.
+    input_spec = ProcessSegNativeInputSpec
+    output_spec = ProcessSegNativeOutputSpec
+
+    _metrics = ['area', 'angle_AP', 'angle_RL', 'diameter_AP', 'diameter_RL', 'eccentricity', 'orientation',
+                'solidity']
+
+    def _run_interface(self, runtime):
+        import numpy as np
+        import csv
+        import datetime
+
+        seg_info = image_info(self.inputs.input_image)
+        shape = seg_info.shape[:3]
+        dx, dy, dz = np.sqrt(np.sum(seg_info.affine[:3, :3] ** 2, axis=0))
+        weights = image_data(self.inputs.input_image, np.float32).ravel()
+        index = np.flatnonzero(weights > 0)
+        weights = weights[index].astype(np.float64)
+        x, y, z = np.unravel_index(index, shape)
+        x = x * dx
+        y = y * dy
+
+        # Per slice sums of the weights and of their first and second moments (mm)
+        def slice_sum(values):
+            return np.bincount(z, weights=weights * values, minlength=shape[2])
+        weight_sum = np.bincount(z, weights=weights, minlength=shape[2])
+        valid = weight_sum > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cx = slice_sum(x) / weight_sum
+            cy = slice_sum(y) / weight_sum
+            cxx = slice_sum(x * x) / weight_sum - cx * cx
+            cyy = slice_sum(y * y) / weight_sum - cy * cy
+            cxy = slice_sum(x * y) / weight_sum - cx * cy
+
+        slopes_x = np.zeros(shape[2])
+        slopes_y = np.zeros(shape[2])
+        fitted = np.flatnonzero(valid)
+        if self.inputs.angle_correction and fitted.size > 1:
+            degree = min(5, fitted.size - 1)
+            slice_z = fitted * dz
+            slopes_x[fitted] = np.polyval(np.polyder(np.polyfit(slice_z, cx[fitted], degree)), slice_z)
+            slopes_y[fitted] = np.polyval(np.polyder(np.polyfit(slice_z, cy[fitted], degree)), slice_z)
+        cos_rl = 1 / np.sqrt(1 + slopes_x ** 2)
+        cos_ap = 1 / np.sqrt(1 + slopes_y ** 2)
+        # Cosine of the angle between the centerline and the slice normal
+        cos_angle = 1 / np.sqrt(1 + slopes_x ** 2 + slopes_y ** 2)
+
+        # Moments of the cross-section perpendicular to the centerline
+        cxx, cyy, cxy = cxx * cos_rl ** 2, cyy * cos_ap ** 2, cxy * cos_rl * cos_ap
+        root = np.sqrt(np.maximum(((cxx - cyy) / 2) ** 2 + cxy ** 2, 0))
+        major = np.maximum((cxx + cyy) / 2 + root, 0)
+        minor = np.maximum((cxx + cyy) / 2 - root, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            eccentricity = np.where(major > 0, np.sqrt(1 - minor / major), 0)
+        metrics = {'area': weight_sum * dx * dy * cos_angle,
+                   'angle_AP': np.degrees(np.arctan(slopes_y)),
+                   'angle_RL': np.degrees(np.arctan(slopes_x)),
+                   'diameter_AP': 4 * np.sqrt(minor),
+                   'diameter_RL': 4 * np.sqrt(major),
+                   'eccentricity': eccentricity,
+                   'orientation': np.degrees(0.5 * np.arctan2(2 * cxy, cxx - cyy)),
+                   'solidity': None}
+        length = dz / cos_angle
+
+        slice_levels = np.zeros(shape[2], dtype=np.intp)
+        if isdefined(self.inputs.vertebrae_image):
+            if image_info(self.inputs.vertebrae_image).shape[:3] != shape:
+                raise ValueError('vertebrae_image does not match the shape of the segmentation')
+            levels = np.rint(image_data(self.inputs.vertebrae_image).ravel()[index]).astype(np.intp)
+            num_levels = max(levels.max() + 1, 1) if levels.size else 1
+            level_weights = np.bincount(z * num_levels + levels, weights=weights,
+                                        minlength=shape[2] * num_levels).reshape(shape[2], num_levels)
+            slice_levels = np.argmax(level_weights, axis=1)
+        elif isdefined(self.inputs.vertebrae):
+            raise ValueError('vertebrae_image is needed to restrict the metrics to vertebral levels')
+
+        keep = valid.copy()
+        if isdefined(self.inputs.slices):
+            z_min, z_max = _parse_range(self.inputs.slices)
+            keep[:z_min] = False
+            keep[z_max + 1:] = False
+        if isdefined(self.inputs.vertebrae):
+            vert_min, vert_max = _parse_range(self.inputs.vertebrae)
+            keep &= (slice_levels >= vert_min) & (slice_levels <= vert_max)
+
+        # Groups of slices of the output rows
+        selected = np.flatnonzero(keep)
+        if self.inputs.per_slice:
+            groups = [[z] for z in selected]
+        elif self.inputs.per_level and isdefined(self.inputs.vertebrae_image):
+            groups = [selected[slice_levels[selected] == level] for level in np.unique(slice_levels[selected])]
+        else:
+            groups = [selected] if selected.size else []
+
+        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        rows = []
+        for group in groups:
+            group = np.asarray(group)
+            group_levels = np.unique(slice_levels[group]) if isdefined(self.inputs.vertebrae_image) else []
+            row = [timestamp, 'native', os.path.abspath(self.inputs.input_image),
+                   '%d:%d' % (group.min(), group.max()) if group.size > 1 else group[0],
+                   ':'.join(str(level) for level in group_levels), '']
+            for metric in self._metrics:
+                if metric in metrics and metrics[metric] is not None:
+                    row += [np.mean(metrics[metric][group]), np.std(metrics[metric][group])]
+                else:
+                    row += ['', '']
+            rows.append(row + [np.sum(length[group])])
+
+        with open(self.inputs.output_filename, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['Timestamp', 'SCT Version', 'Filename', 'Slice (I->S)', 'VertLevel', 'DistancePMJ'] +
+                            [f % metric for metric in self._metrics for f in ['MEAN(%s)', 'STD(%s)']] +
+                            ['SUM(length)'])
+            writer.writerows(rows)
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output_csv'] = os.path.abspath(self.inputs.output_filename)
+        return outputs
+
+
+# TODO: Output spine images?
+
+
+def cord_axis(affine):
+    # Voxel axis closest to the superior-inferior direction
+    import numpy as np
+
+    return int(np.argmax(np.abs(affine[2, :3]) / np.linalg.norm(affine[:3, :3], axis=0)))
+
+
+def crop_box(mask_file, margin_mm, threshold=0.5, image_file=None):
+    # Slices of the bounding box of mask > threshold grown by margin_mm in the plane orthogonal to the cord.
+    # The cord axis is kept whole so the per slice metrics keep their slice numbers. None if the mask is empty.
+    # With image_file, the slices are on the grid of image_file (which can have another resolution or field of
+    # view than the mask): the box is mapped through world coordinates and the smallest box covering it is kept.
+    import itertools
+    import numpy as np
+
+    info = image_info(mask_file)
+    mask = image_data(mask_file).reshape(info.shape[:3] + (-1,)).max(axis=3) > threshold
+    if not mask.any():
+        return None
+    axis = cord_axis(info.affine)
+    box = []
+    for i in range(3):
+        if i == axis:
+            box.append(slice(0, info.shape[i]))
+            continue
+        other = tuple(a for a in range(3) if a != i)
+        indices = np.flatnonzero(mask.any(axis=other))
+        margin = int(np.ceil(margin_mm / info.zooms[i]))
+        box.append(slice(max(indices[0] - margin, 0), min(indices[-1] + margin + 1, info.shape[i])))
+    if image_file is None:
+        return tuple(box)
+
+    image = image_info(image_file)
+    if image.shape[:3] == info.shape[:3] and np.allclose(image.affine, info.affine, atol=1e-4):
+        return tuple(box)
+    # Corners of the box (voxel edges) in the voxel coordinates of image_file
+    corners = np.array(list(itertools.product(*[(b.start - 0.5, b.stop - 0.5) for b in box])))
+    to_image = np.linalg.inv(image.affine).dot(info.affine)
+    corners = corners.dot(to_image[:3, :3].T) + to_image[:3, 3]
+    start = np.maximum(np.floor(corners.min(axis=0) + 0.5).astype(int), 0)
+    stop = np.minimum(np.ceil(corners.max(axis=0) - 0.5).astype(int) + 1, image.shape[:3])
+    if np.any(stop <= start):
+        return None
+    axis = cord_axis(image.affine)
+    return tuple(slice(0, image.shape[i]) if i == axis else slice(start[i], stop[i]) for i in range(3))
+
+
+class CropToMaskInputSpec(ImageOutputInputSpec):
+    input_image = File(exists=True, desc='Image to crop (3D or 4D)', mandatory=True)
+    mask = File(exists=True, desc='Mask (or soft segmentation), on the grid of input_image or overlapping it',
+                mandatory=True)
+    margin_mm = traits.Float(10.0, desc='Margin around the mask bounding box (mm)', usedefault=True)
+    threshold = traits.Float(0.5, desc='Voxels of the mask above threshold are inside', usedefault=True)
+    output_name = traits.Str(desc='Filename for output image (without extension), <input>_crop by default')
+
+
+class CropToMaskOutputSpec(TraitedSpec):
+    output_image = File(exists=True, desc='Cropped image, its affine keeps it in place')
+
+
+class CropToMask(BaseInterface):
+    # Cuts an image to the bounding box of a (cord) mask so the following nodes run on a small volume.
+    # The affine of the crop is updated, so it overlays the input and UncropImage can put it back. A mask on
+    # another grid (e.g. of the MT on image for the MT off image) is applied in world coordinates.
+    input_spec = CropToMaskInputSpec
+    output_spec = CropToMaskOutputSpec
+
+    def _output_name(self):
+        if isdefined(self.inputs.output_name):
+            return self.inputs.output_name
+        return split_filename(self.inputs.input_image)[1] + '_crop'
+
+    def _run_interface(self, runtime):
+        from sct_pipeline.interfaces.image import load_image
+
+        info = image_info(self.inputs.input_image)
+        box = crop_box(self.inputs.mask, self.inputs.margin_mm, self.inputs.threshold, self.inputs.input_image)
+        if box is None:
+            # Nothing to centre on (or the mask is outside of the image), the whole image is kept
+            box = tuple(slice(0, n) for n in info.shape[:3])
+        # slicer only reads the box and shifts the affine to its first voxel
+        cropped = load_image(self.inputs.input_image).slicer[box]
+        save_image(cropped, self._output_name(), self.inputs.compression, self.inputs.compression_level,
+                   self.inputs.compression_threads)
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output_image'] = os.path.abspath(image_filename(self._output_name(), self.inputs.compression))
+        return outputs
+
+
+class UncropImageInputSpec(ImageOutputInputSpec):
+    input_image = File(exists=True, desc='Image cropped by CropToMask (or computed on a cropped image)',
+                       mandatory=True)
+    reference_image = File(exists=True, desc='Image with the native grid', mandatory=True)
+    output_name = traits.Str(desc='Filename for output image (without extension), <input>_native by default')
+
+
+class UncropImageOutputSpec(TraitedSpec):
+    output_image = File(exists=True, desc='Image on the grid of reference_image, 0 outside the crop')
+
+
+class UncropImage(BaseInterface):
+    # Puts a cropped image back in the field of view of reference_image
+    input_spec = UncropImageInputSpec
+    output_spec = UncropImageOutputSpec
+
+    def _output_name(self):
+        if isdefined(self.inputs.output_name):
+            return self.inputs.output_name
+        return split_filename(self.inputs.input_image)[1] + '_native'
+
+    def _run_interface(self, runtime):
+        import nibabel as nib
+        import numpy as np
+        from sct_pipeline.interfaces.image import load_image
+
+        info = image_info(self.inputs.input_image)
+        ref_info = image_info(self.inputs.reference_image)
+        # The crop is the reference grid shifted by a whole number of voxels
+        offset = np.linalg.inv(ref_info.affine).dot(info.affine[:, 3])[:3]
+        if not np.allclose(info.affine[:3, :3], ref_info.affine[:3, :3], atol=1e-4) or \
+                not np.allclose(offset, np.round(offset), atol=1e-3):
+            raise ValueError('%s is not a crop of %s' % (self.inputs.input_image, self.inputs.reference_image))
+        offset = np.round(offset).astype(int)
+        if np.any(offset < 0) or np.any(offset + info.shape[:3] > ref_info.shape[:3]):
+            raise ValueError('%s is outside of %s' % (self.inputs.input_image, self.inputs.reference_image))
+
+        img = load_image(self.inputs.input_image)
+        data = image_data(self.inputs.input_image)
+        full = np.zeros(tuple(ref_info.shape[:3]) + data.shape[3:], dtype=data.dtype)
+        full[tuple(slice(o, o + n) for o, n in zip(offset, data.shape[:3]))] = data
+        header = img.header.copy()
+        header.set_data_dtype(full.dtype)
+        header.set_slope_inter(1, 0)
+        save_image(nib.Nifti1Image(full, ref_info.affine, header), self._output_name(), self.inputs.compression,
+                   self.inputs.compression_level, self.inputs.compression_threads)
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output_image'] = os.path.abspath(image_filename(self._output_name(), self.inputs.compression))
+        return outputs
+
+
+class ExportImageInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, desc='Image to export', mandatory=True)
+    out_file = File(desc='Output filename (.nii or .nii.gz)', mandatory=True)
+    clobber = traits.Bool(False, desc='Overwrite out_file if it exists', usedefault=True)
+    compression_level = traits.Range(1, 9, 6, usedefault=True, desc='zlib compression level')
+
+
+class ExportImageOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='Exported image')
+
+
+class ExportImage(BaseInterface):
+    # Like ExportFile, but compresses (or decompresses) the image to match the extension of out_file, so
+    # final outputs stay .nii.gz whatever the intermediate format of the pipeline
+    input_spec = ExportImageInputSpec
+    output_spec = ExportImageOutputSpec
+
+    def _run_interface(self, runtime):
+        from sct_pipeline.interfaces.image import compress_file
+
+        if os.path.exists(self.inputs.out_file) and not self.inputs.clobber:
+            raise FileExistsError('%s exists and clobber is not set' % self.inputs.out_file)
+        compress_file(self.inputs.in_file, self.inputs.out_file, self.inputs.compression_level)
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = os.path.abspath(self.inputs.out_file)
+
+        return outputs
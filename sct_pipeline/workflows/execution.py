@@ -0,0 +1,137 @@
+import os
+import time
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from nipype import config
+from nipype.interfaces.base import Bunch
+
+from sct_pipeline.workflows.resources import limit_resources
+
+
+@contextmanager
+def scratch_directory(scratch_dir, prefix='sct_pipeline', keep_scratch=False):
+    # Private folder in scratch_dir (e.g. node local NVMe or tmpfs) for the working directories of workflows.
+    # Only files copied out of it (export nodes, the result cache) are kept: the folder is removed when the
+    # block succeeds, and kept for debugging if it raises. Yields None if scratch_dir is None.
+    if scratch_dir is None:
+        yield None
+        return
+    os.makedirs(scratch_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix=prefix + '_', dir=scratch_dir)
+    try:
+        yield work_dir
+    except BaseException:
+        print('Intermediate files kept in %s' % work_dir)
+        raise
+    if keep_scratch:
+        print('Intermediate files kept in %s' % work_dir)
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+class StatusCallbacks(object):
+    # Forwards the node status to several callbacks (the plugins take a single status_callback)
+    def __init__(self, callbacks):
+        self.callbacks = callbacks
+
+    def __call__(self, node, status):
+        for callback in self.callbacks:
+            callback(node, status)
+
+
+def run_workflow(wf, num_threads=1, profile=None, memory_gb=None, scratch_dir=None, keep_scratch=False,
+                 ledger=None, retries=0, retry_backoff=60.0):
+    # Runs a workflow with the Linear plugin (num_threads == 1) or MultiProc. With MultiProc, nodes are packed
+    # using their n_procs/mem_gb hints within num_threads cores and memory_gb of RAM (90% of the system
+    # memory if not set). If profile is set, per node timing/resource usage is written to profile.json/.csv
+    # and a critical path summary to profile_summary.txt. If scratch_dir is set, the workflow runs in a
+    # scratch_directory, so only the exported outputs are left after the run.
+    # If ledger is set, finished nodes are recorded in that file (see ledger.py) and skipped when the workflow
+    # is run again. If nodes crash, the workflow is run again up to retries times, after waiting
+    # retry_backoff seconds (doubled after every attempt).
+    if scratch_dir is not None:
+        with scratch_directory(scratch_dir, wf.name, keep_scratch) as work_dir:
+            wf.base_dir = work_dir
+            return run_workflow(wf, num_threads, profile, memory_gb, ledger=ledger, retries=retries,
+                                retry_backoff=retry_backoff)
+
+    plugin_args = {}
+    if num_threads == 1:
+        plugin = 'Linear'
+    else:
+        plugin = 'MultiProc'
+        plugin_args['n_procs'] = num_threads
+        plugin_args['raise_insufficient'] = False
+        if memory_gb is not None:
+            plugin_args['memory_gb'] = memory_gb
+        limit_resources(wf, num_threads, memory_gb)
+
+    callbacks = []
+    run_ledger = None
+    if ledger is not None:
+        from sct_pipeline.workflows.ledger import RunLedger
+
+        run_ledger = RunLedger(ledger)
+        callbacks.append(run_ledger)
+
+    profiler = None
+    if profile is not None:
+        from sct_pipeline.workflows.profiling import WorkflowProfiler
+
+        config.enable_resource_monitor()
+        profiler = WorkflowProfiler(wf, subnode_jobs=plugin != 'Linear')
+        callbacks.append(profiler)
+    if callbacks:
+        plugin_args['status_callback'] = callbacks[0] if len(callbacks) == 1 else StatusCallbacks(callbacks)
+
+    try:
+        for attempt in range(retries + 1):
+            if run_ledger is not None:
+                num_skipped, num_nodes = run_ledger.restore(wf)
+                print('Run ledger %s: %d of %d nodes already finished' % (ledger, num_skipped, num_nodes))
+                if num_skipped == num_nodes:
+                    # nipype can not run a graph without nodes, the outputs are all in the ledger
+                    import networkx as nx
+
+                    return nx.DiGraph()
+            try:
+                return wf.run(plugin=plugin, plugin_args=plugin_args)
+            except RuntimeError as e:
+                if attempt == retries:
+                    raise
+                wait = retry_backoff * 2 ** attempt
+                print('%s\nRetrying the failed nodes in %.0fs (attempt %d of %d)' % (e, wait, attempt + 1, retries))
+                time.sleep(wait)
+    finally:
+        if profiler is not None:
+            print(profiler.write_report(profile))
+
+
+def default_profile_prefix(wf):
+    base_dir = wf.base_dir if wf.base_dir is not None else os.getcwd()
+    return os.path.join(os.path.abspath(base_dir), wf.name + '_profile')
+
+
+def default_ledger_file(wf):
+    base_dir = wf.base_dir if wf.base_dir is not None else os.getcwd()
+    return os.path.join(os.path.abspath(base_dir), wf.name + '_ledger.jsonl')
+
+
+def get_node_outputs(execgraph, name, wf=None):
+    # Outputs of the node called name in the graph returned by run_workflow (lists for MapNodes). nipype removes
+    # the IdentityInterface nodes (e.g. output_node) from the executed graph, their outputs are collected from
+    # the nodes connected to them in wf.
+    for node in execgraph.nodes():
+        if node.name == name:
+            return node.result.outputs
+    identity = wf.get_node(name) if wf is not None else None
+    if identity is None:
+        raise KeyError('No node named %s in the executed graph' % name)
+    outputs = Bunch(**{field: getattr(identity.inputs, field) for field in identity.inputs.copyable_trait_names()})
+    for src, _, data in wf._graph.in_edges(identity, data=True):
+        src_outputs = get_node_outputs(execgraph, src.name, wf)
+        for src_field, dst_field in data['connect']:
+            setattr(outputs, dst_field, getattr(src_outputs, src_field))
+    return outputs
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import hashlib
+
+import nipype.pipeline.engine as pe
+import nipype.interfaces.utility as util
+
+'''
+Run ledger for resumable runs. Every node that finishes is appended to a JSONL file with the digest of its
+configuration, its outputs and the size/mtime of its output files. When a workflow is started again with the
+same ledger, finished nodes are replaced by IdentityInterface nodes holding the recorded outputs (which nipype
+removes from the graph), so they are skipped without loading their results or hashing their inputs again.
+
+The configuration digest of a node covers its interface, its static inputs (with the size/mtime of input
+files) and the digests of the nodes connected to it, so changing a parameter or an input file invalidates the
+node and everything downstream. A node is only skipped if all its upstream nodes are skipped and its output
+files are unchanged. Sub-workflows connected to their parent workflow are always run by nipype.
+'''
+
+
+def _stat(filename):
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _jsonable(value):
+    # Output values as JSON, raises TypeError for values that can not be recorded
+    from nipype.interfaces.base import isdefined
+
+    if not isdefined(value) or value is None or isinstance(value, (str, bool, int, float)):
+        return value if isdefined(value) else None
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if hasattr(value, 'tolist'):
+        # numpy scalars and arrays
+        return value.tolist()
+    raise TypeError('%r can not be recorded' % value)
+
+
+def _files(value):
+    if isinstance(value, list):
+        return [f for v in value for f in _files(v)]
+    return [value] if isinstance(value, str) and os.path.isfile(value) else []
+
+
+def _static_inputs(node, connected):
+    # Inputs set on the node, without the nohash ones (threads, environment) as in the nipype hash
+    nohash = set(node.inputs.traits(nohash=True))
+    # File traits that do not need to exist are outputs (e.g. the out_file of the exports), they are not stat'ed
+    outputs = set(name for name, trait in node.interface.inputs.traits().items()
+                  if getattr(trait.trait_type, 'exists', True) is False)
+    inputs = {}
+    for name, value in sorted(node.inputs.get().items()):
+        if name in connected or name in nohash:
+            continue
+        try:
+            inputs[name] = _jsonable(value)
+        except TypeError:
+            inputs[name] = repr(value)
+        if name not in outputs:
+            inputs[name + '_stat'] = [_stat(f) for f in _files(inputs[name])]
+    return inputs
+
+
+def _iter_workflow(wf, prefix):
+    # (owner workflow, node, prefix) in topological order, prefix.name is the full name of the executed node
+    import networkx as nx
+
+    for node in nx.topological_sort(wf._graph):
+        key = prefix + '.' + node.name
+        if isinstance(node, pe.Workflow):
+            if wf._graph.in_degree(node) == 0:
+                for item in _iter_workflow(node, key):
+                    yield item
+        else:
+            yield wf, node, prefix
+
+
+class RunLedger(object):
+    # Also the status callback of the plugins, it is kept picklable (MapNodes pickle the callback)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.digests = {}
+        self._restored = set()
+        self._start_times = {}
+        num_lines = 0
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                for line in f:
+                    num_lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line of a run that was killed while writing
+                        continue
+                    self.entries[entry['node']] = entry
+        if num_lines > 2 * len(self.entries) + 100:
+            self._compact()
+
+    def _compact(self):
+        tmp_file = self.filename + '.tmp'
+        with open(tmp_file, 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp_file, self.filename)
+
+    def _append(self, entry):
+        self.entries[entry['node']] = entry
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def _is_finished(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry['status'] != 'done' or entry['digest'] != self.digests[key]:
+            return False
+        if entry['outputs'] is None:
+            return False
+        try:
+            return all(_stat(f) == s for f, s in entry['files'].items())
+        except OSError:
+            return False
+
+    def restore(self, wf):
+        # Computes the digest of every node of wf and replaces the finished ones by their recorded outputs.
+        # Returns the number of skipped nodes and the number of nodes.
+        available = set()
+        num_skipped = 0
+        num_nodes = 0
+        for owner, node, prefix in list(_iter_workflow(wf, wf.name)):
+            key = prefix + '.' + node.name
+            in_edges = list(owner._graph.in_edges(node, data=True))
+            if key in self._restored:
+                # Replaced by an earlier call (retries), keeps the digest of the original node
+                available.add(node)
+                num_skipped += 1
+                num_nodes += 1
+                continue
+            upstream = sorted([self.digests.get(prefix + '.' + src.name, src.name), str(c[0]), c[1]]
+                              for src, _, data in in_edges for c in data['connect'])
+            description = {'interface': node.interface.__class__.__module__ + '.' +
+                                        node.interface.__class__.__name__,
+                           'mapnode': isinstance(node, pe.MapNode),
+                           'inputs': _static_inputs(node, set(u[2] for u in upstream)),
+                           'upstream': upstream}
+            self.digests[key] = hashlib.sha256(json.dumps(description, sort_keys=True,
+                                                          default=repr).encode()).hexdigest()
+
+            if not all(src in available for src, _, _ in in_edges):
+                num_nodes += not isinstance(node.interface, util.IdentityInterface)
+                continue
+            if isinstance(node.interface, util.IdentityInterface):
+                available.add(node)
+                continue
+            num_nodes += 1
+            if not self._is_finished(key):
+                continue
+            out_edges = list(owner._graph.out_edges(node, data=True))
+            if any(not isinstance(c[0], str) for _, _, data in out_edges for c in data['connect']):
+                continue
+
+            outputs = self.entries[key]['outputs']
+            recorded = pe.Node(interface=util.IdentityInterface(fields=list(outputs)), name=node.name)
+            for name, value in outputs.items():
+                if value is not None:
+                    setattr(recorded.inputs, name, value)
+            owner.remove_nodes([node])
+            for _, dst, data in out_edges:
+                for src_field, dst_field in data['connect']:
+                    owner.connect(recorded, src_field, dst, dst_field)
+            available.add(recorded)
+            self._restored.add(key)
+            num_skipped += 1
+        return num_skipped, num_nodes
+
+    def __call__(self, node, status):
+        key = node.fullname
+        if key not in self.digests:
+            # MapNode subnodes, only the MapNode itself is recorded
+            return
+        if status == 'start':
+            self._start_times[key] = time.time()
+            return
+
+        end = time.time()
+        start = self._start_times.pop(key, end)
+        entry = {'node': key, 'workflow': key.rsplit('.', 1)[0], 'status': 'done' if status == 'end' else 'crashed',
+                 'digest': self.digests[key], 'start': start, 'end': end, 'wall_time_s': end - start,
+                 'outputs': None, 'files': {}}
+        if status == 'end':
+            try:
+                # MapNode results are a Bunch of lists
+                outputs = dict(node.result.outputs.items()) if isinstance(node, pe.MapNode) \
+                    else node.result.outputs.get()
+                outputs = {name: _jsonable(value) for name, value in outputs.items()}
+                entry['files'] = {f: _stat(f) for f in _files(list(outputs.values()))}
+                entry['outputs'] = outputs
+            except (TypeError, AttributeError, OSError):
+                # Outputs that are not files/values can not be restored, the node is run again next time
+                pass
+        self._append(entry)
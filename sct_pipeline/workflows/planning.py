@@ -0,0 +1,259 @@
+import json
+import heapq
+import statistics
+
+import nipype.pipeline.engine as pe
+import nipype.interfaces.utility as util
+
+from sct_pipeline.workflows.profiling import image_voxels, record_name
+from sct_pipeline.workflows.resources import RESOURCE_HINTS, _hint_key
+
+'''
+Dry-run planner. The flat graph of a workflow is walked without running it: image sizes are read from the
+NIfTI headers of the inputs set on the nodes and passed downstream, MapNodes run once per item of the lists
+connected to them. The wall time of every node is predicted with a per-interface cost model (fixed seconds
+plus seconds per million input voxels), and the run is simulated with the n_procs/mem_gb of the nodes on
+num_threads cores and memory_gb of RAM, as MultiProc schedules it, to predict the wall time, peak memory, CPU
+hours and scratch disk (everything written by the nodes, exports excluded).
+
+The default costs are rough single subject figures. calibrate_cost_model replaces them with the times, peak
+RSS and output sizes measured by --profile (profiling.py records the input size of every node), per node name
+where available and per interface otherwise.
+'''
+
+# wall_s + wall_s_per_mvox * million input voxels, written_bytes_per_voxel of scratch per input voxel
+COST_MODEL = {
+    # SCT commands
+    'DeepSeg': dict(wall_s=20, wall_s_per_mvox=15, written_bytes_per_voxel=2),
+    'PropSeg': dict(wall_s=10, wall_s_per_mvox=10, written_bytes_per_voxel=2),
+    'LabelVertebrae': dict(wall_s=60, wall_s_per_mvox=30, written_bytes_per_voxel=4),
+    'CreateMask': dict(wall_s=3, wall_s_per_mvox=1, written_bytes_per_voxel=1),
+    'RegisterToTemplate': dict(wall_s=300, wall_s_per_mvox=120, written_bytes_per_voxel=40),
+    'WarpTemplate': dict(wall_s=60, wall_s_per_mvox=20, written_bytes_per_voxel=60),
+    'RegisterMultimodal': dict(wall_s=30, wall_s_per_mvox=40, written_bytes_per_voxel=30),
+    'StraightenSpinalcord': dict(wall_s=120, wall_s_per_mvox=60, written_bytes_per_voxel=40),
+    'ApplyTransform': dict(wall_s=10, wall_s_per_mvox=10, written_bytes_per_voxel=4),
+    'GetCenterline': dict(wall_s=10, wall_s_per_mvox=5, written_bytes_per_voxel=1),
+    'ComputeMTR': dict(wall_s=3, wall_s_per_mvox=1, written_bytes_per_voxel=4),
+    'ExtractMetric': dict(wall_s=5, wall_s_per_mvox=3, written_bytes_per_voxel=0),
+    'ProcessSeg': dict(wall_s=5, wall_s_per_mvox=3, written_bytes_per_voxel=0),
+    'Mean': dict(wall_s=3, wall_s_per_mvox=1, written_bytes_per_voxel=0.2),
+    'MotionCorrection': dict(wall_s=120, wall_s_per_mvox=60, written_bytes_per_voxel=4),
+    'ComputeDTI': dict(wall_s=20, wall_s_per_mvox=10, written_bytes_per_voxel=1),
+    # In-process interfaces
+    'ComputeMTRNative': dict(wall_s=1, wall_s_per_mvox=0.5, written_bytes_per_voxel=2),
+    'WarpTemplateNative': dict(wall_s=5, wall_s_per_mvox=2, written_bytes_per_voxel=4),
+    'ApplyTransformsNative': dict(wall_s=2, wall_s_per_mvox=2, written_bytes_per_voxel=2),
+    'ExtractMetricsNative': dict(wall_s=1, wall_s_per_mvox=0.5, written_bytes_per_voxel=0),
+    'RegisterSlicewiseNative': dict(wall_s=2, wall_s_per_mvox=1, written_bytes_per_voxel=30),
+    'ComputeDTINative': dict(wall_s=2, wall_s_per_mvox=2, written_bytes_per_voxel=0.5),
+    'ProcessSegNative': dict(wall_s=1, wall_s_per_mvox=0.5, written_bytes_per_voxel=0),
+    'CropToMask': dict(wall_s=1, wall_s_per_mvox=0.5, written_bytes_per_voxel=0.3),
+    'UncropImage': dict(wall_s=1, wall_s_per_mvox=0.5, written_bytes_per_voxel=1),
+    'ComputeAvgGMWMMTR': dict(wall_s=1, wall_s_per_mvox=1, written_bytes_per_voxel=0),
+    'GenerateTemplate': dict(wall_s=2, wall_s_per_mvox=2, written_bytes_per_voxel=2),
+    'ThresholdLabels': dict(wall_s=1, wall_s_per_mvox=0.5, written_bytes_per_voxel=1),
+    'LabelFusion': dict(wall_s=5, wall_s_per_mvox=5, written_bytes_per_voxel=1),
+    'LabelFusionNative': dict(wall_s=1, wall_s_per_mvox=1, written_bytes_per_voxel=1),
+    'StoreResults': dict(wall_s=1, wall_s_per_mvox=0, written_bytes_per_voxel=0),
+    # ANTs/FSL
+    'Registration': dict(wall_s=60, wall_s_per_mvox=60, written_bytes_per_voxel=4),
+    'Registration_SyN': dict(wall_s=600, wall_s_per_mvox=300, written_bytes_per_voxel=30),
+    'ApplyTransforms': dict(wall_s=5, wall_s_per_mvox=5, written_bytes_per_voxel=2),
+    'Merge': dict(wall_s=5, wall_s_per_mvox=2, written_bytes_per_voxel=2),
+    # Bookkeeping nodes, exports are written outside of the working directory
+    'IdentityInterface': dict(wall_s=0, wall_s_per_mvox=0, written_bytes_per_voxel=0),
+    'Select': dict(wall_s=0, wall_s_per_mvox=0, written_bytes_per_voxel=0),
+    'Split': dict(wall_s=0, wall_s_per_mvox=0, written_bytes_per_voxel=0),
+    'ExportFile': dict(wall_s=0.5, wall_s_per_mvox=0, written_bytes_per_voxel=0),
+    'ExportImage': dict(wall_s=1, wall_s_per_mvox=0.5, written_bytes_per_voxel=0),
+    # Anything else
+    '_default': dict(wall_s=10, wall_s_per_mvox=10, written_bytes_per_voxel=4),
+}
+
+
+def calibrate_cost_model(report_files, cost_model=None):
+    # Cost model with the measurements of the JSON reports written by --profile (e.g. one per subject).
+    # Entries are added per node name and per interface: seconds and output bytes per input voxel (fixed
+    # seconds for reports without input sizes), mean CPU cores used and peak RSS.
+    samples = {}
+    for report_file in report_files:
+        with open(report_file) as f:
+            records = json.load(f)['nodes']
+        for r in records:
+            if r['mapnode'] or r['status'] != 'ok':
+                continue
+            for key in [record_name(r['name']), r['interface']]:
+                samples.setdefault(key, []).append(r)
+
+    calibrated = dict(COST_MODEL if cost_model is None else cost_model)
+    for key, records in samples.items():
+        sized = [r for r in records if r.get('input_voxels')]
+        if sized:
+            entry = dict(wall_s=0.0,
+                         wall_s_per_mvox=statistics.median(r['wall_time_s'] * 1e6 / r['input_voxels'] for r in sized),
+                         written_bytes_per_voxel=statistics.median((r['bytes_written'] or 0) / r['input_voxels']
+                                                                   for r in sized))
+        else:
+            entry = dict(wall_s=statistics.median(r['wall_time_s'] for r in records), wall_s_per_mvox=0.0,
+                         written_bytes_per_voxel=0.0,
+                         written_bytes=statistics.median(r['bytes_written'] or 0 for r in records))
+        cpu_ratios = [r['cpu_time_s'] / r['wall_time_s'] for r in records if r['cpu_time_s'] and r['wall_time_s']]
+        if cpu_ratios:
+            entry['cpu_ratio'] = statistics.median(cpu_ratios)
+        peak_rss = [r['peak_rss_gb'] for r in records if r['peak_rss_gb']]
+        if peak_rss:
+            entry['mem_gb'] = max(peak_rss)
+        entry['calibrated'] = True
+        calibrated[key] = entry
+    return calibrated
+
+
+def _node_cost(node, cost_model):
+    for key in [node.name, _hint_key(node), node.interface.__class__.__name__, '_default']:
+        if key in cost_model:
+            return cost_model[key]
+
+
+def _node_memory(node, voxels, cost, margin=1.25):
+    # Measured peak RSS if calibrated, otherwise the estimate of the resource hints for this image size
+    if cost.get('mem_gb'):
+        return cost['mem_gb'] * margin
+    hint = RESOURCE_HINTS.get(_hint_key(node))
+    if hint is None or not hint.get('multipliers') or not voxels:
+        return node.mem_gb
+    overhead = hint.get('overhead_gb', 0.3)
+    estimate = overhead + sum(hint['multipliers'].values()) * voxels / 1e9
+    return min(max(estimate, overhead), max(hint['mem_gb'] * 4, 8.0))
+
+
+def _list_lengths(static, fields=None):
+    return [len(v) for name, v in static.items() if isinstance(v, list) and (fields is None or name in fields)]
+
+
+def _num_items(node, static, upstream):
+    # Length of the lists going out of the node, which is the number of runs of the MapNodes using them.
+    # upstream holds the (number of items, connected input fields) of each predecessor, a MapNode only runs
+    # once per item of the predecessors connected to its iterfields.
+    upstream_items = [items for items, _ in upstream]
+    if isinstance(node, pe.MapNode):
+        iterated = [items for items, fields in upstream if set(fields) & set(node.iterfield)]
+        return max(_list_lengths(static, node.iterfield) + iterated + [1])
+    if isinstance(node.interface, util.Merge):
+        return max(sum(upstream_items) + sum(_list_lengths(static)), 1)
+    if isinstance(node.interface, util.IdentityInterface):
+        return max(_list_lengths(static) + upstream_items + [1])
+    return 1
+
+
+def _simulate(graph, order, estimates, num_threads, memory_gb):
+    # List scheduling of the node runs in graph order as MultiProc does: a run starts once its node's
+    # predecessors are finished and enough free cores and memory are available
+    position = {node: i for i, node in enumerate(order)}
+    waiting = {node: graph.in_degree(node) for node in order}
+    remaining = {node: estimates[node]['runs'] for node in order}
+    ready = [(position[node], run, node) for node in order if waiting[node] == 0
+             for run in range(estimates[node]['runs'])]
+    running = []
+    now, free_threads, free_memory, peak_memory, peak_threads = 0.0, num_threads, memory_gb, 0.0, 0
+    while ready or running:
+        ready.sort()
+        for job in list(ready):
+            estimate = estimates[job[2]]
+            fits = estimate['n_procs'] <= free_threads and estimate['mem_gb'] <= free_memory + 1e-9
+            if fits or not running:
+                ready.remove(job)
+                heapq.heappush(running, (now + estimate['wall_time_s'], job))
+                free_threads -= estimate['n_procs']
+                free_memory -= estimate['mem_gb']
+        peak_memory = max(peak_memory, memory_gb - free_memory)
+        peak_threads = max(peak_threads, num_threads - free_threads)
+
+        now, (_, _, node) = heapq.heappop(running)
+        free_threads += estimates[node]['n_procs']
+        free_memory += estimates[node]['mem_gb']
+        remaining[node] -= 1
+        if remaining[node] == 0:
+            for successor in graph.successors(node):
+                waiting[successor] -= 1
+                if waiting[successor] == 0:
+                    ready += [(position[successor], run, successor) for run in range(estimates[successor]['runs'])]
+    return now, peak_memory, peak_threads
+
+
+def plan_workflow(wf, num_threads=1, memory_gb=None, cost_model=None):
+    # Predicted resources of running wf with run_workflow(wf, num_threads, memory_gb=memory_gb). The inputs
+    # of wf (e.g. wf.inputs.input_node) must be set, nothing is run or written.
+    import networkx as nx
+    from nipype.utils.profiler import get_system_total_memory_gb
+
+    cost_model = COST_MODEL if cost_model is None else cost_model
+    if memory_gb is None:
+        # Default of MultiProc
+        memory_gb = get_system_total_memory_gb() * 0.9
+
+    graph = wf._create_flat_graph()
+    order = list(nx.topological_sort(graph))
+    voxels, items, estimates = {}, {}, {}
+    for node in order:
+        predecessors = list(graph.predecessors(node))
+        static = node.inputs.get()
+        voxels[node] = max([image_voxels(list(static.values()))] + [voxels[p] for p in predecessors])
+        items[node] = _num_items(node, static, [(items[p], [dest for _, dest in graph[p][node]['connect']])
+                                                for p in predecessors])
+
+        cost = _node_cost(node, cost_model)
+        n_procs = min(node.n_procs, num_threads)
+        wall_time = cost['wall_s'] + cost['wall_s_per_mvox'] * voxels[node] / 1e6
+        runs = items[node] if isinstance(node, pe.MapNode) else 1
+        estimates[node] = dict(name=node.name, fullname=node.fullname, interface=node.interface.__class__.__name__,
+                               runs=runs, voxels=voxels[node], n_procs=n_procs, wall_time_s=wall_time,
+                               cpu_time_s=wall_time * cost.get('cpu_ratio', n_procs),
+                               mem_gb=min(_node_memory(node, voxels[node], cost), memory_gb),
+                               scratch_gb=runs * (cost.get('written_bytes', 0) +
+                                                  cost['written_bytes_per_voxel'] * voxels[node]) / 1e9,
+                               calibrated=cost.get('calibrated', False),
+                               unknown_size=not voxels[node] and cost['wall_s_per_mvox'] > 0)
+
+    wall_time, peak_memory, peak_threads = _simulate(graph, order, estimates, num_threads, memory_gb) \
+        if order else (0.0, 0.0, 0)
+    nodes = [estimates[node] for node in order]
+    return {'workflow': wf.name, 'num_threads': num_threads, 'memory_gb': memory_gb,
+            'wall_time_s': wall_time, 'serial_time_s': sum(n['runs'] * n['wall_time_s'] for n in nodes),
+            'cpu_hours': sum(n['runs'] * n['cpu_time_s'] for n in nodes) / 3600.0,
+            'peak_memory_gb': peak_memory, 'peak_threads': peak_threads,
+            'scratch_gb': sum(n['scratch_gb'] for n in nodes), 'nodes': nodes}
+
+
+def _format_time(seconds):
+    return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60) if seconds >= 3600 else '%.1fmin' % (seconds / 60)
+
+
+def format_plan(plan, num_nodes=15):
+    lines = ['Plan for %s on %d threads and %.1f GB:' % (plan['workflow'], plan['num_threads'], plan['memory_gb']),
+             '  Wall time:    %s (%s if run serially)' % (_format_time(plan['wall_time_s']),
+                                                          _format_time(plan['serial_time_s'])),
+             '  CPU time:     %.2f CPU hours' % plan['cpu_hours'],
+             '  Peak memory:  %.1f GB (%d threads busy at most)' % (plan['peak_memory_gb'], plan['peak_threads']),
+             '  Scratch disk: %.2f GB' % plan['scratch_gb']]
+
+    # Same node of every subject/run together
+    summary = {}
+    for n in plan['nodes']:
+        s = summary.setdefault(n['name'], dict(runs=0, cpu_time_s=0.0, mem_gb=0.0, scratch_gb=0.0,
+                                               calibrated=n['calibrated'], unknown_size=False))
+        s['runs'] += n['runs']
+        s['cpu_time_s'] += n['runs'] * n['cpu_time_s']
+        s['mem_gb'] = max(s['mem_gb'], n['mem_gb'])
+        s['scratch_gb'] += n['scratch_gb']
+        s['unknown_size'] |= n['unknown_size']
+    lines.append('Most expensive nodes:')
+    lines.append('  %-40s %6s %10s %8s %10s' % ('node', 'runs', 'CPU time', 'mem GB', 'scratch GB'))
+    for name, s in sorted(summary.items(), key=lambda i: -i[1]['cpu_time_s'])[:num_nodes]:
+        lines.append('  %-40s %6d %10s %8.1f %10.2f' % (name + ('' if s['calibrated'] else ' *'), s['runs'],
+                                                        _format_time(s['cpu_time_s']), s['mem_gb'], s['scratch_gb']))
+    lines.append('  * default cost, not calibrated with --plan PROFILE.json')
+    unknown = sorted(name for name, s in summary.items() if s['unknown_size'])
+    if unknown:
+        lines.append('Image size unknown (missing input files) for: ' + ', '.join(unknown))
+    return '\n'.join(lines)
@@ -1,4 +1,6 @@
 import os  # system functions
+import csv
+import re
 
 #from nipype import Workflow, Node, IdentityInterface
 
@@ -12,6 +14,9 @@ import sct_pipeline.interfaces.registration as sct_reg
 import sct_pipeline.interfaces.segmentation as sct_seg
 import sct_pipeline.interfaces.util as sct_util
 import sct_pipeline.interfaces.dmri as sct_dmri
+import sct_pipeline.interfaces.results as sct_results
+from sct_pipeline.interfaces.cache import use_result_cache
+from sct_pipeline.workflows.resources import apply_resource_hints
 
 # from fpdf import FPDF
 # from PIL.Image import Image
@@ -34,6 +39,42 @@ class PipelineWorkflow(pe.Workflow):
     #    if os.path.basename(self.base_dir) == 'pipeline' and os.listdir(self.base_dir) == []:
     #        shutil.rmtree(self.base_dir)
 
+
+class CohortWorkflow(pe.Workflow):
+    # Meta-workflow of subject sub-workflows. nipype runs every node under base_dir/name/<subject>, so when the
+    # cohort runs in the folder it was created for, each <subject> folder is made a link to the working directory
+    # of the subject when it runs on its own (subject_directories). The intermediates stay in the per subject
+    # folders (--use-iacl-struct) and a cohort reuses the nodes of earlier single subject runs. In another base_dir
+    # (e.g. scratch) the subjects run in the cohort folder.
+    def __init__(self, name, base_dir=None):
+        super(CohortWorkflow, self).__init__(name, base_dir)
+        self.subject_directories = {}
+        self._subject_base_dir = base_dir
+
+    def run(self, plugin=None, plugin_args=None, updatehash=False):
+        if self.base_dir is not None and self.base_dir == self._subject_base_dir:
+            self._link_subject_directories()
+        return super(CohortWorkflow, self).run(plugin, plugin_args, updatehash)
+
+    def _link_subject_directories(self):
+        cohort_dir = os.path.join(self.base_dir, self.name)
+        os.makedirs(cohort_dir, exist_ok=True)
+        for subject_name, subject_dir in self.subject_directories.items():
+            link = os.path.join(cohort_dir, subject_name)
+            if os.path.islink(link):
+                if os.path.realpath(link) == os.path.realpath(subject_dir):
+                    continue
+                os.remove(link)
+            elif os.path.exists(link):
+                # Folder of a cohort run without links, kept so its nodes are not run again
+                continue
+            os.makedirs(subject_dir, exist_ok=True)
+            try:
+                os.symlink(subject_dir, link)
+            except OSError:
+                # No symbolic links on this file system, the subject runs in the cohort folder
+                pass
+
 '''def create_spinalcord_mtr_workflow(scan_directory, patient_id=None, scan_id=None, compute_csa=False):
 
     name = 'SCT_MTR'
@@ -86,63 +127,200 @@ def create_spinalcord_t2_workflow(scan_directory, patient_id=None, scan_id=None)
     #sct_warp_template
     #sct_process_segmentation
 
-def create_spinalcord_dti_workflow(scan_directory, patient_id=None, scan_id=None):
-    name = 'SCT_DTI'
-    if patient_id is not None and scan_id is not None:
-        scan_directory = os.path.join(scan_directory, patient_id, 'pipeline')
-        name += '_' + scan_id
+def _subject_directories(prefix, scan_directory, patient_id, scan_id, use_iacl_struct, name=None):
+    # Workflow name, workflow base directory and base filename of the exported outputs of a subject. The name
+    # is prefix (followed by the scan_id with the IACL folder structure) unless it is given.
+    root_dir = scan_directory
+    default_name = prefix
+    if use_iacl_struct is True:
+        if patient_id is not None and scan_id is not None:
+            root_dir = os.path.join(root_dir, patient_id, 'pipeline')
+            default_name += '_' + scan_id
+        else:
+            raise ValueError('Need to provide a patient_id and scan_id to use the IACL folder structure')
+    else:
+        if patient_id is not None:
+            scan_folder = patient_id + '_' + scan_id if scan_id is not None else patient_id
+            root_dir = (os.path.join(root_dir, scan_folder))
+        # else just use the scan_directory
 
-    wf = pe.Workflow(name, scan_directory)
+    # Set up base filename for copying outputs
+    if use_iacl_struct:
+        out_file_base = os.path.join(scan_directory, patient_id, scan_id, patient_id + '_' + scan_id + '_SPINE')
+    else:
+        if patient_id is not None:
+            out_file_base = patient_id + '_' + scan_id if scan_id is not None else patient_id
+        else:
+            out_file_base = 'out'
+        out_file_base = os.path.join(scan_directory, out_file_base + '_SPINE')
+
+    return name if name is not None else default_name, root_dir, out_file_base
+
+
+def add_store_results(wf, results_store, patient_id, scan_id, pipeline, csv_outputs):
+    # Appends the metric CSVs to the cohort results store. pipeline (mtr or dti) keys the results of the subject,
+    # so single subject and cohort runs write the same file. csv_outputs are (node, field, source, runs), runs
+    # is None for a Node and the list of run numbers for a MapNode
+    if patient_id is None:
+        raise ValueError('Need to provide a patient_id to write to the results store')
+    merge_csv = pe.Node(util.Merge(len(csv_outputs), ravel_inputs=True), 'merge_results_csv')
+    store_results = pe.Node(sct_results.StoreResults(), 'store_results')
+    store_results.inputs.store_dir = os.path.abspath(results_store)
+    store_results.inputs.patient_id = patient_id
+    store_results.inputs.scan_id = scan_id if scan_id is not None else ''
+    store_results.inputs.workflow = pipeline
+    sources = []
+    run_numbers = []
+    for n, (node, field, source, runs) in enumerate(csv_outputs):
+        wf.connect(node, field, merge_csv, 'in%d' % (n + 1))
+        sources += [source] * (len(runs) if runs is not None else 1)
+        run_numbers += runs if runs is not None else [1]
+    store_results.inputs.sources = sources
+    store_results.inputs.runs = run_numbers
+    wf.connect(merge_csv, 'out', store_results, 'csv_files')
+    return store_results
+
+
+def create_spinalcord_dti_workflow(scan_directory, patient_id=None, scan_id=None, num_runs=1, use_iacl_struct=False,
+                                   use_native_dti=False, use_native_warp=False, cache_dir=None, cache_size_gb=None,
+                                   results_store=None, name=None):
+    # input_node fields are lists with one entry per DWI run. Every run goes through its own branch of
+    # MapNodes, so motion correction, tensor fitting and template registration of different runs (and the
+    # tensor fit and registration of the same run) can run concurrently.
+    name, root_dir, out_file_base = _subject_directories('SCT_DTI', scan_directory, patient_id, scan_id,
+                                                         use_iacl_struct, name)
+    wf = pe.Workflow(name, root_dir)
 
     input_node = pe.Node(util.IdentityInterface(['dwi_file', 'bval_file', 'bvec_file']), 'input_node')
 
     # First part of this pipeline is to generate an approximate DWI mask for motion correction
-    mean_dwi = pe.Node(sct_util.Mean(), 'mean_dwi')
+    mean_dwi = pe.MapNode(sct_util.Mean(), name='mean_dwi', iterfield=['input_image'])
     mean_dwi.inputs.dimension = 't'
-    wf.connect(input_node, 'dwi_image', mean_dwi, 'input_image')
+    wf.connect(input_node, 'dwi_file', mean_dwi, 'input_image')
 
     # Rough segmentation of dwi (DeepSeg is used later as the final segmentation)
-    initial_spine_segmentation = pe.Node(sct_seg.PropSeg(), 'initial_spine_segmentation')
+    initial_spine_segmentation = pe.MapNode(sct_seg.PropSeg(), name='initial_spine_segmentation',
+                                            iterfield=['input_image'])
     initial_spine_segmentation.inputs.contrast = 'dwi'
     wf.connect(mean_dwi, 'mean_image', initial_spine_segmentation, 'input_image')
 
     # Create a mask that is 35mm from the spine centerline
-    create_mask = pe.Node(sct_seg.CreateMask(), 'create_mask')
-    create_mask.inputs.size = 35
+    create_mask = pe.MapNode(sct_seg.CreateMask(), name='create_mask', iterfield=['input_image', 'centerline_image'])
+    create_mask.inputs.size_in_mm = 35
     wf.connect(mean_dwi, 'mean_image', create_mask, 'input_image')
     wf.connect(initial_spine_segmentation, 'centerline_file', create_mask, 'centerline_image')
 
-    motion_correction = pe.Node(sct_dmri.MotionCorrection(), name='motion_correction')
-    wf.connect(input_node, 'dwi_image', motion_correction, 'dwi_image')
-    wf.connect(input_node, 'bvals', motion_correction, 'bvec')
-    wf.connect(input_node, 'bvecs', motion_correction, 'bval')
+    motion_correction = pe.MapNode(sct_dmri.MotionCorrection(), name='motion_correction',
+                                   iterfield=['dwi_image', 'bval', 'bvec', 'mask'])
+    wf.connect(input_node, 'dwi_file', motion_correction, 'dwi_image')
+    wf.connect(input_node, 'bval_file', motion_correction, 'bval')
+    wf.connect(input_node, 'bvec_file', motion_correction, 'bvec')
     wf.connect(create_mask, 'mask_file', motion_correction, 'mask')
 
-    # Re-segment the spine, then finish the DWI processing
-    spine_segmentation = pe.Node(sct_seg.DeepSeg(), name='spine_segmentation')
+    # Re-segment the spine on the mean of the corrected DWI, then finish the DWI processing
+    spine_segmentation = pe.MapNode(sct_seg.DeepSeg(), name='spine_segmentation', iterfield=['input_image'])
     spine_segmentation.inputs.contrast = 'dwi'
-    wf.connect(motion_correction, 'moco_dwi', spine_segmentation, 'input_image')
+    wf.connect(motion_correction, 'mean_moco_dwi', spine_segmentation, 'input_image')
+
+    if use_native_dti:
+        # Fits the tensor in-process, only around the cord segmentation
+        compute_dti = pe.MapNode(sct_dmri.ComputeDTINative(), name='compute_dti',
+                                 iterfield=['dwi_image', 'bval', 'bvec', 'mask'])
+        wf.connect(spine_segmentation, 'spine_segmentation', compute_dti, 'mask')
+    else:
+        compute_dti = pe.MapNode(sct_dmri.ComputeDTI(), name='compute_dti', iterfield=['dwi_image', 'bval', 'bvec'])
+    wf.connect(motion_correction, 'moco_dwi', compute_dti, 'dwi_image')
+    wf.connect(input_node, 'bval_file', compute_dti, 'bval')
+    wf.connect(input_node, 'bvec_file', compute_dti, 'bvec')
+
+    # Assumes the FOV is centered at the c3c4 disc, as in the MTR workflow
+    label_utils = pe.MapNode(sct_util.LabelUtils(), name='label_utils', iterfield=['input_image'])
+    label_utils.inputs.output_file = 'c3c4.nii.gz'
+    label_utils.inputs.create_seg_mid = 4
+    wf.connect(spine_segmentation, 'spine_segmentation', label_utils, 'input_image')
 
-    # sct_dmri_compute_dti
+    # The CSF is dark on the mean DWI, so it is registered as a T1 contrast
+    template_registration = pe.MapNode(sct_reg.RegisterToTemplate(), name='template_registration',
+                                       iterfield=['input_image', 'spine_segmentation', 'disc_labels'])
+    template_registration.inputs.contrast = 't1'
+    template_registration.inputs.reference = 'subject'
+    template_registration.inputs.param = 'step=1,type=seg,algo=centermassrot:step=2,type=seg,algo=bsplinesyn,slicewise=1'
+    wf.connect(motion_correction, 'mean_moco_dwi', template_registration, 'input_image')
+    wf.connect(spine_segmentation, 'spine_segmentation', template_registration, 'spine_segmentation')
+    wf.connect(label_utils, 'label_image', template_registration, 'disc_labels')
+
+    if use_native_warp:
+        # Only the cord and levels are needed for the metrics
+        warp_template = pe.MapNode(sct_reg.WarpTemplateNative(), name='warp_template',
+                                   iterfield=['destination_image', 'warping_field'])
+        warp_template.inputs.template_labels = ['cord', 'levels']
+    else:
+        warp_template = pe.MapNode(sct_reg.WarpTemplate(), name='warp_template',
+                                   iterfield=['destination_image', 'warping_field'])
+        warp_template.inputs.warp_white_matter = 0
+        warp_template.inputs.warp_spinal_levels = 0
+    wf.connect(motion_correction, 'mean_moco_dwi', warp_template, 'destination_image')
+    wf.connect(template_registration, 'warp_template2anat', warp_template, 'warping_field')
+
+    # Segmentation and template registration results can be reused from other runs on the same inputs
+    if cache_dir is not None:
+        cached_nodes = [spine_segmentation, template_registration]
+        if not use_native_warp:
+            cached_nodes.append(warp_template)
+        use_result_cache(cached_nodes, cache_dir, cache_size_gb)
+
+    # One suffix per run, the outputs of a single run keep the names without a run number
+    runs = ['_run%d' % (n + 1) for n in range(num_runs)] if num_runs > 1 else ['']
+
+    export_segmentation = pe.MapNode(sct_util.ExportImage(), name='export_segmentation',
+                                     iterfield=['in_file', 'out_file'])
+    export_segmentation.inputs.clobber = True
+    export_segmentation.inputs.out_file = [out_file_base + '_DTI' + run + '_seg.nii.gz' for run in runs]
+    wf.connect(warp_template, 'cord', export_segmentation, 'in_file')
+
+    metric_csvs = []
+    for metric in ['fa', 'md', 'ad', 'rd']:
+        # Per slice, per level and whole cord values of the metric
+        extract_metric = pe.MapNode(sct_util.ExtractMetricsNative(), name='extract_' + metric,
+                                    iterfield=['input_image', 'cord_file', 'levels_file'])
+        extract_metric.inputs.output_filename = metric.upper() + '_metrics.csv'
+        wf.connect(compute_dti, metric, extract_metric, 'input_image')
+        wf.connect(warp_template, 'cord', extract_metric, 'cord_file')
+        wf.connect(warp_template, 'levels', extract_metric, 'levels_file')
+
+        export_image = pe.MapNode(sct_util.ExportImage(), name='export_' + metric,
+                                  iterfield=['in_file', 'out_file'])
+        export_image.inputs.clobber = True
+        export_image.inputs.out_file = [out_file_base + '_DTI' + run + '_' + metric.upper() + '.nii.gz'
+                                        for run in runs]
+        wf.connect(compute_dti, metric, export_image, 'in_file')
+
+        export_metric = pe.MapNode(io.ExportFile(), name='export_' + metric + '_metrics',
+                                   iterfield=['in_file', 'out_file'])
+        export_metric.inputs.check_extension = True
+        export_metric.inputs.clobber = True
+        export_metric.inputs.out_file = [out_file_base + '_DTI' + run + '_' + metric.upper() + '_metrics.csv'
+                                         for run in runs]
+        wf.connect(extract_metric, 'output_csv', export_metric, 'in_file')
+        metric_csvs.append((extract_metric, 'output_csv', metric.upper(), list(range(1, num_runs + 1))))
+
+    if results_store is not None:
+        add_store_results(wf, results_store, patient_id, scan_id, 'dti', metric_csvs)
+
+    apply_resource_hints(wf)
+
+    return wf
 
 
 def create_spinalcord_mtr_workflow(scan_directory, patient_id=None, scan_id=None,
-                                   compute_csa=False, compute_avggmwm=False, use_iacl_struct=False):
-    name = 'SCT_MTR'
+                                   compute_csa=False, compute_avggmwm=False, use_iacl_struct=False,
+                                   use_native_mtr=False, use_native_metrics=False, use_native_warp=False,
+                                   use_native_slicereg=False, crop_margin_mm=None, cache_dir=None,
+                                   cache_size_gb=None, results_store=None, name=None):
     vert = '3:4'  # This is consistent with what I provided Tony Kang for his RIS spinal cord study
     # TODO: Add corrected MTR
-    root_dir = scan_directory
-    if use_iacl_struct is True:
-        if patient_id is not None and scan_id is not None:
-            root_dir = os.path.join(root_dir, patient_id, 'pipeline')
-            name += '_' + scan_id
-        else:
-            raise ValueError('Need to provide a patient_id and scan_id to use the IACL folder structure')
-    else:
-        if patient_id is not None:
-            scan_folder = patient_id + '_' + scan_id if scan_id is not None else patient_id
-            root_dir = (os.path.join(root_dir, scan_folder))
-        # else just use the scan_directory
+    name, root_dir, out_file_base = _subject_directories('SCT_MTR', scan_directory, patient_id, scan_id,
+                                                         use_iacl_struct, name)
 
     wf = pe.Workflow(name, root_dir)
 
@@ -158,84 +336,136 @@ def create_spinalcord_mtr_workflow(scan_directory, patient_id=None, scan_id=None
     wf.connect(input_node, 'mton_file', create_mask, 'input_image')
     wf.connect(spine_segmentation, 'spine_segmentation', create_mask, 'centerline_image')
 
-    register_multimodal = pe.Node(sct_reg.RegisterMultimodal(), 'register_mtoff_to_mton')
-    register_multimodal.inputs.param = 'step=1,type=im,algo=slicereg,metric=CC'
+    mton = (input_node, 'mton_file')
+    mtoff = (input_node, 'mtoff_file')
+    mask = (create_mask, 'mask_file')
+    segmentation = (spine_segmentation, 'spine_segmentation')
+    if crop_margin_mm is not None:
+        # The registrations, MTR and metrics run on the images cut around the cord mask (the neck and background
+        # are most of the field of view), the exported images are put back in the native field of view
+        crops = []
+        for crop_name, source in [('crop_mton', mton), ('crop_mtoff', mtoff), ('crop_mask', mask),
+                                  ('crop_segmentation', segmentation)]:
+            crop = pe.Node(sct_util.CropToMask(), crop_name)
+            crop.inputs.margin_mm = crop_margin_mm
+            wf.connect(source[0], source[1], crop, 'input_image')
+            wf.connect(create_mask, 'mask_file', crop, 'mask')
+            crops.append((crop, 'output_image'))
+        mton, mtoff, mask, segmentation = crops
+
+    def native(name, source):
+        # (node, field) of source in the native field of view
+        if crop_margin_mm is None:
+            return source
+        uncrop = pe.Node(sct_util.UncropImage(), name)
+        wf.connect(source[0], source[1], uncrop, 'input_image')
+        wf.connect(input_node, 'mton_file', uncrop, 'reference_image')
+        return uncrop, 'output_image'
+
+    if use_native_slicereg:
+        # Same per slice translations as slicereg, estimated and applied in-process
+        register_multimodal = pe.Node(sct_reg.RegisterSlicewiseNative(), 'register_mtoff_to_mton')
+    else:
+        register_multimodal = pe.Node(sct_reg.RegisterMultimodal(), 'register_mtoff_to_mton')
+        register_multimodal.inputs.param = 'step=1,type=im,algo=slicereg,metric=CC'
     register_multimodal.inputs.interpolation = 'spline'
-    wf.connect(input_node, 'mtoff_file', register_multimodal, 'input_image')
-    wf.connect(input_node, 'mton_file', register_multimodal, 'destination_image')
-    wf.connect(create_mask, 'mask_file', register_multimodal, 'mask')
+    wf.connect(mtoff[0], mtoff[1], register_multimodal, 'input_image')
+    wf.connect(mton[0], mton[1], register_multimodal, 'destination_image')
+    wf.connect(mask[0], mask[1], register_multimodal, 'mask')
 
-    compute_mtr = pe.Node(sct_util.ComputeMTR(), 'compute_mtr')
+    if use_native_mtr:
+        # Computes the MTR in-process instead of calling sct_compute_mtr
+        compute_mtr = pe.Node(sct_util.ComputeMTRNative(), 'compute_mtr')
+    else:
+        compute_mtr = pe.Node(sct_util.ComputeMTR(), 'compute_mtr')
     wf.connect(register_multimodal, 'warped_input_image', compute_mtr, 'mt_off_image')
-    wf.connect(input_node, 'mton_file', compute_mtr, 'mt_on_image')
+    wf.connect(mton[0], mton[1], compute_mtr, 'mt_on_image')
 
     # Assumes the FOV is centered at the c3c4 disc
     label_utils = pe.Node(sct_util.LabelUtils(), 'label_utils')
     label_utils.inputs.output_file = 'c3c4.nii.gz'
     label_utils.inputs.create_seg_mid = 4
-    wf.connect(spine_segmentation, 'spine_segmentation', label_utils, 'input_image')
+    wf.connect(segmentation[0], segmentation[1], label_utils, 'input_image')
 
     template_registration = pe.Node(sct_reg.RegisterToTemplate(), 'template_registration')
     template_registration.inputs.reference = 'subject'
     template_registration.inputs.param = 'step=1,type=seg,algo=centermassrot:step=2,type=seg,algo=bsplinesyn,slicewise=1'
     # Parameters come from the SCT MT example
-    wf.connect(input_node, 'mton_file', template_registration, 'input_image')
-    wf.connect(spine_segmentation, 'spine_segmentation', template_registration, 'spine_segmentation')
+    wf.connect(mton[0], mton[1], template_registration, 'input_image')
+    wf.connect(segmentation[0], segmentation[1], template_registration, 'spine_segmentation')
     wf.connect(label_utils, 'label_image', template_registration, 'disc_labels')
 
-    warp_template = pe.Node(sct_reg.WarpTemplate(), 'warp_template')
-    warp_template.inputs.warp_white_matter = 0
-    warp_template.inputs.warp_spinal_levels = 0
-    wf.connect(input_node,'mton_file', warp_template,'destination_image')
+    if use_native_warp:
+        # Only warps the template files used below instead of the whole PAM50 atlas
+        warp_template = pe.Node(sct_reg.WarpTemplateNative(), 'warp_template')
+        warp_template.inputs.template_labels = ['cord', 'levels', 'gm', 'wm'] if compute_avggmwm else ['cord', 'levels']
+    else:
+        warp_template = pe.Node(sct_reg.WarpTemplate(), 'warp_template')
+        warp_template.inputs.warp_white_matter = 0
+        warp_template.inputs.warp_spinal_levels = 0
+    wf.connect(mton[0], mton[1], warp_template, 'destination_image')
     wf.connect(template_registration, 'warp_template2anat', warp_template,'warping_field')
 
+    # Segmentation and template registration results can be reused from other runs on the same inputs
+    if cache_dir is not None:
+        cached_nodes = [spine_segmentation, template_registration]
+        if not use_native_warp:
+            cached_nodes.append(warp_template)
+        use_result_cache(cached_nodes, cache_dir, cache_size_gb)
+
     #TODO: C2/C4 points
     #TODO: Template registration?
-    extract_mtr = pe.Node(sct_util.ExtractMetric(), 'extract_mtr')
-    extract_mtr.inputs.vertebrae = vert
-    extract_mtr.inputs.per_slice = 1
-    wf.connect(compute_mtr, 'mtr_image', extract_mtr, 'input_image')
-    wf.connect(warp_template, 'levels', extract_mtr, 'vertebrae_image')
-    wf.connect(warp_template, 'cord', extract_mtr, 'label_image')
+    if use_native_metrics:
+        # Per slice, per level and whole ROI metrics for the cord (and GM/WM) in one in-process pass
+        extract_mtr = pe.Node(sct_util.ExtractMetricsNative(), 'extract_mtr')
+        extract_mtr.inputs.vertebrae = vert
+        wf.connect(compute_mtr, 'mtr_image', extract_mtr, 'input_image')
+        wf.connect(warp_template, 'levels', extract_mtr, 'levels_file')
+        wf.connect(warp_template, 'cord', extract_mtr, 'cord_file')
+        if compute_avggmwm:
+            wf.connect(warp_template, 'gm', extract_mtr, 'gm_file')
+            wf.connect(warp_template, 'wm', extract_mtr, 'wm_file')
+    else:
+        extract_mtr = pe.Node(sct_util.ExtractMetric(), 'extract_mtr')
+        extract_mtr.inputs.vertebrae = vert
+        extract_mtr.inputs.per_slice = 1
+        wf.connect(compute_mtr, 'mtr_image', extract_mtr, 'input_image')
+        wf.connect(warp_template, 'levels', extract_mtr, 'vertebrae_image')
+        wf.connect(warp_template, 'cord', extract_mtr, 'label_image')
 
     if compute_csa:
-        process_seg = pe.Node(sct_util.ProcessSeg(), 'process_seg')
+        if use_native_metrics:
+            # Per slice CSA computed in-process from the warped cord and levels
+            process_seg = pe.Node(sct_util.ProcessSegNative(), 'process_seg')
+        else:
+            process_seg = pe.Node(sct_util.ProcessSeg(), 'process_seg')
         process_seg.inputs.vertebrae = vert
         process_seg.inputs.per_slice = 1
         wf.connect(warp_template, 'cord', process_seg, 'input_image')
         wf.connect(warp_template, 'levels', process_seg, 'vertebrae_image')
 
-    if compute_avggmwm:
+    if compute_avggmwm and not use_native_metrics:
         compute_avg_gmwm_mtr = pe.Node(sct_util.ComputeAvgGMWMMTR(), 'compute_avg_gmwm_mtr')
         wf.connect(compute_mtr, 'mtr_image', compute_avg_gmwm_mtr, 'mtr_file')
         wf.connect(warp_template, 'gm', compute_avg_gmwm_mtr, 'gm_file')
         wf.connect(warp_template, 'wm', compute_avg_gmwm_mtr, 'wm_file')
 
-    # Set up base filename for copying outputs
-    if use_iacl_struct:
-        out_file_base = os.path.join(scan_directory, patient_id, scan_id, patient_id + '_' + scan_id + '_SPINE')
-    else:
-        if patient_id is not None:
-            out_file_base = patient_id + '_' + scan_id if scan_id is not None else patient_id
-        else:
-            out_file_base = 'out'
-        out_file_base = os.path.join(scan_directory, out_file_base + '_SPINE')
-
     # Use the template warped cord segmentation as the final spine segmentation
     # I've found this to be a smoother result IF the registration is successful
     # Whereas the DeepSeg result is boxier, but may be better if the template
     # can't register to the spine (this happens more with T2 spines)
-    export_segmentation = pe.Node(io.ExportFile(), name='export_segmentation')
-    export_segmentation.inputs.check_extension = True
+    export_segmentation = pe.Node(sct_util.ExportImage(), name='export_segmentation')
     export_segmentation.inputs.clobber = True
     export_segmentation.inputs.out_file = out_file_base + '_seg.nii.gz'
-    wf.connect(warp_template, 'cord', export_segmentation, 'in_file')
+    cord = native('uncrop_segmentation', (warp_template, 'cord'))
+    wf.connect(cord[0], cord[1], export_segmentation, 'in_file')
 
-    export_mtr = pe.Node(io.ExportFile(), name='export_mtr')
-    export_mtr.inputs.check_extension = True
+    # The native MTR follows the intermediate format of the pipeline, the export always writes .nii.gz
+    export_mtr = pe.Node(sct_util.ExportImage(), name='export_mtr')
     export_mtr.inputs.clobber = True
     export_mtr.inputs.out_file = out_file_base + '_MTR.nii.gz'
-    wf.connect(compute_mtr, 'mtr_image', export_mtr, 'in_file')
+    mtr = native('uncrop_mtr', (compute_mtr, 'mtr_image'))
+    wf.connect(mtr[0], mtr[1], export_mtr, 'in_file')
 
     export_mton = pe.Node(io.ExportFile(), name='export_mton')
     export_mton.inputs.check_extension = True
@@ -243,16 +473,20 @@ def create_spinalcord_mtr_workflow(scan_directory, patient_id=None, scan_id=None
     export_mton.inputs.out_file = out_file_base + '_MT_ON.nii.gz'
     wf.connect(input_node, 'mton_file', export_mton, 'in_file')
 
-    export_mtoff = pe.Node(io.ExportFile(), name='export_mtoff')
-    export_mtoff.inputs.check_extension = True
+    # The uncropped (or natively registered) MT off follows the intermediate format, as the MTR
+    export_mtoff = pe.Node(sct_util.ExportImage(), name='export_mtoff')
     export_mtoff.inputs.clobber = True
     export_mtoff.inputs.out_file = out_file_base + '_MT_OFF_reg.nii.gz'
-    wf.connect(register_multimodal, 'warped_input_image', export_mtoff, 'in_file')
+    mtoff_reg = native('uncrop_mtoff', (register_multimodal, 'warped_input_image'))
+    wf.connect(mtoff_reg[0], mtoff_reg[1], export_mtoff, 'in_file')
 
     export_mtr_metric = pe.Node(io.ExportFile(), name='export_mtr_metric')
     export_mtr_metric.inputs.check_extension = True
     export_mtr_metric.inputs.clobber = True
-    export_mtr_metric.inputs.out_file = out_file_base + '_MTR_perslice.csv'
+    if use_native_metrics:
+        export_mtr_metric.inputs.out_file = out_file_base + '_MTR_metrics.csv'
+    else:
+        export_mtr_metric.inputs.out_file = out_file_base + '_MTR_perslice.csv'
     wf.connect(extract_mtr, 'output_csv', export_mtr_metric, 'in_file')
 
     if compute_csa:
@@ -262,13 +496,21 @@ def create_spinalcord_mtr_workflow(scan_directory, patient_id=None, scan_id=None
         export_csa_metric.inputs.out_file = out_file_base + '_CSA_perslice.csv'
         wf.connect(process_seg, 'output_csv', export_csa_metric, 'in_file')
 
-    if compute_avggmwm:
+    if compute_avggmwm and not use_native_metrics:
         export_avggmwm = pe.Node(io.ExportFile(), name='export_avggmwm')
         export_avggmwm.inputs.check_extension = True
         export_avggmwm.inputs.clobber = True
         export_avggmwm.inputs.out_file = out_file_base + '_avg_GM_WM_MTR.csv'
         wf.connect(compute_avg_gmwm_mtr, 'output_csv', export_avggmwm, 'in_file')
 
+    if results_store is not None:
+        metric_csvs = [(extract_mtr, 'output_csv', 'MTR', None)]
+        if compute_csa:
+            metric_csvs.append((process_seg, 'output_csv', 'CSA', None))
+        if compute_avggmwm and not use_native_metrics:
+            metric_csvs.append((compute_avg_gmwm_mtr, 'output_csv', 'MTR', None))
+        add_store_results(wf, results_store, patient_id, scan_id, 'mtr', metric_csvs)
+
     #if True:
         #Write segmentation images to disk
 
@@ -277,6 +519,83 @@ def create_spinalcord_mtr_workflow(scan_directory, patient_id=None, scan_id=None
 
         #Write PDF with images to disk
 
+    apply_resource_hints(wf)
+
     return wf
 
 
+def get_iacl_mt_files(scan_directory, patient_id, scan_id):
+    raw_dir = os.path.join(scan_directory, patient_id, scan_id, 'raw')
+    mton_file = os.path.join(raw_dir, patient_id + '_' + scan_id + '_SPINE_MT.nii.gz')
+    mtoff_file = os.path.join(raw_dir, patient_id + '_' + scan_id + '_SPINE_MT_OFF.nii.gz')
+    return os.path.abspath(mton_file), os.path.abspath(mtoff_file)
+
+
+def read_cohort_manifest(manifest_file):
+    # Manifest is a CSV/TSV with a header row containing patient_id, scan_id, mton_file and mtoff_file
+    # Relative image paths are resolved against the folder containing the manifest
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    with open(manifest_file, newline='') as f:
+        if manifest_file.endswith('.tsv'):
+            delimiter = '\t'
+        else:
+            delimiter = csv.Sniffer().sniff(f.read(4096), delimiters=',\t;').delimiter
+            f.seek(0)
+        reader = csv.DictReader(f, delimiter=delimiter)
+        subjects = []
+        for row in reader:
+            row = {k.strip(): v.strip() for k, v in row.items() if k is not None and v is not None}
+            if not row.get('patient_id'):
+                raise ValueError('Manifest row %d is missing a patient_id' % (reader.line_num - 1))
+            subject = {'patient_id': row['patient_id'],
+                       'scan_id': row.get('scan_id') or None}
+            for a in ['mton_file', 'mtoff_file']:
+                if row.get(a):
+                    subject[a] = os.path.join(manifest_dir, os.path.expanduser(row[a]))
+                else:
+                    subject[a] = None
+            subjects.append(subject)
+
+    return subjects
+
+
+def create_spinalcord_mtr_cohort_workflow(scan_directory, subjects, use_iacl_struct=False, name='SCT_MTR_cohort',
+                                          **kwargs):
+    # Every subject becomes a sub-workflow of a single meta-workflow so that one scheduler (and one
+    # MultiProc pool) runs the whole cohort. Nodes only depend on nodes of the same subject, so a crash
+    # only stops the downstream nodes of that subject and the rest of the batch keeps running.
+    # Other keyword arguments are passed on to create_spinalcord_mtr_workflow. Each subject runs in the working
+    # directory it has in a single subject run (see CohortWorkflow).
+    wf = CohortWorkflow(name, scan_directory)
+    wf.config['execution']['stop_on_first_crash'] = False
+
+    subject_names = set()
+    for subject in subjects:
+        patient_id = subject['patient_id']
+        scan_id = subject.get('scan_id')
+        subject_name = patient_id + '_' + scan_id if scan_id is not None else patient_id
+        subject_name = re.sub(r'[^\w-]', '_', subject_name)
+        if subject_name in subject_names:
+            raise ValueError('Subject %s appears more than once in the cohort' % subject_name)
+        subject_names.add(subject_name)
+
+        mton_file = subject.get('mton_file')
+        mtoff_file = subject.get('mtoff_file')
+        if use_iacl_struct and (mton_file is None or mtoff_file is None):
+            if scan_id is None:
+                raise ValueError('Need to provide a patient_id and scan_id to use the IACL folder structure')
+            mton_file, mtoff_file = get_iacl_mt_files(scan_directory, patient_id, scan_id)
+        if mton_file is None or mtoff_file is None:
+            raise ValueError('Subject %s needs both an MT on and MT off file' % subject_name)
+
+        # Named after the subject, so every subject runs in its own folders of the cohort workflow
+        subject_wf = create_spinalcord_mtr_workflow(scan_directory, patient_id, scan_id,
+                                                    use_iacl_struct=use_iacl_struct, name=subject_name, **kwargs)
+        single_name, root_dir, _ = _subject_directories('SCT_MTR', scan_directory, patient_id, scan_id,
+                                                        use_iacl_struct)
+        wf.subject_directories[subject_name] = os.path.join(root_dir, single_name)
+        subject_wf.inputs.input_node.mton_file = os.path.abspath(mton_file)
+        subject_wf.inputs.input_node.mtoff_file = os.path.abspath(mtoff_file)
+        wf.add_nodes([subject_wf])
+
+    return wf
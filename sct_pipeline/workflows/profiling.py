@@ -0,0 +1,200 @@
+import os
+import csv
+import json
+import time
+
+import nipype.pipeline.engine as pe
+
+from sct_pipeline.interfaces.image import image_info
+
+_FIELDS = ['fullname', 'name', 'interface', 'status', 'start', 'end', 'wall_time_s', 'cpu_time_s',
+           'peak_rss_gb', 'bytes_read', 'bytes_written', 'input_voxels', 'mapnode']
+
+# Nipype bookkeeping files that should not be counted as node outputs
+_BOOKKEEPING = ('_report', '_inputs.pklz', '_node.pklz', 'result_', 'command.txt', '.proc-')
+
+
+def _file_sizes(value, seen):
+    size = 0
+    values = value if isinstance(value, (list, tuple)) else [value]
+    for v in values:
+        if isinstance(v, (list, tuple)):
+            size += _file_sizes(v, seen)
+        elif isinstance(v, str) and v not in seen and os.path.isfile(v):
+            seen.add(v)
+            size += os.path.getsize(v)
+    return size
+
+
+def image_voxels(value):
+    # Number of voxels (all volumes) of the largest NIfTI image in value, from the header only
+    values = value if isinstance(value, (list, tuple)) else [value]
+    voxels = 0
+    for v in values:
+        if isinstance(v, (list, tuple)):
+            voxels = max(voxels, image_voxels(v))
+        elif isinstance(v, str) and v.endswith(('.nii', '.nii.gz')) and os.path.isfile(v):
+            shape = image_info(v).shape
+            count = 1
+            for s in shape:
+                count *= s
+            voxels = max(voxels, count)
+    return voxels
+
+
+def record_name(name):
+    # MapNode subnodes are called _<name><index>
+    return name.lstrip('_').rstrip('0123456789') if name.startswith('_') else name
+
+
+def _dir_size(directory):
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith('_report')]
+        size += sum(os.path.getsize(os.path.join(root, f)) for f in files
+                    if not f.startswith(_BOOKKEEPING) and os.path.isfile(os.path.join(root, f)))
+    return size
+
+
+def _cpu_time(runtime):
+    # Integrates the CPU usage sampled by the nipype resource monitor (in percent of one core)
+    prof = getattr(runtime, 'prof_dict', None)
+    if not prof or len(prof.get('time', [])) < 2:
+        return None
+    t, cpus = prof['time'], prof['cpus']
+    return sum((t[i + 1] - t[i]) * (cpus[i + 1] + cpus[i]) / 200.0 for i in range(len(t) - 1))
+
+
+def _num_subnodes(node):
+    try:
+        return node.num_subnodes()
+    except Exception:
+        return 0
+
+
+class WorkflowProfiler(object):
+    # Status callback for the nipype plugins that records wall time, CPU time, peak RSS and I/O volume
+    # for every node. CPU time and peak RSS need the nipype resource monitor (and psutil).
+
+    def __init__(self, workflow, subnode_jobs=True):
+        # subnode_jobs: the plugin runs the subnodes of MapNodes as separate jobs (MultiProc, not Linear)
+        self.workflow = workflow
+        self.subnode_jobs = subnode_jobs
+        self.records = []
+        self._start_times = {}
+        self._wall_start = time.time()
+
+    def __call__(self, node, status):
+        if status == 'start':
+            self._start_times[node.fullname] = time.time()
+            return
+
+        end = time.time()
+        start = self._start_times.pop(node.fullname, end)
+        # MapNode subnodes get their own records when they are run as separate jobs (MultiProc only does so for
+        # more than one subnode), the parent then only keeps its wall time
+        is_mapnode = isinstance(node, pe.MapNode) and self.subnode_jobs and _num_subnodes(node) > 1
+        record = dict(fullname=node.fullname, name=node.name, interface=node.interface.__class__.__name__,
+                      status='ok' if status == 'end' else 'crashed', start=start, end=end,
+                      wall_time_s=end - start, cpu_time_s=None, peak_rss_gb=None, bytes_read=None,
+                      bytes_written=None, input_voxels=None, mapnode=is_mapnode)
+
+        if not is_mapnode:
+            try:
+                # MapNodes that ran their subnodes themselves have one runtime per subnode
+                runtimes = node.result.runtime if isinstance(node.result.runtime, list) else [node.result.runtime]
+                cpu_times = [_cpu_time(runtime) for runtime in runtimes]
+                peaks = [getattr(runtime, 'mem_peak_gb', None) for runtime in runtimes]
+                record['cpu_time_s'] = sum(cpu_times) if None not in cpu_times else None
+                record['peak_rss_gb'] = max(peaks) if None not in peaks else None
+            except Exception:
+                pass
+            try:
+                record['bytes_read'] = _file_sizes(list(node.inputs.get().values()), set())
+                record['bytes_written'] = _dir_size(node.output_dir())
+            except OSError:
+                pass
+            try:
+                # Size of the node inputs, used to scale the cost model of planning.py
+                record['input_voxels'] = image_voxels(list(node.inputs.get().values()))
+            except Exception:
+                pass
+        self.records.append(record)
+
+    def critical_path(self):
+        # Longest chain of dependent nodes weighted by their wall time
+        import networkx as nx
+
+        wall_times = {r['fullname']: r['wall_time_s'] for r in self.records}
+        graph = self.workflow._create_flat_graph()
+        best = {}
+        for node in nx.topological_sort(graph):
+            length = wall_times.get(node.fullname, 0.0)
+            preds = [best[p] for p in graph.predecessors(node)]
+            prev = max(preds, key=lambda b: b[0]) if preds else (0.0, [])
+            best[node] = (prev[0] + length, prev[1] + [node.fullname])
+        if not best:
+            return 0.0, []
+        return max(best.values(), key=lambda b: b[0])
+
+    def summary(self):
+        return summarize_records(self.records)
+
+    def write_report(self, prefix):
+        os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+        path_time, path_nodes = self.critical_path()
+        report = {'workflow': self.workflow.name,
+                  'wall_time_s': time.time() - self._wall_start,
+                  'critical_path': {'wall_time_s': path_time, 'nodes': path_nodes},
+                  'summary': self.summary(),
+                  'nodes': self.records}
+        with open(prefix + '.json', 'w') as f:
+            json.dump(report, f, indent=2)
+        with open(prefix + '.csv', 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+        lines = ['Total wall time: %.1fs' % report['wall_time_s'],
+                 'Critical path (%.1fs):' % path_time]
+        lines += ['  %-60s %8.1fs' % (n, next((r['wall_time_s'] for r in self.records if r['fullname'] == n), 0))
+                  for n in path_nodes]
+        lines.append('Slowest nodes (mean wall time):')
+        for name, s in sorted(report['summary'].items(), key=lambda i: -i[1]['mean_wall_time_s'])[:10]:
+            lines.append('  %-40s %8.1fs x%d' % (name, s['mean_wall_time_s'], s['count']))
+        with open(prefix + '_summary.txt', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return '\n'.join(lines)
+
+
+def summarize_records(records):
+    # Groups node records by node name (e.g. the same node across all subjects of a cohort)
+    summary = {}
+    for r in records:
+        if r['mapnode']:
+            continue
+        name = record_name(r['name'])
+        s = summary.setdefault(name, {'count': 0, 'total_wall_time_s': 0.0, 'max_wall_time_s': 0.0,
+                                      'total_cpu_time_s': 0.0, 'max_peak_rss_gb': 0.0, 'total_bytes_read': 0,
+                                      'total_bytes_written': 0, 'crashed': 0})
+        s['count'] += 1
+        s['crashed'] += r['status'] != 'ok'
+        s['total_wall_time_s'] += r['wall_time_s']
+        s['max_wall_time_s'] = max(s['max_wall_time_s'], r['wall_time_s'])
+        s['total_cpu_time_s'] += r['cpu_time_s'] or 0.0
+        s['max_peak_rss_gb'] = max(s['max_peak_rss_gb'], r['peak_rss_gb'] or 0.0)
+        s['total_bytes_read'] += r['bytes_read'] or 0
+        s['total_bytes_written'] += r['bytes_written'] or 0
+    for s in summary.values():
+        s['mean_wall_time_s'] = s['total_wall_time_s'] / s['count']
+        s['mean_cpu_time_s'] = s['total_cpu_time_s'] / s['count']
+    return summary
+
+
+def summarize_profiles(report_files):
+    # Aggregates the JSON reports of several runs (e.g. one per subject) into one per-node summary
+    records = []
+    for report_file in report_files:
+        with open(report_file) as f:
+            records += json.load(f)['nodes']
+    return summarize_records(records)
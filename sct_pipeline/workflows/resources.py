@@ -0,0 +1,142 @@
+import json
+
+from nipype.interfaces.base import isdefined
+
+try:
+    from nipype.utils.ram_estimator import RamEstimator
+except ImportError:  # nipype < 1.11, only the static mem_gb estimates are used
+    RamEstimator = None
+
+'''
+Scheduling hints for the MultiProc plugin. Every interface gets a number of threads and a memory estimate
+so that heavy nodes (sct_deepseg_sc, SyN registrations) are not packed together on the same cores/RAM
+as if they were trivial one core jobs.
+
+multipliers are bytes per voxel of the given inputs, and are used (with nipype >= 1.11) to scale the
+memory estimate with the size of the images once the inputs are known. overhead_gb is the fixed cost
+(interpreter, models, template). Estimates are conservative starting points, they can be replaced with
+measured values using apply_measured_memory and the reports written by --profile.
+'''
+
+RESOURCE_HINTS = {
+    # SCT commands
+    'DeepSeg': dict(n_procs=2, mem_gb=2.5, overhead_gb=1.5, multipliers={'input_image': 48}),
+    'PropSeg': dict(n_procs=1, mem_gb=1.0, overhead_gb=0.5, multipliers={'input_image': 32}),
+    'LabelVertebrae': dict(n_procs=1, mem_gb=2.0, overhead_gb=1.0, multipliers={'input_image': 48}),
+    'CreateMask': dict(n_procs=1, mem_gb=0.5, overhead_gb=0.4, multipliers={'input_image': 16}),
+    'RegisterToTemplate': dict(n_procs=4, mem_gb=4.0, overhead_gb=2.5, multipliers={'input_image': 96}),
+    'WarpTemplate': dict(n_procs=2, mem_gb=2.5, overhead_gb=1.0, multipliers={'destination_image': 64}),
+    'RegisterMultimodal': dict(n_procs=2, mem_gb=1.5, overhead_gb=0.5,
+                               multipliers={'input_image': 48, 'destination_image': 48}),
+    'StraightenSpinalcord': dict(n_procs=2, mem_gb=2.5, overhead_gb=1.0, multipliers={'input_image': 96}),
+    'ApplyTransform': dict(n_procs=1, mem_gb=1.0, overhead_gb=0.5,
+                           multipliers={'input_image': 32, 'destination_image': 32}),
+    'GetCenterline': dict(n_procs=1, mem_gb=0.5, overhead_gb=0.4, multipliers={'input_image': 16}),
+    'ComputeMTR': dict(n_procs=1, mem_gb=0.6, overhead_gb=0.4,
+                       multipliers={'mt_on_image': 16, 'mt_off_image': 16}),
+    'ExtractMetric': dict(n_procs=1, mem_gb=0.8, overhead_gb=0.5, multipliers={'input_image': 32}),
+    'ProcessSeg': dict(n_procs=1, mem_gb=0.8, overhead_gb=0.5, multipliers={'input_image': 32}),
+    'LabelUtils': dict(n_procs=1, mem_gb=0.5, overhead_gb=0.4, multipliers={'input_image': 16}),
+    'Mean': dict(n_procs=1, mem_gb=1.0, overhead_gb=0.4, multipliers={'input_image': 16}),
+    'MotionCorrection': dict(n_procs=2, mem_gb=3.0, overhead_gb=1.0, multipliers={'dwi_image': 24}),
+    'ComputeDTI': dict(n_procs=1, mem_gb=2.0, overhead_gb=0.5, multipliers={'dwi_image': 24}),
+    # In-process interfaces
+    'ComputeMTRNative': dict(n_procs=1, mem_gb=0.3, overhead_gb=0.2,
+                             multipliers={'mt_on_image': 8, 'mt_off_image': 8}),
+    'WarpTemplateNative': dict(n_procs=1, mem_gb=1.5, overhead_gb=1.0, multipliers={'warping_field': 24}),
+    'ApplyTransformsNative': dict(n_procs=1, mem_gb=1.0, overhead_gb=0.3,
+                                  multipliers={'input_images': 8, 'reference_image': 24}),
+    'ExtractMetricsNative': dict(n_procs=1, mem_gb=0.5, overhead_gb=0.2, multipliers={'input_image': 16}),
+    'RegisterSlicewiseNative': dict(n_procs=1, mem_gb=0.8, overhead_gb=0.3,
+                                    multipliers={'input_image': 40, 'destination_image': 24}),
+    'ComputeDTINative': dict(n_procs=1, mem_gb=0.6, overhead_gb=0.3, multipliers={'dwi_image': 2, 'mask': 4}),
+    'ProcessSegNative': dict(n_procs=1, mem_gb=0.4, overhead_gb=0.2,
+                             multipliers={'input_image': 12, 'vertebrae_image': 4}),
+    'CropToMask': dict(n_procs=1, mem_gb=0.5, overhead_gb=0.2, multipliers={'input_image': 8, 'mask': 8}),
+    'UncropImage': dict(n_procs=1, mem_gb=0.5, overhead_gb=0.2, multipliers={'reference_image': 8}),
+    'ComputeAvgGMWMMTR': dict(n_procs=1, mem_gb=0.5, overhead_gb=0.2,
+                              multipliers={'mtr_file': 8, 'gm_file': 8, 'wm_file': 8}),
+    'GenerateTemplate': dict(n_procs=1, mem_gb=1.0, overhead_gb=0.2, multipliers={'input_file': 8}),
+    'ThresholdLabels': dict(n_procs=1, mem_gb=0.5, overhead_gb=0.2),
+    'LabelFusion': dict(n_procs=1, mem_gb=2.0, overhead_gb=0.3, multipliers={'images': 4}),
+    'LabelFusionNative': dict(n_procs=1, mem_gb=0.5, overhead_gb=0.2),
+    # ANTs/FSL
+    'Registration': dict(n_procs=2, mem_gb=1.5, overhead_gb=0.5,
+                         multipliers={'fixed_image': 24, 'moving_image': 24}),
+    'Registration_SyN': dict(n_procs=4, mem_gb=4.0, overhead_gb=1.0,
+                             multipliers={'fixed_image': 96, 'moving_image': 96}),
+    'ApplyTransforms': dict(n_procs=1, mem_gb=0.8, overhead_gb=0.3,
+                            multipliers={'input_image': 16, 'reference_image': 16}),
+    'Merge': dict(n_procs=1, mem_gb=2.0, overhead_gb=0.2, multipliers={'in_files': 8}),
+    # Bookkeeping nodes
+    'IdentityInterface': dict(n_procs=1, mem_gb=0.05),
+    'Select': dict(n_procs=1, mem_gb=0.05),
+    'ExportFile': dict(n_procs=1, mem_gb=0.05),
+    'ExportImage': dict(n_procs=1, mem_gb=0.1),
+}
+
+# Environment variables used by ITK/ANTs and the numerical libraries used by SCT
+THREAD_VARIABLES = ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                    'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def _hint_key(node):
+    key = node.interface.__class__.__name__
+    if key == 'Merge' and node.interface.__class__.__module__.startswith('nipype.interfaces.utility'):
+        return 'IdentityInterface'
+    if key == 'Registration':
+        transforms = node.inputs.transforms
+        if isinstance(transforms, list) and any(t in ['SyN', 'BSplineSyN'] for t in transforms):
+            return 'Registration_SyN'
+    return key
+
+
+def set_node_threads(node, n_procs):
+    # ANTs interfaces get num_threads from n_procs, command line tools get it from the environment
+    node.n_procs = n_procs
+    # hasattr would add the trait to the dynamic input specs of MapNodes, and trait() returns a generic
+    # trait for any name once the spec has been copied (e.g. after the workflow was run)
+    if 'environ' in node.inputs.trait_names():
+        environ = dict(node.inputs.environ) if isdefined(node.inputs.environ) else {}
+        environ.update({v: str(n_procs) for v in THREAD_VARIABLES})
+        node.inputs.environ = environ
+
+
+def apply_resource_hints(wf, hints=None):
+    # Sets n_procs, mem_gb and (where available) a ram estimator on every node of the workflow
+    hints = hints if hints is not None else RESOURCE_HINTS
+    for node in wf._get_all_nodes():
+        hint = hints.get(_hint_key(node))
+        if hint is None:
+            continue
+        set_node_threads(node, hint['n_procs'])
+        node._mem_gb = hint['mem_gb']
+        if RamEstimator is not None and hint.get('multipliers'):
+            node.ram_estimator = RamEstimator(input_multipliers=hint['multipliers'],
+                                              overhead_gb=hint.get('overhead_gb', 0.3),
+                                              min_gb=hint.get('overhead_gb', 0.3),
+                                              max_gb=max(hint['mem_gb'] * 4, 8.0))
+
+
+def limit_resources(wf, num_threads, memory_gb=None):
+    # Makes sure no node asks for more threads (or memory) than the pool has, which would otherwise
+    # start more threads than there are cores or stop the scheduler from ever running the node
+    for node in wf._get_all_nodes():
+        if node.n_procs > num_threads:
+            set_node_threads(node, num_threads)
+        if memory_gb is not None and node.mem_gb > memory_gb:
+            node._mem_gb = memory_gb
+
+
+def apply_measured_memory(wf, profile_summary, margin=1.25):
+    # Replaces the memory estimates with the peak RSS measured by --profile (see profiling.py). Node names
+    # are the same for every subject, so measurements from earlier runs of a cohort can be reused.
+    # profile_summary is a profile report file, its 'summary' or the output of summarize_profiles.
+    if isinstance(profile_summary, str):
+        with open(profile_summary) as f:
+            profile_summary = json.load(f)['summary']
+    for node in wf._get_all_nodes():
+        measured = profile_summary.get(node.name, {}).get('max_peak_rss_gb')
+        if measured:
+            node._mem_gb = measured * margin
+            node.ram_estimator = None
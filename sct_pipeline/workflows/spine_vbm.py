@@ -1,4 +1,5 @@
 import os  # system functions
+import json
 
 import nipype.pipeline.engine as pe
 import nipype.interfaces.utility as util
@@ -9,46 +10,57 @@ import nipype.interfaces.fsl as fsl
 import sct_pipeline.interfaces.registration as sct_reg
 import sct_pipeline.interfaces.segmentation as sct_seg
 import sct_pipeline.interfaces.util as sct_util
-
-
-def spine_label_registration(name, deformable=False):
+from sct_pipeline.interfaces.cache import use_result_cache
+from sct_pipeline.interfaces.image import apply_intermediate_format, compress_file
+from sct_pipeline.workflows.resources import apply_resource_hints
+from sct_pipeline.workflows.execution import default_profile_prefix, get_node_outputs, run_workflow, \
+    scratch_directory
+
+
+# Per stage (Rigid, Affine, SyN) schedules. The fast profile runs the rigid/affine stages on downsampled
+# images only (the finest level is dropped), samples fewer points and stops earlier on convergence.
+REGISTRATION_PROFILES = {
+    'full': dict(number_of_iterations=[[100, 50, 25], [100, 50, 25], [100, 10, 5]],
+                 convergence_threshold=[1e-6, 1e-6, 1e-4],
+                 convergence_window_size=[10, 10, 10],
+                 smoothing_sigmas=[[4, 2, 1], [4, 2, 1], [2, 1, 0]],
+                 shrink_factors=[[4, 2, 1], [4, 2, 1], [4, 2, 1]],
+                 sampling_percentage=[0.25, 0.25, 0.25]),
+    'fast': dict(number_of_iterations=[[100, 50], [100, 50], [100, 10, 5]],
+                 convergence_threshold=[1e-5, 1e-5, 1e-4],
+                 convergence_window_size=[5, 5, 5],
+                 smoothing_sigmas=[[4, 2], [4, 2], [2, 1, 0]],
+                 shrink_factors=[[8, 4], [8, 4], [4, 2, 1]],
+                 sampling_percentage=[0.1, 0.1, 0.15]),
+}
+
+
+def spine_label_registration(name, deformable=False, profile='full'):
     registration_node = pe.MapNode(interface=ants.Registration(),
                                          iterfield=['moving_image'],
                                          name=name)
-    registration_node.inputs.dimension = 3
-    registration_node.inputs.interpolation = 'Linear'
-    registration_node.inputs.metric = [['MI', 'MeanSquares', 'MeanSquares'],
-                                             ['MI', 'MeanSquares', 'MeanSquares'],
-                                             ['MI', 'MeanSquares', 'MeanSquares']]
+    schedule = REGISTRATION_PROFILES[profile]
     if deformable:
-        registration_node.inputs.metric_weight = [[0.4, 0.3, 0.3], [0.4, 0.3, 0.3], [0.4, 0.3, 0.3]]
-        registration_node.inputs.radius_or_number_of_bins = [[32, 5, 5], [32, 5, 5], [32, 5, 5]]
-        registration_node.inputs.sampling_strategy = [['Regular', 'Regular', 'Regular'],
-                                                            ['Regular', 'Regular', 'Regular'],
-                                                            ['Regular', 'Regular', 'Regular']]
-        registration_node.inputs.sampling_percentage = [[0.25, 0.25, 0.25], [0.25, 0.25, 0.25], [0.25, 0.25, 0.25]]
         registration_node.inputs.transforms = ['Rigid', 'Affine', 'SyN']
         registration_node.inputs.transform_parameters = [(0.1,), (0.1,), (0.1, 3, 0)]
-        registration_node.inputs.number_of_iterations = [[100, 50, 25], [100, 50, 25], [100, 10, 5]]
-        registration_node.inputs.convergence_threshold = [1e-6, 1e-6, 1e-4]
-        registration_node.inputs.convergence_window_size = [10, 10, 10]
-        registration_node.inputs.smoothing_sigmas = [[4, 2, 1], [4, 2, 1], [2, 1, 0]]
-        registration_node.inputs.sigma_units = ['vox', 'vox', 'vox']
-        registration_node.inputs.shrink_factors = [[4, 2, 1], [4, 2, 1], [4, 2, 1]]
     else: #affine
-        registration_node.inputs.metric_weight = [[0.4, 0.3, 0.3], [0.4, 0.3, 0.3]]
-        registration_node.inputs.radius_or_number_of_bins = [[32, 5, 5], [32, 5, 5]]
-        registration_node.inputs.sampling_strategy = [['Regular', 'Regular', 'Regular'],
-                                                      ['Regular', 'Regular', 'Regular']]
-        registration_node.inputs.sampling_percentage = [[0.25, 0.25, 0.25], [0.25, 0.25, 0.25]]
         registration_node.inputs.transforms = ['Rigid', 'Affine']
         registration_node.inputs.transform_parameters = [(0.1,), (0.1,)]
-        registration_node.inputs.number_of_iterations = [[100, 50, 25], [100, 50, 25]]
-        registration_node.inputs.convergence_threshold = [1e-6, 1e-6]
-        registration_node.inputs.convergence_window_size = [10, 10]
-        registration_node.inputs.smoothing_sigmas = [[4, 2, 1], [4, 2, 1]]
-        registration_node.inputs.sigma_units = ['vox', 'vox']
-        registration_node.inputs.shrink_factors = [[4, 2, 1], [4, 2, 1]]
+    num_stages = len(registration_node.inputs.transforms)
+
+    registration_node.inputs.dimension = 3
+    registration_node.inputs.interpolation = 'Linear'
+    registration_node.inputs.metric = [['MI', 'MeanSquares', 'MeanSquares']] * num_stages
+    registration_node.inputs.metric_weight = [[0.4, 0.3, 0.3]] * num_stages
+    registration_node.inputs.radius_or_number_of_bins = [[32, 5, 5]] * num_stages
+    registration_node.inputs.sampling_strategy = [['Regular', 'Regular', 'Regular']] * num_stages
+    registration_node.inputs.sampling_percentage = [[p] * 3 for p in schedule['sampling_percentage'][:num_stages]]
+    registration_node.inputs.number_of_iterations = schedule['number_of_iterations'][:num_stages]
+    registration_node.inputs.convergence_threshold = schedule['convergence_threshold'][:num_stages]
+    registration_node.inputs.convergence_window_size = schedule['convergence_window_size'][:num_stages]
+    registration_node.inputs.smoothing_sigmas = schedule['smoothing_sigmas'][:num_stages]
+    registration_node.inputs.sigma_units = ['vox'] * num_stages
+    registration_node.inputs.shrink_factors = schedule['shrink_factors'][:num_stages]
 
     registration_node.inputs.write_composite_transform = True
     registration_node.inputs.initial_moving_transform_com = 1
@@ -56,14 +68,41 @@ def spine_label_registration(name, deformable=False):
 
     return registration_node
 
-def create_spine_template_workflow(output_root, init_template_index=0, max_label=9):
-    # TODO: Split into seperate workflows
-    # Segmentation, template registration/formation, vbm analysis
-    wf = pe.Workflow(name='spine_template', base_dir=output_root)
-
-    input_node = pe.Node(interface=util.IdentityInterface(fields=['spine_files', 'design_mat', 'tcon']),
-                         name='input_node')
-
+def add_batched_transforms(wf, name, inputs, reference, transforms, reference_per_subject=True):
+    # Resamples the images of each subject that share the same transforms with one ApplyTransformsNative node,
+    # so the transforms are read and interpolated once. inputs is a list of (node, field, interpolation) with
+    # one file per subject, reference and transforms are (node, field). Returns a node whose outputs out1,
+    # out2, ... are the resampled files of each input.
+    merge_inputs = pe.MapNode(interface=util.Merge(len(inputs)),
+                              iterfield=['in%d' % (i + 1) for i in range(len(inputs))],
+                              name='merge_' + name + '_inputs')
+    for i, (node, field, _) in enumerate(inputs):
+        wf.connect(node, field, merge_inputs, 'in%d' % (i + 1))
+
+    apply_transforms = pe.MapNode(interface=sct_reg.ApplyTransformsNative(),
+                                  iterfield=['input_images', 'transforms'] +
+                                            (['reference_image'] if reference_per_subject else []),
+                                  name=name)
+    apply_transforms.inputs.interpolations = [interpolation for _, _, interpolation in inputs]
+    wf.connect(merge_inputs, 'out', apply_transforms, 'input_images')
+    wf.connect(reference[0], reference[1], apply_transforms, 'reference_image')
+    wf.connect(transforms[0], transforms[1], apply_transforms, 'transforms')
+
+    split_outputs = pe.MapNode(interface=util.Split(),
+                               iterfield=['inlist'],
+                               name='split_' + name + '_outputs')
+    split_outputs.inputs.splits = [1] * len(inputs)
+    split_outputs.inputs.squeeze = True
+    wf.connect(apply_transforms, 'output_images', split_outputs, 'inlist')
+
+    return split_outputs
+
+
+def add_spine_preprocessing(wf, input_node, cache_dir=None, cache_size_gb=None, use_native_transforms=False,
+                            crop_margin_mm=None):
+    # Segmentation, vertebral labeling and straightening of the input_node spine_files. Returns the
+    # (node, field) of the straightened images and segmentations and the thresholded label node.
+    # If crop_margin_mm is set, the straightened images are cut to the cord plus crop_margin_mm in-plane.
     spine_segmentation = pe.MapNode(interface=sct_seg.DeepSeg(),
                                     iterfield=['input_image'],
                                     name='spine_segmentation')
@@ -77,6 +116,10 @@ def create_spine_template_workflow(output_root, init_template_index=0, max_label
     wf.connect(input_node, 'spine_files', label_vertebrae, 'input_image')
     wf.connect(spine_segmentation, 'spine_segmentation', label_vertebrae, 'spine_segmentation')
 
+    # Segmentation and labeling results can be reused from other runs (e.g. the MTR pipeline) on the same images
+    if cache_dir is not None:
+        use_result_cache([spine_segmentation, label_vertebrae], cache_dir, cache_size_gb)
+
     # Straighten the spinalcord, then apply the warp field to the segmentation and label maps
     straighten_spinalcord = pe.MapNode(interface=sct_reg.StraightenSpinalcord(),
                                        iterfield=['input_image','segmentation_image'],
@@ -84,33 +127,108 @@ def create_spine_template_workflow(output_root, init_template_index=0, max_label
     wf.connect(input_node, 'spine_files', straighten_spinalcord, 'input_image')
     wf.connect(spine_segmentation, 'spine_segmentation', straighten_spinalcord, 'segmentation_image')
 
-    straighten_segmentation = pe.MapNode(interface=sct_reg.ApplyTransform(),
-                                         iterfield=['input_image', 'destination_image', 'transforms'],
-                                         name='straighten_segmentation')
-    straighten_segmentation.inputs.interpolation = 'linear'  # Soft segmentation, so use linear
-    wf.connect(spine_segmentation, 'spine_segmentation', straighten_segmentation, 'input_image')
-    wf.connect(straighten_spinalcord, 'straightened_input', straighten_segmentation, 'destination_image')
-    wf.connect(straighten_spinalcord, 'warp_curve2straight', straighten_segmentation, 'transforms')
-
-    straighten_labels = pe.MapNode(interface=sct_reg.ApplyTransform(),
-                                   iterfield=['input_image', 'destination_image', 'transforms'],
-                                   name='straighten_labels')
-    straighten_labels.inputs.interpolation = 'nn'  # Hard label segmentation, so use nn
-    wf.connect(label_vertebrae, 'labels', straighten_labels, 'input_image')
-    wf.connect(straighten_spinalcord, 'straightened_input', straighten_labels, 'destination_image')
-    wf.connect(straighten_spinalcord, 'warp_curve2straight', straighten_labels, 'transforms')
+    if use_native_transforms:
+        # The segmentation and labels share warp_curve2straight, which is read once per subject
+        straighten_images = add_batched_transforms(wf, 'straighten_images',
+                                                   [(spine_segmentation, 'spine_segmentation', 'linear'),
+                                                    (label_vertebrae, 'labels', 'nn')],
+                                                   (straighten_spinalcord, 'straightened_input'),
+                                                   (straighten_spinalcord, 'warp_curve2straight'))
+        straightened_seg = (straighten_images, 'out1')
+        straightened_labels = (straighten_images, 'out2')
+    else:
+        straighten_segmentation = pe.MapNode(interface=sct_reg.ApplyTransform(),
+                                             iterfield=['input_image', 'destination_image', 'transforms'],
+                                             name='straighten_segmentation')
+        straighten_segmentation.inputs.interpolation = 'linear'  # Soft segmentation, so use linear
+        wf.connect(spine_segmentation, 'spine_segmentation', straighten_segmentation, 'input_image')
+        wf.connect(straighten_spinalcord, 'straightened_input', straighten_segmentation, 'destination_image')
+        wf.connect(straighten_spinalcord, 'warp_curve2straight', straighten_segmentation, 'transforms')
+
+        straighten_labels = pe.MapNode(interface=sct_reg.ApplyTransform(),
+                                       iterfield=['input_image', 'destination_image', 'transforms'],
+                                       name='straighten_labels')
+        straighten_labels.inputs.interpolation = 'nn'  # Hard label segmentation, so use nn
+        wf.connect(label_vertebrae, 'labels', straighten_labels, 'input_image')
+        wf.connect(straighten_spinalcord, 'straightened_input', straighten_labels, 'destination_image')
+        wf.connect(straighten_spinalcord, 'warp_curve2straight', straighten_labels, 'transforms')
+        straightened_seg = (straighten_segmentation, 'output_file')
+        straightened_labels = (straighten_labels, 'output_file')
+
+    straightened = (straighten_spinalcord, 'straightened_input')
+    if crop_margin_mm is not None:
+        # The straightened cord is centred in a field of view that is mostly background, the registrations and
+        # templates only need the cord and its surroundings. The crops keep their place in the straightened space.
+        crops = []
+        for crop_name, source in [('crop_straightened', straightened), ('crop_straightened_seg', straightened_seg),
+                                  ('crop_straightened_labels', straightened_labels)]:
+            crop = pe.MapNode(interface=sct_util.CropToMask(),
+                              iterfield=['input_image', 'mask'],
+                              name=crop_name)
+            crop.inputs.margin_mm = crop_margin_mm
+            wf.connect(source[0], source[1], crop, 'input_image')
+            wf.connect(straightened_seg[0], straightened_seg[1], crop, 'mask')
+            crops.append((crop, 'output_image'))
+        straightened, straightened_seg, straightened_labels = crops
 
     # TODO: Split here into a separate workflow
     threshold_labels = pe.Node(sct_util.ThresholdLabels(), name='threshold_labels')
     threshold_labels.inputs.threshold = True
     threshold_labels.inputs.num_additional_labels_removed = 1
-    wf.connect(straighten_labels, 'output_file', threshold_labels, 'label_files')
+    wf.connect(straightened_labels[0], straightened_labels[1], threshold_labels, 'label_files')
+
+    return straightened, straightened_seg, threshold_labels
+
+
+def create_spine_preprocessing_workflow(output_root, max_common_label=None, cache_dir=None, cache_size_gb=None,
+                                        use_native_transforms=False, crop_margin_mm=None,
+                                        name='spine_preprocessing'):
+    # Standalone preprocessing of new subjects. max_common_label should be the one of the template the
+    # subjects are added to, so the thresholded labels match the template labels.
+    wf = pe.Workflow(name=name, base_dir=output_root)
+
+    input_node = pe.Node(interface=util.IdentityInterface(fields=['spine_files']),
+                         name='input_node')
+
+    straightened, straightened_seg, threshold_labels = \
+        add_spine_preprocessing(wf, input_node, cache_dir, cache_size_gb, use_native_transforms, crop_margin_mm)
+    if max_common_label is not None:
+        threshold_labels.inputs.max_common_label = max_common_label
+
+    output_node = pe.Node(interface=util.IdentityInterface(fields=['straightened_files', 'seg_files',
+                                                                   'label_files', 'max_common_label']),
+                          name='output_node')
+    wf.connect(straightened[0], straightened[1], output_node, 'straightened_files')
+    wf.connect(straightened_seg[0], straightened_seg[1], output_node, 'seg_files')
+    wf.connect(threshold_labels, 'thresholded_label_files', output_node, 'label_files')
+    wf.connect(threshold_labels, 'max_common_label', output_node, 'max_common_label')
+
+    apply_resource_hints(wf)
+
+    return wf
+
+
+def create_spine_template_workflow(output_root, init_template_index=0, max_label=9, stream_templates=False,
+                                   use_native_label_fusion=False, cache_dir=None, cache_size_gb=None,
+                                   registration_profile='full', export_dir=None, use_native_transforms=False,
+                                   crop_margin_mm=None):
+    # If export_dir is set, the templates are copied there as spine_template.nii.gz, spine_template_seg.nii.gz
+    # and spine_template_labels.nii.gz (e.g. when the working directory is on scratch space)
+    # TODO: Split into seperate workflows
+    # Segmentation, template registration/formation, vbm analysis
+    wf = pe.Workflow(name='spine_template', base_dir=output_root)
+
+    input_node = pe.Node(interface=util.IdentityInterface(fields=['spine_files', 'design_mat', 'tcon']),
+                         name='input_node')
+
+    straightened, straightened_seg, threshold_labels = \
+        add_spine_preprocessing(wf, input_node, cache_dir, cache_size_gb, use_native_transforms, crop_margin_mm)
 
     # Select the template_index element of the straightened spinalcord to use as the initial template
     select_init_template = pe.Node(interface=util.Select(),
                                    name='select_init_template')
     select_init_template.inputs.index = [init_template_index]
-    wf.connect(straighten_spinalcord, 'straightened_input', select_init_template, 'inlist')
+    wf.connect(straightened[0], straightened[1], select_init_template, 'inlist')
 
     select_init_label = pe.Node(interface=util.Select(),
                                 name='select_init_label')
@@ -120,13 +238,13 @@ def create_spine_template_workflow(output_root, init_template_index=0, max_label
     select_init_seg = pe.Node(interface=util.Select(),
                               name='select_init_seg')
     select_init_seg.inputs.index = [init_template_index]
-    wf.connect(straighten_segmentation, 'output_file', select_init_seg, 'inlist')
+    wf.connect(straightened_seg[0], straightened_seg[1], select_init_seg, 'inlist')
 
     merge_moving_images = pe.MapNode(interface=util.Merge(3), 
                                      iterfield=['in1', 'in2', 'in3'],
                                      name='merge_moving_images')
-    wf.connect(straighten_spinalcord, 'straightened_input', merge_moving_images, 'in1')
-    wf.connect(straighten_segmentation, 'output_file', merge_moving_images, 'in2')
+    wf.connect(straightened[0], straightened[1], merge_moving_images, 'in1')
+    wf.connect(straightened_seg[0], straightened_seg[1], merge_moving_images, 'in2')
     wf.connect(threshold_labels, 'thresholded_label_files', merge_moving_images, 'in3')
     
     merge_fixed_images = pe.Node(interface=util.Merge(3), 
@@ -135,68 +253,75 @@ def create_spine_template_workflow(output_root, init_template_index=0, max_label
     wf.connect(select_init_seg, 'out', merge_fixed_images, 'in2')
     wf.connect(select_init_label, 'out', merge_fixed_images, 'in3')
     
-    affine_registration = pe.MapNode(interface=ants.Registration(),
-                                     iterfield=['moving_image'],
-                                     name='affine_registration')
-    affine_registration.inputs.dimension = 3
-    affine_registration.inputs.interpolation = 'Linear'
-    affine_registration.inputs.metric = [['MI', 'MeanSquares', 'MeanSquares'], ['MI', 'MeanSquares', 'MeanSquares']]
-    affine_registration.inputs.metric_weight = [[0.4, 0.3, 0.3], [0.4, 0.3, 0.3]]
-    affine_registration.inputs.radius_or_number_of_bins = [[32, 5, 5], [32, 5, 5]]
-    affine_registration.inputs.sampling_strategy = [['Regular', 'Regular', 'Regular'], ['Regular', 'Regular', 'Regular']]
-    affine_registration.inputs.sampling_percentage = [[0.25, 0.25, 0.25], [0.25, 0.25, 0.25]]
-    affine_registration.inputs.transforms = ['Rigid', 'Affine']
-    affine_registration.inputs.transform_parameters = [(0.1,), (0.1,)]
-    affine_registration.inputs.number_of_iterations = [[100, 50, 25], [100, 50, 25]]
-    affine_registration.inputs.convergence_threshold = [1e-6, 1e-6]
-    affine_registration.inputs.convergence_window_size = [10, 10]
-    affine_registration.inputs.smoothing_sigmas = [[4, 2, 1], [4, 2, 1]]
-    affine_registration.inputs.sigma_units = ['vox', 'vox']
-    affine_registration.inputs.shrink_factors = [[4, 2, 1], [4, 2, 1]]
-    affine_registration.inputs.write_composite_transform = True
-    affine_registration.inputs.initial_moving_transform_com = 1
-    affine_registration.inputs.output_warped_image = True
+    affine_registration = spine_label_registration('affine_registration', deformable=False,
+                                                   profile=registration_profile)
     wf.connect(merge_moving_images, 'out', affine_registration, 'moving_image')
     wf.connect(merge_fixed_images, 'out', affine_registration, 'fixed_image')
 
-    affine_4d_template = pe.Node(interface=fsl.Merge(),
-                                name='affine_4d_template')
-    affine_4d_template.inputs.dimension = 't'
-    wf.connect(affine_registration, 'warped_image', affine_4d_template, 'in_files')
-
+    # If stream_templates is set, the templates are averaged one image at a time directly from the
+    # registered images instead of merging them into a 4D file first (peak memory of one volume)
     affine_template = pe.Node(interface=sct_util.GenerateTemplate(),
                               name='affine_template')
-    wf.connect(affine_4d_template, 'merged_file', affine_template, 'input_file')
-
-    affine_warp_labels = pe.MapNode(interface=ants.ApplyTransforms(),
-                                    iterfield=['input_image', 'reference_image', 'transforms'])
-    affine_warp_labels.inputs.interpolation = 'NearestNeighbor'
-    wf.connect(threshold_labels, 'thresholded_label_files', affine_warp_labels, 'input_image')
-    wf.connect(affine_registration, 'warped_image', affine_warp_labels, 'reference_image')
-    wf.connect(affine_registration, 'forward_transforms', affine_warp_labels, 'transforms')
+    if stream_templates:
+        wf.connect(affine_registration, 'warped_image', affine_template, 'input_files')
+    else:
+        affine_4d_template = pe.Node(interface=fsl.Merge(),
+                                    name='affine_4d_template')
+        affine_4d_template.inputs.dimension = 't'
+        wf.connect(affine_registration, 'warped_image', affine_4d_template, 'in_files')
+        wf.connect(affine_4d_template, 'merged_file', affine_template, 'input_file')
+
+    if use_native_transforms:
+        # The labels and segmentation share the composite transform, which is read once per subject
+        affine_warp = add_batched_transforms(wf, 'affine_warp',
+                                             [(threshold_labels, 'thresholded_label_files', 'nn'),
+                                              (straightened_seg[0], straightened_seg[1], 'linear')],
+                                             (affine_registration, 'warped_image'),
+                                             (affine_registration, 'composite_transform'))
+        affine_warped_labels = (affine_warp, 'out1')
+        affine_warped_seg = (affine_warp, 'out2')
+    else:
+        affine_warp_labels = pe.MapNode(interface=ants.ApplyTransforms(),
+                                        iterfield=['input_image', 'reference_image', 'transforms'],
+                                        name='affine_warp_labels')
+        affine_warp_labels.inputs.interpolation = 'NearestNeighbor'
+        wf.connect(threshold_labels, 'thresholded_label_files', affine_warp_labels, 'input_image')
+        wf.connect(affine_registration, 'warped_image', affine_warp_labels, 'reference_image')
+        wf.connect(affine_registration, 'composite_transform', affine_warp_labels, 'transforms')
+
+        affine_warp_seg = pe.MapNode(interface=ants.ApplyTransforms(),
+                                     iterfield=['input_image', 'reference_image', 'transforms'],
+                                     name='affine_warp_seg')
+        affine_warp_seg.inputs.interpolation = 'Linear'
+        wf.connect(straightened_seg[0], straightened_seg[1], affine_warp_seg, 'input_image')
+        wf.connect(affine_registration, 'warped_image', affine_warp_seg, 'reference_image')
+        wf.connect(affine_registration, 'composite_transform', affine_warp_seg, 'transforms')
+        affine_warped_labels = (affine_warp_labels, 'output_image')
+        affine_warped_seg = (affine_warp_seg, 'output_image')
 
     #Handle l-r flip
-    affine_labels = pe.Node(interface=sct_seg.LabelFusion(),
-                            name='affine_labels')
+    if use_native_label_fusion:
+        # Streams the label images and only keeps per-label vote counts in memory
+        affine_labels = pe.Node(interface=sct_seg.LabelFusionNative(),
+                                name='affine_labels')
+        # The thresholded labels go up to the largest common label of the cohort
+        wf.connect(threshold_labels, 'max_common_label', affine_labels, 'max_label')
+    else:
+        affine_labels = pe.Node(interface=sct_seg.LabelFusion(),
+                                name='affine_labels')
     affine_labels.inputs.operation = 'MajorityVoting'
-    wf.connect(affine_warp_labels, 'output_image', affine_labels, 'images')
-
-    affine_warp_seg = pe.MapNode(interface=ants.ApplyTransforms(),
-                                 iterfield=['input_image', 'reference_image', 'transforms'],
-                                 name='affine_warp_seg')
-    affine_warp_seg.inputs.interpolation = 'Linear'
-    wf.connect(straighten_segmentation, 'output_file', affine_warp_seg, 'input_image')
-    wf.connect(affine_registration, 'warped_image', affine_warp_seg, 'reference_image')
-    wf.connect(affine_registration, 'forward_transforms', affine_warp_seg, 'transforms')
-
-    affine_4d_seg = pe.Node(interface=fsl.Merge(),
-                            name='affine_4d_seg')
-    affine_4d_seg.inputs.dimension = 't'
-    wf.connect(affine_warp_seg, 'output_image', affine_4d_seg, 'in_files')
+    wf.connect(affine_warped_labels[0], affine_warped_labels[1], affine_labels, 'images')
 
     affine_seg = pe.Node(interface=sct_util.GenerateTemplate(),
                          name='affine_seg')
-    wf.connect(affine_4d_template, 'merged_file', affine_seg, 'input_file')
+    if stream_templates:
+        wf.connect(affine_warped_seg[0], affine_warped_seg[1], affine_seg, 'input_files')
+    else:
+        affine_4d_seg = pe.Node(interface=fsl.Merge(),
+                                name='affine_4d_seg')
+        affine_4d_seg.inputs.dimension = 't'
+        wf.connect(affine_warped_seg[0], affine_warped_seg[1], affine_4d_seg, 'in_files')
+        wf.connect(affine_4d_seg, 'merged_file', affine_seg, 'input_file')
 
     merge_fixed_images_affine = pe.Node(interface=util.Merge(3),
                                  name='merge_fixed_images_affine')
@@ -204,44 +329,44 @@ def create_spine_template_workflow(output_root, init_template_index=0, max_label
     wf.connect(affine_seg, 'template_file', merge_fixed_images_affine, 'in2')
     wf.connect(affine_labels, 'output_image', merge_fixed_images_affine, 'in3')
 
-    deformable_registration = pe.MapNode(interface=ants.Registration(),
-                                     iterfield=['moving_image'],
-                                     name='deformable_registration')
-    deformable_registration.inputs.dimension = 3
-    deformable_registration.inputs.interpolation = 'Linear'
-    deformable_registration.inputs.metric = [['MI', 'MeanSquares', 'MeanSquares'],
-                                             ['MI', 'MeanSquares', 'MeanSquares'],
-                                             ['MI', 'MeanSquares', 'MeanSquares']]
-    deformable_registration.inputs.metric_weight = [[0.4, 0.3, 0.3], [0.4, 0.3, 0.3], [0.4, 0.3, 0.3]]
-    deformable_registration.inputs.radius_or_number_of_bins = [[32, 5, 5], [32, 5, 5], [32, 5, 5]]
-    deformable_registration.inputs.sampling_strategy = [['Regular', 'Regular', 'Regular'],
-                                                        ['Regular', 'Regular', 'Regular'],
-                                                        ['Regular', 'Regular', 'Regular']]
-    deformable_registration.inputs.sampling_percentage = [[0.25, 0.25, 0.25], [0.25, 0.25, 0.25], [0.25, 0.25, 0.25]]
-    deformable_registration.inputs.transforms = ['Rigid', 'Affine', 'SyN']
-    deformable_registration.inputs.transform_parameters = [(0.1,), (0.1,), (0.1, 3, 0)]
-    deformable_registration.inputs.number_of_iterations = [[100, 50, 25], [100, 50, 25], [100, 10, 5]]
-    deformable_registration.inputs.convergence_threshold = [1e-6, 1e-6, 1e-4]
-    deformable_registration.inputs.convergence_window_size = [10, 10, 10]
-    deformable_registration.inputs.smoothing_sigmas = [[4, 2, 1], [4, 2, 1], [2, 1, 0]]
-    deformable_registration.inputs.sigma_units = ['vox', 'vox', 'vox']
-    deformable_registration.inputs.shrink_factors = [[4, 2, 1], [4, 2, 1], [4, 2, 1]]
-    deformable_registration.inputs.write_composite_transform = True
-    deformable_registration.inputs.initial_moving_transform_com = 1
-    deformable_registration.inputs.output_warped_image = True
+    deformable_registration = spine_label_registration('deformable_registration', deformable=True,
+                                                       profile=registration_profile)
     wf.connect(merge_moving_images, 'out', deformable_registration, 'moving_image')
     wf.connect(merge_fixed_images_affine, 'out', deformable_registration, 'fixed_image')
 
-    #TODO: Compartmentalize reusable deformation segments
-
-    deformable_4d_template = pe.Node(interface=fsl.Merge(),
-                                 name='deformable_4d_template')
-    deformable_4d_template.inputs.dimension = 't'
-    wf.connect(deformable_registration, 'warped_image', deformable_4d_template, 'in_files')
-
     deformable_template = pe.Node(interface=sct_util.GenerateTemplate(),
                               name='deformable_template')
-    wf.connect(deformable_4d_template, 'merged_file', deformable_template, 'input_file')
+    if stream_templates:
+        wf.connect(deformable_registration, 'warped_image', deformable_template, 'input_files')
+    else:
+        deformable_4d_template = pe.Node(interface=fsl.Merge(),
+                                     name='deformable_4d_template')
+        deformable_4d_template.inputs.dimension = 't'
+        wf.connect(deformable_registration, 'warped_image', deformable_4d_template, 'in_files')
+        wf.connect(deformable_4d_template, 'merged_file', deformable_template, 'input_file')
+
+    # Inputs of build_spine_template, which refines the affine templates
+    output_node = pe.Node(interface=util.IdentityInterface(fields=['straightened_files', 'seg_files', 'label_files',
+                                                                   'max_common_label', 'affine_template',
+                                                                   'affine_seg_template', 'affine_label_template']),
+                          name='output_node')
+    wf.connect(straightened[0], straightened[1], output_node, 'straightened_files')
+    wf.connect(straightened_seg[0], straightened_seg[1], output_node, 'seg_files')
+    wf.connect(threshold_labels, 'thresholded_label_files', output_node, 'label_files')
+    wf.connect(threshold_labels, 'max_common_label', output_node, 'max_common_label')
+    wf.connect(affine_template, 'template_file', output_node, 'affine_template')
+    wf.connect(affine_seg, 'template_file', output_node, 'affine_seg_template')
+    wf.connect(affine_labels, 'output_image', output_node, 'affine_label_template')
+
+    if export_dir is not None:
+        for suffix, node, field in [('', deformable_template, 'template_file'),
+                                    ('_seg', affine_seg, 'template_file'),
+                                    ('_labels', affine_labels, 'output_image')]:
+            export_template = pe.Node(interface=sct_util.ExportImage(), name='export_template' + suffix)
+            export_template.inputs.clobber = True
+            export_template.inputs.out_file = os.path.join(os.path.abspath(export_dir),
+                                                           'spine_template' + suffix + '.nii.gz')
+            wf.connect(node, field, export_template, 'in_file')
 
     #num_dataset = len(input_node.inputs.spine_files)
     #pick_first = pe.Node(util.Split(), 'pick_first')
@@ -374,8 +499,320 @@ def create_spine_template_workflow(output_root, init_template_index=0, max_label
     # wf.connect(input_node, 'design_mat', init_randomise, 'design_mat')
     # wf.connect(input_node, 'tcon', init_randomise, 'tcon')
 
+    apply_resource_hints(wf)
+
     return wf
 
+def create_template_iteration_workflow(output_root, registration_profile='full', max_label=9,
+                                       use_native_transforms=False, use_native_label_fusion=False,
+                                       name='template_iteration'):
+    # One round of template building: the straightened images (with their segmentations and labels) are
+    # registered to the current template and averaged. If previous_template/previous_seg_template and
+    # previous_count are set, the registered images are added to the running mean of an existing template,
+    # and the labels are fused with previous_warped_labels. max_label is the largest label of the label
+    # files (the max_common_label they were thresholded with), used by the native label fusion.
+    wf = pe.Workflow(name=name, base_dir=output_root)
+
+    input_node = pe.Node(interface=util.IdentityInterface(fields=['straightened_files', 'seg_files', 'label_files',
+                                                                  'template', 'seg_template', 'label_template',
+                                                                  'previous_template', 'previous_seg_template',
+                                                                  'previous_count', 'previous_warped_labels']),
+                         name='input_node')
+    input_node.inputs.previous_count = 0
+    input_node.inputs.previous_warped_labels = []
+
+    merge_moving_images = pe.MapNode(interface=util.Merge(3),
+                                     iterfield=['in1', 'in2', 'in3'],
+                                     name='merge_moving_images')
+    wf.connect(input_node, 'straightened_files', merge_moving_images, 'in1')
+    wf.connect(input_node, 'seg_files', merge_moving_images, 'in2')
+    wf.connect(input_node, 'label_files', merge_moving_images, 'in3')
+
+    merge_fixed_images = pe.Node(interface=util.Merge(3),
+                                 name='merge_fixed_images')
+    wf.connect(input_node, 'template', merge_fixed_images, 'in1')
+    wf.connect(input_node, 'seg_template', merge_fixed_images, 'in2')
+    wf.connect(input_node, 'label_template', merge_fixed_images, 'in3')
+
+    template_registration = spine_label_registration('template_registration', deformable=True,
+                                                     profile=registration_profile)
+    wf.connect(merge_moving_images, 'out', template_registration, 'moving_image')
+    wf.connect(merge_fixed_images, 'out', template_registration, 'fixed_image')
+
+    if use_native_transforms:
+        warp_images = add_batched_transforms(wf, 'warp_images',
+                                             [(input_node, 'seg_files', 'linear'),
+                                              (input_node, 'label_files', 'nn')],
+                                             (input_node, 'template'),
+                                             (template_registration, 'composite_transform'),
+                                             reference_per_subject=False)
+        warped_segs = (warp_images, 'out1')
+        warped_labels = (warp_images, 'out2')
+    else:
+        warp_seg = pe.MapNode(interface=ants.ApplyTransforms(),
+                              iterfield=['input_image', 'transforms'],
+                              name='warp_seg')
+        warp_seg.inputs.interpolation = 'Linear'
+        wf.connect(input_node, 'seg_files', warp_seg, 'input_image')
+        wf.connect(input_node, 'template', warp_seg, 'reference_image')
+        wf.connect(template_registration, 'composite_transform', warp_seg, 'transforms')
+
+        warp_labels = pe.MapNode(interface=ants.ApplyTransforms(),
+                                 iterfield=['input_image', 'transforms'],
+                                 name='warp_labels')
+        warp_labels.inputs.interpolation = 'NearestNeighbor'
+        wf.connect(input_node, 'label_files', warp_labels, 'input_image')
+        wf.connect(input_node, 'template', warp_labels, 'reference_image')
+        wf.connect(template_registration, 'composite_transform', warp_labels, 'transforms')
+        warped_segs = (warp_seg, 'output_image')
+        warped_labels = (warp_labels, 'output_image')
+
+    template = pe.Node(interface=sct_util.GenerateTemplate(),
+                       name='template')
+    wf.connect(template_registration, 'warped_image', template, 'input_files')
+    wf.connect(input_node, 'previous_template', template, 'previous_template')
+    wf.connect(input_node, 'previous_count', template, 'previous_count')
+
+    seg_template = pe.Node(interface=sct_util.GenerateTemplate(),
+                           name='seg_template')
+    wf.connect(warped_segs[0], warped_segs[1], seg_template, 'input_files')
+    wf.connect(input_node, 'previous_seg_template', seg_template, 'previous_template')
+    wf.connect(input_node, 'previous_count', seg_template, 'previous_count')
+
+    # Votes can not be averaged, so the labels of the previous subjects are fused again
+    all_warped_labels = pe.Node(interface=util.Merge(2),
+                                name='all_warped_labels')
+    wf.connect(input_node, 'previous_warped_labels', all_warped_labels, 'in1')
+    wf.connect(warped_labels[0], warped_labels[1], all_warped_labels, 'in2')
+
+    if use_native_label_fusion:
+        label_template = pe.Node(interface=sct_seg.LabelFusionNative(),
+                                 name='label_template')
+        label_template.inputs.max_label = max_label
+    else:
+        label_template = pe.Node(interface=sct_seg.LabelFusion(),
+                                 name='label_template')
+    label_template.inputs.operation = 'MajorityVoting'
+    wf.connect(all_warped_labels, 'out', label_template, 'images')
+
+    output_node = pe.Node(interface=util.IdentityInterface(fields=['template', 'seg_template', 'label_template',
+                                                                   'num_images', 'warped_images', 'warped_segs',
+                                                                   'warped_labels']),
+                          name='output_node')
+    wf.connect(template, 'template_file', output_node, 'template')
+    wf.connect(template, 'num_images', output_node, 'num_images')
+    wf.connect(seg_template, 'template_file', output_node, 'seg_template')
+    wf.connect(label_template, 'output_image', output_node, 'label_template')
+    wf.connect(template_registration, 'warped_image', output_node, 'warped_images')
+    wf.connect(warped_segs[0], warped_segs[1], output_node, 'warped_segs')
+    wf.connect(warped_labels[0], warped_labels[1], output_node, 'warped_labels')
+
+    apply_resource_hints(wf)
+
+    return wf
+
+
+def template_change(old_template, new_template):
+    # Relative change (L2 norm) between two templates
+    import nibabel as nib
+    import numpy as np
+
+    old_data = nib.load(old_template).get_fdata(dtype=np.float32)
+    new_data = nib.load(new_template).get_fdata(dtype=np.float32)
+    if old_data.shape != new_data.shape:
+        return float('inf')
+    norm = np.linalg.norm(old_data)
+    if norm == 0:
+        return float('inf')
+    return float(np.linalg.norm(new_data - old_data) / norm)
+
+
+def read_template_state(state_file):
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def write_template_state(state, state_file):
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_file, state_file)
+
+
+def export_template_state(state, export_dir, first_subject=0):
+    # Copies the templates and the per subject images (from first_subject on) of state to export_dir and
+    # points state at the copies, so the state does not depend on the (scratch) working directories
+    os.makedirs(export_dir, exist_ok=True)
+    for key in ['template', 'seg_template', 'label_template']:
+        export_file = os.path.join(export_dir, key + '.nii.gz')
+        compress_file(state[key], export_file)
+        state[key] = export_file
+    for idx in range(first_subject, len(state['subjects'])):
+        subject_dir = os.path.join(export_dir, 'subject_%04d' % idx)
+        os.makedirs(subject_dir, exist_ok=True)
+        subject = state['subjects'][idx]
+        for key in ['straightened_file', 'warped_image', 'warped_seg', 'warped_label']:
+            export_file = os.path.join(subject_dir, key + '.nii.gz')
+            compress_file(subject[key], export_file)
+            subject[key] = export_file
+    return state
+
+
+def _run_template_workflow(wf, num_threads, profile, memory_gb, compression, compression_level, ledger, retries,
+                           retry_backoff):
+    apply_intermediate_format(wf, compression, compression_level)
+    if profile == '':
+        profile = default_profile_prefix(wf)
+    elif profile is not None:
+        profile = profile + '_' + wf.name
+    # The iterations have different workflow names, so they can share the ledger of the main workflow
+    return get_node_outputs(run_workflow(wf, num_threads, profile=profile, memory_gb=memory_gb, ledger=ledger,
+                                         retries=retries, retry_backoff=retry_backoff), 'output_node', wf)
+
+
+def build_spine_template(output_root, straightened_files, seg_files, label_files, template, seg_template,
+                         label_template, iterations=3, tolerance=1e-3, registration_profile='full', max_label=9,
+                         max_common_label=None, state_file=None, num_threads=1, profile=None, memory_gb=None,
+                         compression='gzip', compression_level=1, scratch_dir=None, keep_scratch=False,
+                         use_native_transforms=False, use_native_label_fusion=False, ledger=None, retries=0,
+                         retry_backoff=60.0):
+    # Registers all subjects to the current template and averages them, until the template changes less than
+    # tolerance (relative L2 norm) or the number of iterations is reached. The templates, image count and
+    # per subject registered images are written to state_file (template_state.json in output_root by default)
+    # after every iteration, so subjects can be added later with update_spine_template. With scratch_dir, the
+    # iterations run in scratch space and the final images are exported next to state_file. The labels are
+    # fused up to max_common_label (the label files are thresholded with it) if it is set, max_label otherwise.
+    if state_file is None:
+        state_file = os.path.join(output_root, 'template_state.json')
+    if max_common_label is not None:
+        max_label = max_common_label
+
+    with scratch_directory(scratch_dir, 'spine_template_iterations', keep_scratch) as work_dir:
+        state = _iterate_spine_template(work_dir or output_root, straightened_files, seg_files, label_files,
+                                        template, seg_template, label_template, iterations, tolerance,
+                                        registration_profile, max_label, max_common_label, state_file,
+                                        num_threads, profile, memory_gb, compression, compression_level,
+                                        use_native_transforms, use_native_label_fusion, ledger, retries,
+                                        retry_backoff)
+        if work_dir is not None and state is not None:
+            export_template_state(state, os.path.join(os.path.dirname(os.path.abspath(state_file)),
+                                                      'template_files'))
+            write_template_state(state, state_file)
+
+    return state
+
+
+def _iterate_spine_template(output_root, straightened_files, seg_files, label_files, template, seg_template,
+                            label_template, iterations, tolerance, registration_profile, max_label,
+                            max_common_label, state_file, num_threads, profile, memory_gb, compression,
+                            compression_level, use_native_transforms, use_native_label_fusion, ledger, retries,
+                            retry_backoff):
+    state = None
+    history = []
+    for iteration in range(iterations):
+        wf = create_template_iteration_workflow(output_root, registration_profile, max_label,
+                                                use_native_transforms, use_native_label_fusion,
+                                                name='template_iteration_%d' % iteration)
+        wf.inputs.input_node.straightened_files = straightened_files
+        wf.inputs.input_node.seg_files = seg_files
+        wf.inputs.input_node.label_files = label_files
+        wf.inputs.input_node.template = template
+        wf.inputs.input_node.seg_template = seg_template
+        wf.inputs.input_node.label_template = label_template
+        outputs = _run_template_workflow(wf, num_threads, profile, memory_gb, compression, compression_level,
+                                         ledger, retries, retry_backoff)
+
+        change = template_change(template, outputs.template)
+        history.append({'iteration': iteration, 'change': change})
+        print('Template iteration %d: relative change %.6f' % (iteration, change))
+        template, seg_template, label_template = outputs.template, outputs.seg_template, outputs.label_template
+
+        state = {'template': template,
+                 'seg_template': seg_template,
+                 'label_template': label_template,
+                 'num_images': outputs.num_images,
+                 'max_common_label': max_common_label,
+                 'max_label': max_label,
+                 'native_label_fusion': use_native_label_fusion,
+                 'registration_profile': registration_profile,
+                 'iterations': history,
+                 'updates': [],
+                 'subjects': [{'straightened_file': f, 'warped_image': w, 'warped_seg': ws, 'warped_label': wl}
+                              for f, w, ws, wl in zip(straightened_files, outputs.warped_images,
+                                                      outputs.warped_segs, outputs.warped_labels)]}
+        write_template_state(state, state_file)
+
+        if change < tolerance:
+            break
+
+    return state
+
+
+def update_spine_template(state_file, straightened_files, seg_files, label_files, output_root=None,
+                          num_threads=1, profile=None, memory_gb=None, compression='gzip', compression_level=1,
+                          scratch_dir=None, keep_scratch=False, use_native_transforms=False,
+                          use_native_label_fusion=None, ledger=None, retries=0, retry_backoff=60.0):
+    # Registers only the new subjects to the template in state_file and updates the running mean templates.
+    # The inputs must be preprocessed with the max_common_label of the template
+    # (see create_spine_preprocessing_workflow). With scratch_dir, the registrations run in scratch space and
+    # the new images are exported next to state_file. The labels are fused as when the template was built
+    # unless use_native_label_fusion is set.
+    state = read_template_state(state_file)
+    if output_root is None:
+        output_root = os.path.dirname(os.path.abspath(state_file))
+
+    with scratch_directory(scratch_dir, 'spine_template_update', keep_scratch) as work_dir:
+        num_subjects = len(state['subjects'])
+        state = _update_spine_template(state, work_dir or output_root, straightened_files, seg_files, label_files,
+                                       num_threads, profile, memory_gb, compression, compression_level,
+                                       use_native_transforms, use_native_label_fusion, ledger, retries,
+                                       retry_backoff)
+        if work_dir is not None:
+            export_template_state(state, os.path.join(os.path.dirname(os.path.abspath(state_file)),
+                                                      'template_files_update_%d' % (len(state['updates']) - 1)),
+                                  first_subject=num_subjects)
+        write_template_state(state, state_file)
+
+    return state
+
+
+def _update_spine_template(state, output_root, straightened_files, seg_files, label_files, num_threads, profile,
+                           memory_gb, compression, compression_level, use_native_transforms,
+                           use_native_label_fusion, ledger, retries, retry_backoff):
+    update = len(state['updates'])
+    # States written before the labels were fused up to max_common_label recorded max_label=9
+    max_label = state['max_common_label'] if state.get('max_common_label') is not None else state['max_label']
+    if use_native_label_fusion is None:
+        use_native_label_fusion = state.get('native_label_fusion', False)
+    wf = create_template_iteration_workflow(output_root, state['registration_profile'], max_label,
+                                            use_native_transforms, use_native_label_fusion,
+                                            name='template_update_%d' % update)
+    wf.inputs.input_node.straightened_files = straightened_files
+    wf.inputs.input_node.seg_files = seg_files
+    wf.inputs.input_node.label_files = label_files
+    wf.inputs.input_node.template = state['template']
+    wf.inputs.input_node.seg_template = state['seg_template']
+    wf.inputs.input_node.label_template = state['label_template']
+    wf.inputs.input_node.previous_template = state['template']
+    wf.inputs.input_node.previous_seg_template = state['seg_template']
+    wf.inputs.input_node.previous_count = state['num_images']
+    wf.inputs.input_node.previous_warped_labels = [s['warped_label'] for s in state['subjects']]
+    outputs = _run_template_workflow(wf, num_threads, profile, memory_gb, compression, compression_level, ledger,
+                                     retries, retry_backoff)
+
+    change = template_change(state['template'], outputs.template)
+    print('Added %d subjects to the template: relative change %.6f' % (len(straightened_files), change))
+    state['updates'].append({'update': update, 'num_added': len(straightened_files), 'change': change})
+    state['template'] = outputs.template
+    state['seg_template'] = outputs.seg_template
+    state['label_template'] = outputs.label_template
+    state['num_images'] = outputs.num_images
+    state['subjects'] += [{'straightened_file': f, 'warped_image': w, 'warped_seg': ws, 'warped_label': wl}
+                          for f, w, ws, wl in zip(straightened_files, outputs.warped_images,
+                                                  outputs.warped_segs, outputs.warped_labels)]
+
+    return state
+
 # def create_spine_vbm_workflow(output_root):
 #    wf = pe.Workflow(name='spine_vbm', base_dir=os.path.join(output_root, 'spine_vbm'))
 
@@ -19,7 +19,9 @@ args = dict(
     url='https://github.com/jglaister/sct_pipeline'
 )
 
-setup(install_requires=['nipype', 'numpy', 'nibabel'],
-      packages=['sct_pipeline.interfaces', 'sct_pipeline.workflows'],
+# pyarrow for the results store, h5py for ANTs .h5 composite transforms in the native resampling
+setup(install_requires=['nipype', 'numpy', 'nibabel', 'scipy'],
+      extras_require={'results': ['pyarrow'], 'transforms': ['h5py'], 'all': ['pyarrow', 'h5py']},
+      packages=['sct_pipeline.interfaces', 'sct_pipeline.workflows', 'sct_pipeline.benchmark'],
       scripts=glob('bin/*'), **args)
 
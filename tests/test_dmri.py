@@ -0,0 +1,50 @@
+import numpy as np
+import nibabel as nib
+
+from sct_pipeline.interfaces.dmri import ComputeDTINative
+
+
+def _rotation(angles):
+    ax, ay, az = angles
+    rx = np.array([[1, 0, 0], [0, np.cos(ax), -np.sin(ax)], [0, np.sin(ax), np.cos(ax)]])
+    ry = np.array([[np.cos(ay), 0, np.sin(ay)], [0, 1, 0], [-np.sin(ay), 0, np.cos(ay)]])
+    rz = np.array([[np.cos(az), -np.sin(az), 0], [np.sin(az), np.cos(az), 0], [0, 0, 1]])
+    return rz.dot(ry).dot(rx)
+
+
+def _directions(num_directions):
+    # Points on a half sphere (golden spiral)
+    k = np.arange(num_directions) + 0.5
+    gz = k / num_directions
+    angle = np.pi * (3 - np.sqrt(5)) * k
+    return np.stack([np.sqrt(1 - gz ** 2) * np.cos(angle), np.sqrt(1 - gz ** 2) * np.sin(angle), gz], axis=1)
+
+
+def test_compute_dti_native_tensor_phantom(tmp_path, monkeypatch):
+    # Noise free signal of a rotated tensor, the fit must recover its scalar maps
+    evals = np.array([1.7e-3, 0.4e-3, 0.2e-3])
+    rotation = _rotation([0.3, -0.7, 1.1])
+    tensor = rotation.dot(np.diag(evals)).dot(rotation.T)
+    bvecs = np.concatenate([np.zeros((2, 3)), _directions(20)])
+    bvals = np.r_[0, 0, np.full(20, 1000.0)]
+    signal = 1000 * np.exp(-bvals * np.einsum('ni,ij,nj->n', bvecs, tensor, bvecs))
+
+    shape = (4, 4, 3)
+    nib.save(nib.Nifti1Image(np.tile(signal, shape + (1,)).astype(np.float32), np.eye(4)),
+             str(tmp_path / 'dwi.nii.gz'))
+    np.savetxt(str(tmp_path / 'dwi.bval'), bvals[None], fmt='%g')
+    np.savetxt(str(tmp_path / 'dwi.bvec'), bvecs.T, fmt='%.10f')
+
+    monkeypatch.chdir(str(tmp_path))
+    fit = ComputeDTINative(dwi_image=str(tmp_path / 'dwi.nii.gz'), bval=str(tmp_path / 'dwi.bval'),
+                           bvec=str(tmp_path / 'dwi.bvec'))
+    outputs = fit.run().outputs
+
+    md = evals.mean()
+    expected = {'fa': np.sqrt(1.5 * np.sum((evals - md) ** 2) / np.sum(evals ** 2)), 'md': md, 'ad': evals[0],
+                'rd': evals[1:].mean()}
+    for metric, value in expected.items():
+        result = nib.load(getattr(outputs, metric)).get_fdata()
+        assert result.shape == shape
+        # float32 signal and maps
+        np.testing.assert_allclose(result, value, rtol=1e-4)
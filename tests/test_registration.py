@@ -0,0 +1,46 @@
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+from sct_pipeline.benchmark.phantom import cord_phantom
+from sct_pipeline.interfaces.registration import RegisterSlicewiseNative, slice_shifts
+
+
+def test_slice_shifts_recovers_known_shifts():
+    # Every slice of a smooth phantom is moved by a known in-plane shift, integer and sub-voxel
+    cord, csf, tissue, _ = cord_phantom(shape=(48, 48, 12), zooms=(0.75, 0.75, 5.0), noise=0)
+    fixed = ndimage.gaussian_filter(1000 * cord + 600 * csf + 300 * tissue, sigma=(1, 1, 0))
+    rng = np.random.RandomState(0)
+    expected = np.round(rng.uniform(-3, 3, size=(fixed.shape[2], 2)), 1)
+    expected[:4] = np.round(expected[:4])
+
+    # moving(x + shift) = fixed(x)
+    moving = np.stack([ndimage.shift(fixed[..., z], expected[z], order=3, mode='nearest')
+                       for z in range(fixed.shape[2])], axis=2)
+    mask = (cord + csf) > 0
+    shifts, score = slice_shifts(fixed, moving, mask, (5, 5))
+
+    assert np.all(score > 0.9)
+    assert np.max(np.abs(shifts - expected)) < 0.1
+
+
+def test_register_slicewise_native_warp(tmp_path, monkeypatch):
+    # Shifts that vary smoothly along z are recovered through the polynomial and written as an ITK warping field
+    cord, csf, tissue, affine = cord_phantom(shape=(48, 48, 12), zooms=(0.75, 0.75, 5.0), noise=0)
+    destination = ndimage.gaussian_filter(1000 * cord + 600 * csf + 300 * tissue, sigma=(1, 1, 0))
+    z = np.arange(destination.shape[2])
+    expected = np.stack([2.5 - 0.04 * (z - 4) ** 2, -1.5 + 0.3 * z], axis=1)
+    moving = np.stack([ndimage.shift(destination[..., k], expected[k], order=3, mode='nearest') for k in z], axis=2)
+    for data, name in [(destination, 'destination'), (moving, 'input'), ((cord + csf) > 0, 'mask')]:
+        nib.save(nib.Nifti1Image(data.astype(np.float32), affine), str(tmp_path / (name + '.nii.gz')))
+
+    monkeypatch.chdir(str(tmp_path))
+    outputs = RegisterSlicewiseNative(input_image=str(tmp_path / 'input.nii.gz'),
+                                      destination_image=str(tmp_path / 'destination.nii.gz'),
+                                      mask=str(tmp_path / 'mask.nii.gz'), poly=2).run().outputs
+
+    # LPS displacement in mm
+    field = nib.load(outputs.warpfield_input_to_destination).get_fdata()
+    assert field.shape == destination.shape + (1, 3)
+    np.testing.assert_allclose(field[0, 0, :, 0, :2], -0.75 * expected, atol=0.1 * 0.75)
+    assert np.all(field[..., 2] == 0)
@@ -0,0 +1,98 @@
+import numpy as np
+import nibabel as nib
+import pytest
+import scipy.io
+
+from sct_pipeline.interfaces.transforms import resample_images
+
+SHAPE = (12, 10, 8)
+AFFINE = np.array([[1.0, 0, 0, -6], [0, 1.0, 0, 3], [0, 0, 2.0, -10], [0, 0, 0, 1]])
+LPS = np.diag([-1.0, -1.0, 1.0])
+
+
+def _save(tmp_path, name, data, affine=AFFINE):
+    filename = str(tmp_path / name)
+    img = nib.Nifti1Image(data, affine)
+    if data.ndim == 5:
+        img.header.set_intent('vector')
+    nib.save(img, filename)
+    return filename
+
+
+def _rotation_mat(tmp_path, center_voxel, translation_lps):
+    # ITK .mat of a 180 degree rotation about z around the centre of a voxel, then a translation (LPS, mm)
+    center_lps = LPS.dot(AFFINE[:3, :3].dot(center_voxel) + AFFINE[:3, 3])
+    parameters = np.r_[np.diag([-1.0, -1.0, 1.0]).ravel(), translation_lps]
+    filename = str(tmp_path / 'affine.mat')
+    scipy.io.savemat(filename, {'AffineTransform_double_3_3': parameters[:, None], 'fixed': center_lps[:, None]},
+                     format='4')
+    return filename
+
+
+def test_mat_rotation_nearest_neighbour(tmp_path):
+    # Fixed parameters (centre) and translation are LPS: +2 mm in L is -2 voxels in x of the RAS grid
+    data = np.random.RandomState(0).randint(1, 100, size=SHAPE).astype(np.int16)
+    image = _save(tmp_path, 'labels.nii.gz', data)
+    transform = _rotation_mat(tmp_path, [5, 4, 0], [-2.0, 0.0, 0.0])
+
+    output = resample_images([image], ['nn'], image, [transform])[0]
+
+    # Input voxel of reference voxel (i, j, k) is (10 - i + 2, 8 - j, k), 0 outside the input
+    expected = np.zeros(SHAPE, dtype=np.int16)
+    expected[1:, :9] = data[::-1][:11, 8::-1]
+    assert output.dtype == np.int16
+    np.testing.assert_array_equal(output, expected)
+
+
+def test_displacement_field_linear(tmp_path):
+    # Displacement fields are LPS vectors in mm, linear interpolation of a linear image is exact inside the volume
+    i, j, k = np.meshgrid(*[np.arange(n) for n in SHAPE], indexing='ij')
+    image = _save(tmp_path, 'ramp.nii.gz', (3.0 * i + 5.0 * j + 7.0 * k).astype(np.float32))
+    field = np.zeros(SHAPE + (1, 3), dtype=np.float32)
+    field[..., 0] = -0.5
+    field[..., 2] = 1.0
+    warp = _save(tmp_path, 'warp.nii.gz', field)
+
+    output = resample_images([image], ['linear'], image, [warp])[0]
+
+    # Input point of reference voxel (i, j, k) is (i + 0.5, j, k + 0.5)
+    expected = 3.0 * (i + 0.5) + 5.0 * j + 7.0 * (k + 0.5)
+    assert output.dtype == np.float32
+    np.testing.assert_allclose(output[:-1, :, :-1], expected[:-1, :, :-1], rtol=1e-6)
+
+
+def test_h5_composite_matches_transform_files(tmp_path):
+    # Composite of an affine and a displacement field, the last component is applied first as in
+    # antsApplyTransforms, so the composite resamples as the list of the separate files
+    h5py = pytest.importorskip('h5py')
+    data = np.random.RandomState(1).randint(1, 100, size=SHAPE).astype(np.uint8)
+    image = _save(tmp_path, 'labels.nii.gz', data)
+    transform = _rotation_mat(tmp_path, [5, 4, 0], [0.0, 0.0, 0.0])
+    field = np.zeros(SHAPE + (1, 3), dtype=np.float32)
+    field[..., 1] = -1.0
+    warp = _save(tmp_path, 'warp.nii.gz', field)
+
+    composite = str(tmp_path / 'composite.h5')
+    mat = scipy.io.loadmat(transform)
+    origin_lps = LPS.dot(AFFINE[:3, 3])
+    direction_lps = LPS.dot(AFFINE[:3, :3] / np.diag(AFFINE)[:3])
+    with h5py.File(composite, 'w') as f:
+        f.create_dataset('TransformGroup/0/TransformType', data=[np.bytes_('CompositeTransform_double_3_3')])
+        f.create_dataset('TransformGroup/1/TransformType', data=[np.bytes_('AffineTransform_double_3_3')])
+        f.create_dataset('TransformGroup/1/TransformParameters', data=mat['AffineTransform_double_3_3'].ravel())
+        f.create_dataset('TransformGroup/1/TransformFixedParameters', data=mat['fixed'].ravel())
+        f.create_dataset('TransformGroup/2/TransformType',
+                         data=[np.bytes_('DisplacementFieldTransform_double_3_3')])
+        # x varies fastest
+        f.create_dataset('TransformGroup/2/TransformParameters', data=field[:, :, :, 0].transpose(2, 1, 0, 3).ravel())
+        f.create_dataset('TransformGroup/2/TransformFixedParameters',
+                         data=np.r_[SHAPE, origin_lps, np.diag(AFFINE)[:3], direction_lps.ravel()])
+
+    output = resample_images([image], ['nn'], image, [composite])[0]
+    separate = resample_images([image], ['nn'], image, [transform, warp])[0]
+
+    # Field first (+1 voxel in y, RAS), then the rotation: input voxel (10 - i, 8 - (j + 1), k)
+    expected = np.zeros(SHAPE, dtype=np.uint8)
+    expected[:11, :8] = data[10::-1, 7::-1]
+    np.testing.assert_array_equal(output, separate)
+    np.testing.assert_array_equal(output, expected)